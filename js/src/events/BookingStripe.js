@@ -11,7 +11,7 @@ import {
 import {StripeProvider, Elements, CardElement, injectStripe} from 'react-stripe-elements'
 import FontAwesomeIcon from '@fortawesome/react-fontawesome'
 import {ModalFooter} from '../general/Modal'
-import {load_script} from '../utils'
+import {load_script, sleep} from '../utils'
 import Input from '../forms/Input'
 import {User} from './BookingTickets'
 import {Waiting} from '../general/Errors'
@@ -118,12 +118,21 @@ class StripeForm_ extends React.Component {
       this.setState({submitted: true})
 
       const token = payload.token
-      await this.props.requests.post(`events/buy/`, {
+      const r = await this.props.requests.post(`events/buy/`, {
         stripe_token: token.id,
         stripe_client_ip: token.client_ip,
         stripe_card_ref: `${token.card.last4}-${token.card.exp_year}-${token.card.exp_month}`,
         booking_token: this.props.reservation.booking_token,
       })
+      if (r.status === 'pending') {
+        const status = await this.wait_for_payment(r.payment_id)
+        if (status === 'pending') {
+          this.props.set_message({icon: ['fas', 'check-circle'],
+                                  message: 'Payment processing, check your email for confirmation'})
+          this.props.finished()
+          return
+        }
+      }
     } catch (error) {
       this.props.setRootState({error})
       return
@@ -132,6 +141,20 @@ class StripeForm_ extends React.Component {
     this.props.finished()
   }
 
+  async wait_for_payment (payment_id) {
+    // payment is being taken by the worker, poll until it completes or we give up waiting
+    for (let i = 0; i < 60; i++) {
+      await sleep(1000)
+      const r = await this.props.requests.get(`events/payment/${payment_id}/`)
+      if (r.status === 'failed') {
+        throw {user_msg: r.message || 'Payment failed'}
+      } else if (r.status !== 'pending') {
+        return r.status
+      }
+    }
+    return 'pending'
+  }
+
   update_stripe_status (status) {
     this.setState({
       card_error: status.error && status.error.message,
@@ -0,0 +1,78 @@
+"""
+Benchmarks for hot paths, run from the py directory with eg. "python -m benchmarks.aws_signing".
+"""
+import json
+import subprocess
+import timeit
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+
+def run(name, func, *, number=10_000, repeat=5):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    print(f'{name:>40}: {number / best:10,.0f} per second, {best / number * 1e6:8.1f}µs each')
+
+
+def latency_stats(times: List[float], duration: float) -> dict:
+    """
+    Summarise request times in seconds over a run lasting duration seconds, latencies are in milliseconds.
+    """
+    times = sorted(times)
+    count = len(times)
+    if not count:
+        return dict(count=0, per_second=0)
+
+    def percentile(p):
+        return round(times[min(count - 1, int(count * p / 100))] * 1000, 2)
+
+    return dict(
+        count=count,
+        per_second=round(count / duration, 2),
+        mean=round(sum(times) / count * 1000, 2),
+        p50=percentile(50),
+        p95=percentile(95),
+        p99=percentile(99),
+        max=round(times[-1] * 1000, 2),
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, name: str, config: dict, results: dict):
+    """
+    Save results as json together with the commit and config so runs can be compared.
+    """
+    data = dict(
+        benchmark=name,
+        commit=git_commit(),
+        time=datetime.utcnow().isoformat(),
+        config=config,
+        results=results,
+    )
+    Path(path).write_text(json.dumps(data, indent=2))
+    print(f'results saved to {path}')
+
+
+def compare_results(path, results: dict, *, section=None, keys=('per_second', 'p50', 'p99')):
+    """
+    Print the change in each key for each row of results from those saved at path by a previous run, section
+    picks the rows out of the saved results if they're not at the top level.
+    """
+    previous = json.loads(Path(path).read_text())
+    previous_results = previous['results'][section] if section else previous['results']
+    print(f'\nchange from {previous["commit"]} ({previous["time"]:.16}):')
+    for row, values in results.items():
+        old = previous_results.get(row)
+        if not old:
+            continue
+        changes = (
+            f'{k} {(values[k] - old[k]) / old[k]:+7.1%}' for k in keys if old.get(k) and values.get(k) is not None
+        )
+        print(f'{row:>30}: {"  ".join(changes)}')
@@ -0,0 +1,313 @@
+"""
+HTTP load test of the API, run from the py directory with eg.
+
+    python -m benchmarks.api --concurrency 50 --duration 60 --save api.json
+
+The app is run from create_app with the stand-ins for SES, stripe, google and grecaptcha from tests/dummy_server.py,
+either in process (optionally with --stand-ins-behaviour to add latency and errors) or already running at the url
+given with --stand-ins. The database (set with DATABASE_URL as usual) must first be seeded with
+"./run.py patch create_bulk_data --live". Virtual users each stay on one company and run randomly chosen scenarios
+until the duration is up, results are reported per route.
+
+The "buy" scenario adds reservations and tickets to the database and enqueues confirmation emails in redis,
+reseed the database before comparing runs which include it.
+"""
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import time
+from typing import List, NamedTuple
+
+import uvloop
+from aiohttp import ClientSession, CookieJar, TCPConnector
+from aiohttp.test_utils import TestServer
+from buildpg import asyncpg
+
+from shared.settings import Settings
+from tests.dummy_server import create_dummy_server
+from web.main import create_app
+
+from . import compare_results, latency_stats, save_results
+
+STAND_IN_URL_FIELDS = 'aws_ses_endpoint', 'grecaptcha_url', 'google_siw_url', 'facebook_siw_url', 'stripe_root'
+
+
+class Company(NamedTuple):
+    domain: str
+    cat_slugs: List[str]
+    events: List[dict]
+    # upcoming paid events with plenty of tickets left
+    bookable: List[int]
+    hosts: List[str]
+    admins: List[str]
+
+
+async def load_companies(settings: Settings) -> List[Company]:
+    conn = await asyncpg.connect_b(dsn=settings.pg_dsn)
+    companies = []
+    try:
+        for company_id, domain in await conn.fetch("SELECT id, domain FROM companies WHERE slug LIKE 'bulk-%'"):
+            cat_slugs = [r[0] for r in await conn.fetch(
+                'SELECT slug FROM categories WHERE company=$1 AND live=TRUE', company_id
+            )]
+            events = [dict(r) for r in await conn.fetch(
+                """
+                SELECT e.id, c.slug AS cat_slug, e.slug
+                FROM events AS e
+                JOIN categories AS c ON e.category = c.id
+                WHERE c.company=$1 AND e.status='published' AND e.public=TRUE
+                ORDER BY e.start_ts DESC
+                LIMIT 200
+                """,
+                company_id,
+            )]
+            bookable = [r[0] for r in await conn.fetch(
+                """
+                SELECT e.id
+                FROM events AS e
+                JOIN categories AS c ON e.category = c.id
+                WHERE c.company=$1 AND e.status='published' AND e.start_ts > now() AND e.price IS NOT NULL AND
+                  (e.ticket_limit IS NULL OR e.ticket_limit - e.tickets_taken > 100)
+                """,
+                company_id,
+            )]
+            users = await conn.fetch(
+                """
+                SELECT email, role FROM users
+                WHERE company=$1 AND role IN ('host', 'admin') AND status='active' AND password_hash IS NOT NULL
+                """,
+                company_id,
+            )
+            if cat_slugs and events and bookable:
+                companies.append(Company(
+                    domain=domain,
+                    cat_slugs=cat_slugs,
+                    events=events,
+                    bookable=bookable,
+                    hosts=[r['email'] for r in users if r['role'] == 'host'],
+                    admins=[r['email'] for r in users if r['role'] == 'admin'],
+                ))
+    finally:
+        await conn.close()
+    if not companies:
+        raise RuntimeError('no bulk companies found, run "./run.py patch create_bulk_data --live" first')
+    return companies
+
+
+class Results:
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.start = time()
+
+    def record(self, route: str, duration: float, status):
+        self.times[route].append(duration)
+        self.statuses[route][status] += 1
+
+    def summary(self) -> dict:
+        duration = time() - self.start
+        return {
+            route: {
+                **latency_stats(times, duration),
+                'statuses': {str(k): v for k, v in self.statuses[route].items()},
+            }
+            for route, times in sorted(self.times.items())
+        }
+
+
+class VirtualUser:
+    def __init__(self, root: str, company: Company, connector: TCPConnector, results: Results):
+        self.root = root
+        self.company = company
+        self.results = results
+        # the company is found from the host, cookies are set for the server's ip address hence unsafe
+        self.session = ClientSession(
+            cookie_jar=CookieJar(unsafe=True),
+            connector=connector,
+            connector_owner=False,
+            headers={'Host': company.domain},
+        )
+        self.role = None
+
+    async def request(self, route: str, method: str, path: str, **kwargs):
+        start = time()
+        try:
+            async with self.session.request(method, self.root + path, **kwargs) as r:
+                if r.content_type == 'application/json':
+                    data = await r.json()
+                else:
+                    data = await r.read()
+        except (OSError, asyncio.TimeoutError) as e:
+            self.results.record(route, time() - start, e.__class__.__name__)
+            return None, None
+        self.results.record(route, time() - start, r.status)
+        return r.status, data
+
+    async def login(self, role: str, *, force=False):
+        if self.role == role and not force:
+            return True
+        email = random.choice(self.company.admins if role == 'admin' else self.company.hosts)
+        status, data = await self.request('login', 'post', '/api/login/', json={'email': email, 'password': 'testing'})
+        if status != 200:
+            self.role = None
+            return False
+        status, _ = await self.request('auth-token', 'post', '/api/auth-token/', json={'token': data['auth_token']})
+        self.role = role if status == 200 else None
+        return self.role is not None
+
+    async def close(self):
+        await self.session.close()
+
+
+async def scenario_home(user: VirtualUser):
+    await user.request('index', 'get', '/api/')
+
+
+async def scenario_browse(user: VirtualUser):
+    await user.request('index', 'get', '/api/')
+    await user.request('category', 'get', f'/api/cat/{random.choice(user.company.cat_slugs)}/')
+    event = random.choice(user.company.events)
+    await user.request('event-get', 'get', f'/api/events/{event["cat_slug"]}/{event["slug"]}/')
+
+
+async def scenario_login(user: VirtualUser):
+    await user.login('host', force=True)
+
+
+async def scenario_buy(user: VirtualUser):
+    if not await user.login('host'):
+        return
+    event_id = random.choice(user.company.bookable)
+    status, data = await user.request(
+        'event-reserve-tickets', 'post', f'/api/events/{event_id}/reserve/',
+        json={'tickets': [{'t': True}] * random.randint(1, 3)},
+    )
+    if status == 200:
+        await user.request('event-buy-tickets', 'post', '/api/events/buy/', json={
+            'stripe_token': 'tok_visa',
+            'stripe_client_ip': '127.0.0.1',
+            'stripe_card_ref': '4242-32-08',
+            'booking_token': data['booking_token'],
+        })
+
+
+async def scenario_admin(user: VirtualUser):
+    if not await user.login('admin'):
+        return
+    await user.request('event-browse', 'get', '/api/events/')
+    event_id = random.choice(user.company.events)['id']
+    await user.request('event-retrieve', 'get', f'/api/events/{event_id}/')
+    await user.request('event-tickets', 'get', f'/api/events/{event_id}/tickets/')
+    await user.request('user-browse', 'get', '/api/users/')
+
+
+SCENARIOS = {
+    'home': scenario_home,
+    'browse': scenario_browse,
+    'login': scenario_login,
+    'buy': scenario_buy,
+    'admin': scenario_admin,
+}
+DEFAULT_MIX = 'home:30,browse:50,login:5,buy:10,admin:5'
+
+
+async def run_user(user: VirtualUser, scenarios, weights, end: float):
+    try:
+        while time() < end:
+            scenario = random.choices(scenarios, weights=weights)[0]
+            await scenario(user)
+    finally:
+        await user.close()
+
+
+async def start_server(app, loop):
+    server = TestServer(app, loop=loop)
+    await server.start_server(loop=loop)
+    return server
+
+
+async def start_stand_ins(loop, *, url: str = None, behaviour: str = None):
+    """
+    Start the stand-ins for external services unless url is given, returns the server (if started) and its url.
+    """
+    if url:
+        return None, url.rstrip('/')
+    behaviour_config = behaviour and json.loads(Path(behaviour).read_text())
+    server = await create_dummy_server(loop, lambda app: start_server(app, loop), behaviour_config)
+    return server, server.app['server_name']
+
+
+async def benchmark(loop, *, concurrency: int, duration: float, mix: dict, seed: int, stand_ins: str = None,
+                    stand_ins_behaviour: str = None):
+    random.seed(seed)
+    dummy_server, server_name = await start_stand_ins(loop, url=stand_ins, behaviour=stand_ins_behaviour)
+    settings = Settings(**{f: f'{server_name}/{f}/' for f in STAND_IN_URL_FIELDS})
+    companies = await load_companies(settings)
+
+    app_server = await start_server(create_app(settings=settings), loop)
+    root = f'http://127.0.0.1:{app_server.port}'
+    connector = TCPConnector(limit=concurrency, loop=loop)
+    results = Results()
+    print(f'running {concurrency} virtual users against {len(companies)} companies for {duration}s...')
+    try:
+        end = time() + duration
+        scenarios, weights = [SCENARIOS[s] for s in mix], list(mix.values())
+        await asyncio.gather(*(
+            run_user(VirtualUser(root, companies[i % len(companies)], connector, results), scenarios, weights, end)
+            for i in range(concurrency)
+        ))
+        return results.summary()
+    finally:
+        connector.close()
+        await app_server.close()
+        dummy_server and await dummy_server.close()
+
+
+def print_results(results: dict):
+    print(f'{"route":>25} {"requests":>9} {"per sec":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}  statuses')
+    for route, r in results.items():
+        statuses = ', '.join(f'{k}: {v}' for k, v in sorted(r['statuses'].items()))
+        print(f'{route:>25} {r["count"]:9,d} {r["per_second"]:9.1f} {r["p50"]:9.1f} {r["p95"]:9.1f} '
+              f'{r["p99"]:9.1f}  {statuses}')
+
+
+def parse_mix(v: str) -> dict:
+    mix = {}
+    for item in v.split(','):
+        name, _, weight = item.partition(':')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario "{name}", options are: {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test of the API')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f'scenarios with relative weights, default "{DEFAULT_MIX}"')
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--stand-ins', help='url of stand-ins for external services already running')
+    parser.add_argument('--stand-ins-behaviour', help='json file with latency and errors for the stand-ins')
+    parser.add_argument('--save', help='save results to this json file')
+    parser.add_argument('--compare', help='compare results to those saved by a previous run')
+    args = parser.parse_args()
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    config = dict(concurrency=args.concurrency, duration=args.duration, mix=args.mix, seed=args.seed,
+                  stand_ins=args.stand_ins, stand_ins_behaviour=args.stand_ins_behaviour)
+    results = loop.run_until_complete(benchmark(loop, **config))
+    print_results(results)
+    if args.save:
+        save_results(args.save, 'api', config, results)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+from shared.emails.plumbing import BaseEmailActor
+from shared.settings import Settings
+
+from . import run
+
+
+def main():
+    settings = Settings(aws_access_key='testing_access_key', aws_secret_key='testing_secret_key')
+    actor = BaseEmailActor(settings=settings)
+    data = b'x' * 5_000
+    run('aws signature, 5KB email', lambda: actor._aws_headers(data))
+    run('aws signing key, cached', lambda: actor._aws_signing_key('20180101'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+Contention benchmark for ticket sales: many buyers try to book one event with a ticket limit at the same moment.
+
+Run from the py directory with eg.
+
+    python -m benchmarks.contention --buyers 300 --ticket-limit 100 --pool-size 20 --mode buy
+
+A company, event and one user per buyer are created in the database set with DATABASE_URL and deleted afterwards.
+All buyers log in first, then reserve (and in "buy" mode pay for) tickets at once. pg_locks is sampled throughout
+for lock waits, the run fails if more tickets were taken than the event's ticket_limit.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+from time import time
+
+import uvloop
+from aiohttp import TCPConnector
+from buildpg import asyncpg
+
+from shared.settings import Settings
+from shared.utils import mk_password
+from web.main import create_app
+
+from . import compare_results, latency_stats, save_results
+from .api import STAND_IN_URL_FIELDS, Company, Results, VirtualUser, start_server, start_stand_ins
+
+LOCK_WAITS_SQL = """
+SELECT l.locktype, a.wait_event_type
+FROM pg_locks AS l
+JOIN pg_stat_activity AS a ON l.pid = a.pid
+WHERE NOT l.granted AND a.datname = current_database()
+"""
+
+
+async def create_event(conn, settings: Settings, *, buyers: int, ticket_limit: int):
+    name = f'contention-{int(time())}'
+    company_id = await conn.fetchval(
+        """
+        INSERT INTO companies (name, slug, domain, stripe_public_key, stripe_secret_key)
+        VALUES ($1, $1, $1 || '.example.com', 'pk_test_contention', 'sk_test_contention')
+        RETURNING id
+        """,
+        name,
+    )
+    # logins aren't being measured, a low work factor keeps them quick
+    password_hash = mk_password('testing', Settings(bcrypt_work_factor=4))
+    emails = [f'buyer-{i}@{name}.example.com' for i in range(buyers)]
+    user_ids = await conn.fetch(
+        """
+        INSERT INTO users (company, role, status, first_name, last_name, email, password_hash)
+        SELECT $1, 'host', 'active', 'Buyer', 'Testing', unnest($2::varchar[]), $3
+        RETURNING id
+        """,
+        company_id, emails, password_hash,
+    )
+    cat_id = await conn.fetchval(
+        "INSERT INTO categories (company, name, slug) VALUES ($1, 'Contention', 'contention') RETURNING id",
+        company_id,
+    )
+    event_id = await conn.fetchval(
+        """
+        INSERT INTO events (category, status, host, name, slug, start_ts, price, ticket_limit)
+        VALUES ($1, 'published', $2, 'Contention', 'contention', $3, 10, $4)
+        RETURNING id
+        """,
+        cat_id, user_ids[0][0], datetime.utcnow() + timedelta(days=7), ticket_limit,
+    )
+    return company_id, event_id, Company(
+        domain=f'{name}.example.com', cat_slugs=[], events=[], bookable=[event_id], hosts=emails, admins=[]
+    )
+
+
+async def sample_lock_waits(pool, stop: asyncio.Event, interval: float):
+    """
+    Sample lock waits until stop is set, returns the number of samples and a count of waiting locks by type.
+    """
+    samples, waits, max_waiting = 0, Counter(), 0
+    async with pool.acquire() as conn:
+        while not stop.is_set():
+            rows = await conn.fetch(LOCK_WAITS_SQL)
+            samples += 1
+            waits.update(f'{r["locktype"]}:{r["wait_event_type"]}' for r in rows)
+            max_waiting = max(max_waiting, len(rows))
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    return dict(
+        samples=samples,
+        mean_waiting=round(sum(waits.values()) / max(samples, 1), 2),
+        max_waiting=max_waiting,
+        by_type=dict(waits.most_common()),
+    )
+
+
+async def buy(user: VirtualUser, event_id: int, tickets: int, mode: str, start: asyncio.Event):
+    await start.wait()
+    status, data = await user.request(
+        'event-reserve-tickets', 'post', f'/api/events/{event_id}/reserve/', json={'tickets': [{'t': True}] * tickets}
+    )
+    if status == 200 and mode == 'buy':
+        await user.request('event-buy-tickets', 'post', '/api/events/buy/', json={
+            'stripe_token': 'tok_visa',
+            'stripe_client_ip': '127.0.0.1',
+            'stripe_card_ref': '4242-32-08',
+            'booking_token': data['booking_token'],
+        })
+
+
+async def benchmark(loop, *, buyers: int, ticket_limit: int, tickets: int, pool_size: int, mode: str,
+                    lock_sample_interval: float, stand_ins: str = None, stand_ins_behaviour: str = None):
+    dummy_server, server_name = await start_stand_ins(loop, url=stand_ins, behaviour=stand_ins_behaviour)
+    settings = Settings(**{f: f'{server_name}/{f}/' for f in STAND_IN_URL_FIELDS})
+
+    admin_pool = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=2, max_size=2)
+    async with admin_pool.acquire() as conn:
+        company_id, event_id, company = await create_event(conn, settings, buyers=buyers, ticket_limit=ticket_limit)
+
+    app = create_app(settings=settings)
+    app['main_app']['pg'] = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=pool_size, max_size=pool_size)
+    app_server = await start_server(app, loop)
+    root = f'http://127.0.0.1:{app_server.port}'
+    connector = TCPConnector(limit=buyers, loop=loop)
+    results = Results()
+    users = [VirtualUser(root, company._replace(hosts=[email]), connector, results) for email in company.hosts]
+    try:
+        print(f'logging in {buyers} buyers...')
+        await asyncio.gather(*(u.login('host') for u in users))
+
+        print(f'{buyers} buyers booking {tickets} tickets each for an event with {ticket_limit} tickets, '
+              f'mode "{mode}", pool size {pool_size}...')
+        results = Results()
+        for u in users:
+            u.results = results
+        start, stop = asyncio.Event(), asyncio.Event()
+        sampler = loop.create_task(sample_lock_waits(admin_pool, stop, lock_sample_interval))
+        buyer_tasks = asyncio.gather(*(buy(u, event_id, tickets, mode, start) for u in users))
+        start_time = time()
+        start.set()
+        await buyer_tasks
+        duration = time() - start_time
+        stop.set()
+        lock_waits = await sampler
+
+        async with admin_pool.acquire() as conn:
+            tickets_sold, tickets_taken = await conn.fetchrow(
+                """
+                SELECT (SELECT count(*) FROM tickets WHERE event=$1 AND status != 'cancelled'), tickets_taken
+                FROM events WHERE id=$1
+                """,
+                event_id,
+            )
+        reserved = results.statuses['event-reserve-tickets']
+        return dict(
+            duration=round(duration, 3),
+            reservations_per_second=round(reserved[200] / duration, 2),
+            reserve_statuses={str(k): v for k, v in reserved.items()},
+            rate_470=round(reserved[470] / max(sum(reserved.values()), 1), 3),
+            tickets_sold=tickets_sold,
+            tickets_taken=tickets_taken,
+            oversold=max(tickets_sold - ticket_limit, 0),
+            lock_waits=lock_waits,
+            routes={route: latency_stats(times, duration) for route, times in results.times.items()},
+        )
+    finally:
+        await asyncio.gather(*(u.close() for u in users))
+        connector.close()
+        await app_server.close()
+        dummy_server and await dummy_server.close()
+        async with admin_pool.acquire() as conn:
+            await conn.execute('DELETE FROM events WHERE id=$1', event_id)
+            await conn.execute('DELETE FROM companies WHERE id=$1', company_id)
+        await admin_pool.close()
+
+
+def print_results(r: dict):
+    print(f'\n{r["reservations_per_second"]:0.1f} successful reservations per second over {r["duration"]:0.2f}s')
+    print(f'reserve statuses: {r["reserve_statuses"]}, 470 rate {r["rate_470"]:0.1%}')
+    print(f'tickets sold: {r["tickets_sold"]}, tickets_taken: {r["tickets_taken"]}, oversold: {r["oversold"]}')
+    lw = r['lock_waits']
+    print(f'lock waits: mean {lw["mean_waiting"]} max {lw["max_waiting"]} over {lw["samples"]} samples, '
+          f'by type: {lw["by_type"]}')
+    for route, s in r['routes'].items():
+        print(f'{route:>25}: p50 {s["p50"]}ms p95 {s["p95"]}ms p99 {s["p99"]}ms max {s["max"]}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Contention benchmark for ticket sales on a single event')
+    parser.add_argument('--buyers', type=int, default=200)
+    parser.add_argument('--ticket-limit', type=int, default=100)
+    parser.add_argument('--tickets', type=int, default=1, help='tickets per booking')
+    parser.add_argument('--pool-size', type=int, default=10, help="size of the app's postgres connection pool")
+    parser.add_argument('--mode', choices=('reserve', 'buy'), default='reserve',
+                        help='"reserve" only reserves tickets, "buy" also pays for them')
+    parser.add_argument('--lock-sample-interval', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--stand-ins', help='url of stand-ins for external services already running')
+    parser.add_argument('--stand-ins-behaviour', help='json file with latency and errors for the stand-ins')
+    parser.add_argument('--save', help='save results to this json file')
+    parser.add_argument('--compare', help='compare results to those saved by a previous run')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    config = dict(buyers=args.buyers, ticket_limit=args.ticket_limit, tickets=args.tickets, pool_size=args.pool_size,
+                  mode=args.mode, lock_sample_interval=args.lock_sample_interval, stand_ins=args.stand_ins,
+                  stand_ins_behaviour=args.stand_ins_behaviour)
+    r = loop.run_until_complete(benchmark(loop, **config))
+    print_results(r)
+    if args.save:
+        save_results(args.save, 'contention', config, r)
+    if args.compare:
+        compare_results(args.compare, r['routes'], section='routes')
+    if r['oversold'] or r['tickets_sold'] != r['tickets_taken']:
+        print('oversold!', file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""
+Email sending throughput of one worker, run from the py directory with eg.
+
+    python -m benchmarks.emails --batch-sizes 10,100,1000 --save emails.json
+
+send_emails is run for each batch size against the stand-in SES endpoint from tests/dummy_server.py (or one already
+running given with --stand-ins), with a company and users created in the database set with DATABASE_URL and
+deleted afterwards. Redis is needed for SES rate limiting, the rate is set high enough not to limit sends.
+
+Time spent in each phase is measured by wrapping the functions which implement it:
+
+* db: queries on the actor's pool
+* render: clean_ctx, render_email (chevron and markdown) and personalise_email, with "--ctx shared" each batch
+  is rendered once and personalised per user, with "--ctx unique" every email is rendered in full
+* mime: building the EmailMessage and encoding it for SES (quoted-printable, base64 and urlencode)
+* sign: SigV4 signing
+* rate limit: SES rate limiter checks in redis
+* http: requests to SES, including reading the response
+
+Emails are sent concurrently so phase times are totals across all sends and can add up to more than the wall
+clock time. With --memory, peak memory allocated during each batch is measured with tracemalloc which slows
+everything down, stand-ins run in process keep every email they receive so use --stand-ins for clean numbers.
+"""
+import argparse
+import asyncio
+import resource
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import wraps
+from time import perf_counter, time
+
+import uvloop
+from buildpg import asyncpg
+
+from shared.emails import plumbing
+from shared.emails.defaults import Triggers
+from shared.emails.plumbing import BaseEmailActor, UserEmail
+from shared.emails.ratelimit import SesRateLimiter
+from shared.settings import Settings
+
+from . import compare_results, save_results
+from .api import start_stand_ins
+
+PHASES = 'db', 'render', 'mime', 'sign', 'rate limit', 'http'
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    def wrap(self, phase, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.totals[phase] += perf_counter() - start
+        return wrapper
+
+    def wrap_async(self, phase, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.totals[phase] += perf_counter() - start
+        return wrapper
+
+
+class TimedConnection:
+    def __init__(self, conn, timer: PhaseTimer):
+        self._conn = conn
+        self._timer = timer
+
+    def __getattr__(self, item):
+        v = getattr(self._conn, item)
+        if item in {'execute', 'executemany', 'fetch', 'fetchrow', 'fetchval'}:
+            return self._timer.wrap_async('db', v)
+        return v
+
+
+class TimedPool:
+    def __init__(self, pool, timer: PhaseTimer):
+        self._pool = pool
+        self._timer = timer
+
+    def acquire(self):
+        return TimedAcquire(self._pool.acquire(), self._timer)
+
+    async def close(self):
+        await self._pool.close()
+
+
+class TimedAcquire:
+    def __init__(self, acquire, timer: PhaseTimer):
+        self._acquire = acquire
+        self._timer = timer
+
+    async def __aenter__(self):
+        return TimedConnection(await self._acquire.__aenter__(), self._timer)
+
+    async def __aexit__(self, *args):
+        return await self._acquire.__aexit__(*args)
+
+
+class TimedClient:
+    """
+    Wraps the actor's ClientSession to time requests from sending them to reading the response.
+    """
+    def __init__(self, client, timer: PhaseTimer):
+        self._client = client
+        self._timer = timer
+
+    def post(self, *args, **kwargs):
+        return TimedRequest(self._client.post(*args, **kwargs), self._timer)
+
+    async def close(self):
+        await self._client.close()
+
+
+class TimedRequest:
+    def __init__(self, request, timer: PhaseTimer):
+        self._request = request
+        self._timer = timer
+        self._start = None
+
+    async def __aenter__(self):
+        self._start = perf_counter()
+        return await self._request.__aenter__()
+
+    async def __aexit__(self, *args):
+        try:
+            return await self._request.__aexit__(*args)
+        finally:
+            self._timer.totals['http'] += perf_counter() - self._start
+
+
+def instrument(actor: BaseEmailActor, timer: PhaseTimer):
+    """
+    Wrap the functions implementing each phase, module level functions are replaced in the plumbing module.
+    """
+    for name in ('clean_ctx', 'render_email', 'personalise_email'):
+        setattr(plumbing, name, timer.wrap('render', getattr(plumbing, name)))
+    for name in ('email_message', 'ses_send_data'):
+        setattr(plumbing, name, timer.wrap('mime', getattr(plumbing, name)))
+    actor._aws_headers = timer.wrap('sign', actor._aws_headers)
+    actor._ses_limiter.acquire = timer.wrap_async('rate limit', actor._ses_limiter.acquire)
+    actor.client = TimedClient(actor.client, timer)
+    actor.pg = TimedPool(actor.pg, timer)
+
+
+async def create_users(conn, count: int):
+    name = f'emails-{int(time())}'
+    company_id = await conn.fetchval(
+        "INSERT INTO companies (name, slug, domain) VALUES ($1, $1, $1 || '.example.com') RETURNING id", name
+    )
+    user_ids = await conn.fetch(
+        """
+        INSERT INTO users (company, role, status, first_name, last_name, email)
+        SELECT $1, 'guest', 'active', 'Frank', 'Spencer', 'user-' || i || '@' || $2
+        FROM generate_series(1, $3) AS i
+        RETURNING id
+        """,
+        company_id, f'{name}.example.com', count,
+    )
+    return company_id, [r[0] for r in user_ids]
+
+
+def email_ctx(start: datetime, i: int = None):
+    return {
+        'event_link': '/supper-clubs/franks-great-supper/',
+        'event_name': "Frank's Great Supper" if i is None else f"Frank's Great Supper {i}",
+        'event_short_description': 'Eat, drink & discuss middle aged, middle class things like house prices.',
+        'event_start': start,
+        'event_duration': 7200,
+        'event_location': '31 Testing Road, London',
+        'static_map': 'https://maps.googleapis.com/maps/api/staticmap?center=51.479415,-0.132098&zoom=12',
+        'google_maps_url': 'https://www.google.com/maps/place/51.479415,-0.132098/@51.479415,-0.132098,13z',
+    }
+
+
+async def benchmark(loop, *, batch_sizes, ctx: str, concurrency: int, memory: bool, stand_ins: str = None):
+    dummy_server, server_name = await start_stand_ins(loop, url=stand_ins)
+    settings = Settings(
+        aws_access_key='testing_access_key',
+        aws_secret_key='testing_secret_key',
+        aws_ses_endpoint=f'{server_name}/aws_ses_endpoint/',
+        aws_ses_max_send_rate=1_000_000,
+        email_send_concurrency=concurrency,
+    )
+    actor = BaseEmailActor(settings=settings, loop=loop, concurrency_enabled=False)
+    actor.pg = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=2, max_size=5)
+    actor._ses_limiter = SesRateLimiter(await actor.get_redis(), max_rate=settings.aws_ses_max_send_rate)
+    async with actor.pg.acquire() as conn:
+        company_id, user_ids = await create_users(conn, max(batch_sizes))
+
+    timer = PhaseTimer()
+    instrument(actor, timer)
+    event_start = datetime.utcnow() + timedelta(hours=12)
+    results = {}
+    try:
+        for batch_size in batch_sizes:
+            users_emails = [
+                UserEmail(id=user_id, ctx=email_ctx(event_start, i if ctx == 'unique' else None))
+                for i, user_id in enumerate(user_ids[:batch_size])
+            ]
+            timer.totals.clear()
+            if memory:
+                tracemalloc.start()
+            start = perf_counter()
+            sent = await actor.send_emails.direct(company_id, Triggers.event_reminder.value, users_emails,
+                                                  dedupe_key=f'benchmark-{batch_size}-{time()}')
+            duration = perf_counter() - start
+            r = dict(
+                sent=sent,
+                seconds=round(duration, 3),
+                per_second=round(sent / duration, 1),
+                phase_ms_per_email={p: round(timer.totals[p] / batch_size * 1000, 3) for p in PHASES},
+                max_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            )
+            if memory:
+                r['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+                tracemalloc.stop()
+            results[str(batch_size)] = r
+    finally:
+        async with actor.pg.acquire() as conn:
+            await conn.execute('DELETE FROM companies WHERE id=$1', company_id)
+        await actor.close()
+        await actor.shutdown()
+        dummy_server and await dummy_server.close()
+    return results
+
+
+def print_results(results: dict):
+    print(f'{"batch":>7} {"sent":>7} {"per sec":>9} ' + ' '.join(f'{p + " ms":>13}' for p in PHASES) + '  memory')
+    for batch_size, r in results.items():
+        phases = ' '.join(f'{r["phase_ms_per_email"][p]:13.3f}' for p in PHASES)
+        memory = f'{r["max_rss_mb"]}MB max rss'
+        if 'peak_traced_mb' in r:
+            memory += f', {r["peak_traced_mb"]}MB peak traced'
+        print(f'{batch_size:>7} {r["sent"]:7,d} {r["per_second"]:9.1f} {phases}  {memory}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Email rendering and sending throughput')
+    parser.add_argument('--batch-sizes', type=lambda v: [int(s) for s in v.split(',')], default='10,100,1000')
+    parser.add_argument('--ctx', choices=('shared', 'unique'), default='shared',
+                        help='whether all users have the same context, eg. reminders, or each a different one')
+    parser.add_argument('--concurrency', type=int, default=Settings.__fields__['email_send_concurrency'].default,
+                        help='emails sent at once, email_send_concurrency')
+    parser.add_argument('--memory', action='store_true', help='measure peak memory with tracemalloc')
+    parser.add_argument('--stand-ins', help='url of stand-ins for external services already running')
+    parser.add_argument('--save', help='save results to this json file')
+    parser.add_argument('--compare', help='compare results to those saved by a previous run')
+    args = parser.parse_args()
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    config = dict(batch_sizes=args.batch_sizes, ctx=args.ctx, concurrency=args.concurrency, memory=args.memory,
+                  stand_ins=args.stand_ins)
+    results = loop.run_until_complete(benchmark(loop, **config))
+    print_results(results)
+    if args.save:
+        save_results(args.save, 'emails', config, results)
+    if args.compare:
+        compare_results(args.compare, results, keys=('per_second',))
+
+
+if __name__ == '__main__':
+    main()
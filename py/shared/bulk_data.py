@@ -0,0 +1,319 @@
+"""
+Generate large volumes of realistic data for benchmarking, used by the create_bulk_data patch.
+
+Rows are built in python from a seeded random generator and loaded with COPY, ids are reserved from each table's
+sequence up front so rows can reference each other before they're inserted. The same seed and volumes always give
+the same data in an empty database, except that dates are relative to the day the data is created.
+"""
+import json
+import logging
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, NamedTuple
+
+from .utils import mk_password, slugify
+
+logger = logging.getLogger('nosht.bulk_data')
+
+
+class BulkConfig(NamedTuple):
+    seed: int = 123
+    companies: int = 10
+    # per company
+    users: int = 5_000
+    # in total, shared evenly between companies
+    events: int = 20_000
+    # mean tickets sold for a published event
+    tickets: int = 150
+    # mean logins per host or admin
+    logins: int = 20
+
+
+USER_COLUMNS = (
+    'id', 'company', 'role', 'status', 'first_name', 'last_name', 'email', 'password_hash', 'receive_emails',
+    'created_ts', 'active_ts',
+)
+CAT_COLUMNS = 'id', 'company', 'name', 'slug', 'live', 'description', 'sort_index', 'image'
+EVENT_COLUMNS = (
+    'id', 'category', 'status', 'host', 'name', 'slug', 'highlight', 'start_ts', 'duration', 'short_description',
+    'long_description', 'public', 'location_name', 'location_lat', 'location_lng', 'price', 'ticket_limit',
+    'tickets_taken', 'image',
+)
+ACTION_COLUMNS = 'id', 'company', 'user_id', 'ts', 'type', 'extra'
+TICKET_COLUMNS = 'event', 'user_id', 'reserve_action', 'paid_action', 'status', 'created_ts', 'extra'
+
+FIRST_NAMES = (
+    'Frank', 'Jane', 'Anna', 'Ben', 'Chloe', 'David', 'Emma', 'George', 'Hannah', 'Isaac', 'Jack', 'Lucy', 'Mohammed',
+    'Olivia', 'Priya', 'Sam', 'Tom', 'Zoe',
+)
+LAST_NAMES = (
+    'Spencer', 'Dow', 'Smith', 'Jones', 'Williams', 'Taylor', 'Brown', 'Davies', 'Evans', 'Patel', 'Wilson', 'Khan',
+    'Wright', 'Walker', 'Green', 'Hughes', 'Edwards', "O'Brien",
+)
+WORDS = (
+    'sit', 'quisquam', 'eius', 'sed', 'tempora', 'aliquam', 'labore', 'voluptatem', 'porro', 'etincidunt', 'adipisci',
+    'dolor', 'amet', 'magnam', 'quaerat', 'neque', 'est', 'numquam', 'dolorem', 'quiquia', 'ipsum', 'ut', 'dolore',
+    'consectetur', 'modi', 'non',
+)
+CAT_NAMES = (
+    'Supper Clubs', 'Singing Events', 'Walks', 'Book Clubs', 'Workshops', 'Talks', 'Wine Tastings', 'Film Nights',
+    'Quizzes', 'Dances',
+)
+EVENT_ADJECTIVES = 'Great', 'Quiet', 'Loud', 'Summer', 'Winter', 'Annual', 'Big', 'Small', 'Late', 'Early'
+IMAGES = (
+    'https://nosht.scolvin.com/cat/mountains/options/yQt1XLAPDm',
+    'https://nosht.scolvin.com/cat/mountains/options/YEcz6kUlsc',
+    'https://nosht.scolvin.com/cat/mountains/options/g3I6RDoZtE',
+    'https://nosht.scolvin.com/cat/mountains/options/zwaxBXpsyu',
+)
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.99 '
+    'Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/11.1.1 '
+    'Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 11_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/11.0 '
+    'Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:61.0) Gecko/20100101 Firefox/61.0',
+    'Mozilla/5.0 (Linux; Android 8.0.0; SM-G960F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.87 '
+    'Mobile Safari/537.36',
+)
+
+
+async def reserve_ids(conn, table: str, count: int) -> int:
+    """
+    Take count ids from table's id sequence, returns the first.
+    """
+    seq = await conn.fetchval("SELECT pg_get_serial_sequence($1, 'id')", table)
+    last_id = await conn.fetchval('SELECT setval($1::regclass, nextval($1::regclass) + $2 - 1)', seq, count)
+    return last_id - count + 1
+
+
+class BulkData:
+    def __init__(self, conn, settings, config: BulkConfig):
+        self.conn = conn
+        self.config = config
+        self.rand = random.Random(config.seed)
+        self.today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.password_hash = mk_password('testing', settings)
+        self.ua_ids: List[int] = []
+        self.counts = dict(companies=0, users=0, categories=0, events=0, actions=0, tickets=0)
+
+    async def load(self):
+        # update_user_ts would run for every action, active_ts is set from the latest action instead
+        await self.conn.execute('ALTER TABLE actions DISABLE TRIGGER update_user_ts')
+        try:
+            await self._load()
+        finally:
+            await self.conn.execute('ALTER TABLE actions ENABLE TRIGGER update_user_ts')
+        await self.conn.execute('ANALYZE')
+        return self.counts
+
+    async def _load(self):
+        await self.conn.execute(
+            'INSERT INTO user_agents (ua) SELECT unnest($1::varchar[]) ON CONFLICT (ua) DO NOTHING', USER_AGENTS
+        )
+        self.ua_ids = [r[0] for r in await self.conn.fetch('SELECT id FROM user_agents WHERE ua=ANY($1)', USER_AGENTS)]
+
+        events_per_company = -(-self.config.events // self.config.companies)
+        for _ in range(self.config.companies):
+            await self.create_company(events_per_company)
+            logger.info('%(companies)d companies, %(events)d events, %(tickets)d tickets, %(actions)d actions',
+                        self.counts)
+
+        await self.conn.execute(
+            """
+            UPDATE users AS u SET active_ts=a.ts
+            FROM (SELECT user_id, max(ts) AS ts FROM actions GROUP BY user_id) AS a
+            WHERE u.id=a.user_id AND u.active_ts < a.ts
+            """
+        )
+
+    async def create_company(self, event_count: int):
+        rand = self.rand
+        company_id = await self.conn.fetchval(
+            """
+            INSERT INTO companies (name, slug, domain, image, stripe_public_key, stripe_secret_key)
+            VALUES ('Bulk ' || $1, 'bulk-' || $1, 'bulk-' || $1 || '.example.com', $2, 'pk_test_bulk', 'sk_test_bulk')
+            RETURNING id
+            """,
+            f'{self.config.seed}-{self.counts["companies"] + 1}', rand.choice(IMAGES)
+        )
+        self.counts['companies'] += 1
+
+        users, host_ids, guest_ids = await self.users(company_id)
+        await self.copy('users', users, USER_COLUMNS)
+
+        cat_count = rand.randint(3, len(CAT_NAMES))
+        first_cat_id = await reserve_ids(self.conn, 'categories', cat_count)
+        cat_ids = list(range(first_cat_id, first_cat_id + cat_count))
+        cats = [
+            (cat_id, company_id, name, slugify(name), rand.random() < 0.9, self.sentence(10, 20)[:140], i,
+             rand.choice(IMAGES))
+            for i, (cat_id, name) in enumerate(zip(cat_ids, rand.sample(CAT_NAMES, len(cat_ids))))
+        ]
+        await self.copy('categories', cats, CAT_COLUMNS)
+
+        # actions have to exist before the tickets which reference them, so tickets are created with indexes into
+        # actions and ids are assigned once the number of actions is known
+        actions, tickets = [], []
+        for user_id, _, role, *_, created_ts, _ in users:
+            if role == 'guest':
+                continue
+            for _ in range(int(rand.expovariate(1 / self.config.logins))):
+                ts = self.ts_between(created_ts, self.today)
+                actions.append((company_id, user_id, ts, 'login', self.request_extra('/api/auth-token/')))
+
+        first_event_id = await reserve_ids(self.conn, 'events', event_count)
+        events = []
+        for event_id in range(first_event_id, first_event_id + event_count):
+            event = self.event(event_id, rand.choice(cat_ids), rand.choice(host_ids))
+            if event[2] == 'published':
+                tickets_taken = self.bookings(company_id, event, guest_ids, actions, tickets)
+                event = event[:-2] + (tickets_taken, event[-1])
+            events.append(event)
+        await self.copy('events', events, EVENT_COLUMNS)
+        if not actions:
+            return
+
+        first_action_id = await reserve_ids(self.conn, 'actions', len(actions))
+        await self.copy('actions', [(first_action_id + i, *a) for i, a in enumerate(actions)], ACTION_COLUMNS)
+        tickets = [
+            (
+                event_id,
+                user_id,
+                first_action_id + reserve_index,
+                None if paid_index is None else first_action_id + paid_index,
+                *t,
+            )
+            for event_id, user_id, reserve_index, paid_index, *t in tickets
+        ]
+        await self.copy('tickets', tickets, TICKET_COLUMNS)
+
+    async def users(self, company_id: int):
+        rand = self.rand
+        user_count = self.config.users
+        first_id = await reserve_ids(self.conn, 'users', user_count)
+        host_count = max(5, user_count // 50)
+        users, host_ids, guest_ids = [], [], []
+        for i, user_id in enumerate(range(first_id, first_id + user_count)):
+            if i < 2:
+                role, status, password_hash = 'admin', 'active', self.password_hash
+            elif i < host_count:
+                role, status, password_hash = 'host', 'active', self.password_hash
+                host_ids.append(user_id)
+            else:
+                # guests are mostly created by someone else buying them a ticket and never confirm their email
+                role, status, password_hash = 'guest', 'active' if rand.random() < 0.1 else 'pending', None
+                guest_ids.append(user_id)
+
+            if role == 'guest' and rand.random() < 0.3:
+                first_name, last_name = None, None
+            else:
+                first_name, last_name = rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)
+            created_ts = self.today - timedelta(days=rand.uniform(0, 1000))
+            users.append((
+                user_id, company_id, role, status, first_name, last_name, f'user-{user_id}@example.com',
+                password_hash, rand.random() < 0.95, created_ts, created_ts,
+            ))
+        return users, host_ids, guest_ids
+
+    def event(self, event_id, cat_id, host_id):
+        rand = self.rand
+        name = f'{rand.choice(EVENT_ADJECTIVES)} {rand.choice(WORDS).title()} {rand.choice(CAT_NAMES)[:-1]}'
+        # most events are in the past, about 20% are upcoming
+        start_ts = self.today + timedelta(days=int(rand.uniform(-730, 180)))
+        if rand.random() < 0.1:
+            duration = None
+        else:
+            start_ts += timedelta(hours=rand.randint(10, 20))
+            duration = timedelta(hours=rand.randint(1, 4))
+        status = rand.choices(('published', 'pending', 'suspended'), weights=(85, 10, 5))[0]
+        lat, lng = None, None
+        if rand.random() < 0.8:
+            lat, lng = round(rand.gauss(51.5, 0.1), 6), round(rand.gauss(-0.12, 0.15), 6)
+        return (
+            event_id, cat_id, status, host_id, name, f'{slugify(name)}-{event_id}', rand.random() < 0.1, start_ts,
+            duration, self.sentence(12, 20)[:140], self.paragraphs(), rand.random() < 0.9,
+            f'{rand.randint(1, 300)} {rand.choice(LAST_NAMES)} Road, London', lat, lng,
+            rand.choice((None, Decimal(10), Decimal(15), Decimal(20), Decimal(25), Decimal(30), Decimal(50))),
+            None if rand.random() < 0.4 else rand.randint(10, 200),
+            0,
+            rand.choice(IMAGES),
+        )
+
+    def bookings(self, company_id, event, guest_ids, actions, tickets) -> int:
+        """
+        Add actions and tickets for bookings of a published event, returns the number of tickets taken.
+        """
+        rand = self.rand
+        event_id, start_ts, ticket_limit = event[0], event[7], event[-3]
+        demand = int(rand.expovariate(1 / self.config.tickets))
+        if start_ts > self.today:
+            # upcoming events are still selling
+            demand = int(demand * rand.random())
+        if ticket_limit is not None:
+            demand = min(demand, ticket_limit)
+
+        tickets_taken = 0
+        while tickets_taken < demand:
+            ticket_count = min(rand.choice((1, 1, 1, 2, 2, 3, 4)), demand - tickets_taken)
+            buyer_id = rand.choice(guest_ids)
+            reserve_ts = start_ts - timedelta(days=rand.uniform(0, 60))
+            if reserve_ts > self.today:
+                reserve_ts = self.today - timedelta(days=rand.uniform(0, 30))
+            reserve_index = len(actions)
+            actions.append((company_id, buyer_id, reserve_ts, 'reserve-tickets', self.request_extra('/api/')))
+            if rand.random() < 0.05:
+                # the reservation expired or was cancelled
+                actions.append((company_id, buyer_id, reserve_ts + timedelta(minutes=2), 'cancel-reserved-tickets',
+                                None))
+                paid_index, status = None, 'cancelled'
+            else:
+                paid_index, status = len(actions), 'paid'
+                actions.append((company_id, buyer_id, reserve_ts + timedelta(minutes=1), 'buy-tickets', json.dumps({
+                    'new_customer': rand.random() < 0.5,
+                    'new_card': rand.random() < 0.5,
+                    'charge_id': f'ch_{rand.getrandbits(64):016x}',
+                    'card_last4': '4242',
+                    'card_expiry': f'{rand.randint(1, 12)}/{rand.randint(19, 23)}',
+                })))
+                tickets_taken += ticket_count
+
+            for i in range(ticket_count):
+                user_id = buyer_id if i == 0 else (rand.choice(guest_ids) if rand.random() < 0.9 else None)
+                extra = json.dumps({'dietary_req': 'vegetarian'}) if rand.random() < 0.05 else None
+                tickets.append((event_id, user_id, reserve_index, paid_index, status, reserve_ts, extra))
+        return tickets_taken
+
+    async def copy(self, table, records, columns):
+        await self.conn.copy_records_to_table(table, records=records, columns=columns)
+        self.counts[table] += len(records)
+
+    def ts_between(self, start, end):
+        return start + (end - start) * self.rand.random()
+
+    def request_extra(self, url):
+        return json.dumps({
+            'url': url,
+            'ip': '.'.join(str(self.rand.randint(1, 254)) for _ in range(4)),
+            'ua_id': self.rand.choice(self.ua_ids),
+        })
+
+    def sentence(self, min_words, max_words):
+        words = self.rand.choices(WORDS, k=self.rand.randint(min_words, max_words))
+        return ' '.join(words).capitalize() + '.'
+
+    def paragraphs(self):
+        return '\n\n'.join(
+            ' '.join(self.sentence(5, 15) for _ in range(self.rand.randint(2, 6)))
+            for _ in range(self.rand.randint(1, 4))
+        )
+
+
+async def load_bulk_data(conn, settings, config: BulkConfig) -> dict:
+    """
+    Create config.companies companies with users, categories, events, tickets and actions, returns the number
+    of rows created for each table.
+    """
+    return await BulkData(conn, settings, config).load()
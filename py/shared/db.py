@@ -5,11 +5,13 @@ import random
 from datetime import datetime, timedelta
 from enum import Enum
 from textwrap import shorten
+from time import time
 
 import lorem
 from async_timeout import timeout
 from buildpg import Values, asyncpg
 
+from .bulk_data import BulkConfig, load_bulk_data
 from .emails.defaults import Triggers
 from .settings import Settings
 from .utils import mk_password, slugify
@@ -205,6 +207,122 @@ async def update_enums(conn, settings, **kwargs):
         await conn.execute(f"ALTER TYPE EMAIL_TRIGGERS ADD VALUE IF NOT EXISTS '{t.value}'")
 
 
+@patch
+async def add_charging_ticket_status(conn, settings, **kwargs):
+    """
+    add "charging" to TICKET_STATUS, needs to be run with --direct
+    """
+    await conn.execute("ALTER TYPE TICKET_STATUS ADD VALUE IF NOT EXISTS 'charging' AFTER 'reserved'")
+
+
+@patch
+async def add_user_stripe_sources(conn, settings, **kwargs):
+    """
+    add stripe_sources column to users
+    """
+    await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_sources JSONB')
+
+
+@patch
+async def create_email_outbox(conn, settings, **kwargs):
+    """
+    create email_outbox table
+    """
+    await conn.execute("""
+    CREATE TYPE EMAIL_OUTBOX_STATUS AS ENUM ('pending', 'sent', 'skipped', 'dead');
+    CREATE TABLE email_outbox (
+      id SERIAL PRIMARY KEY,
+      company INT NOT NULL REFERENCES companies ON DELETE CASCADE,
+      trigger EMAIL_TRIGGERS NOT NULL,
+      user_id INT NOT NULL REFERENCES users ON DELETE CASCADE,
+      dedupe_key VARCHAR(63) NOT NULL,
+      ctx JSONB,
+      status EMAIL_OUTBOX_STATUS NOT NULL DEFAULT 'pending',
+      attempts SMALLINT NOT NULL DEFAULT 0,
+      send_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+      message_id VARCHAR(255),
+      error TEXT,
+      created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE UNIQUE INDEX email_outbox_dedupe ON email_outbox USING btree (company, trigger, user_id, dedupe_key);
+    CREATE INDEX email_outbox_pending ON email_outbox USING btree (company, trigger, send_after)
+      WHERE status='pending';
+    CREATE INDEX email_outbox_created ON email_outbox USING btree (created_ts);
+    """)
+
+
+@patch
+async def add_event_reminded(conn, settings, **kwargs):
+    """
+    add reminded column to events, existing events which have started are marked as reminded
+    """
+    await conn.execute('ALTER TABLE events ADD COLUMN IF NOT EXISTS reminded BOOLEAN NOT NULL DEFAULT FALSE')
+    await conn.execute('UPDATE events SET reminded=TRUE WHERE start_ts < now()')
+    await conn.execute("""
+    CREATE INDEX IF NOT EXISTS event_reminder_due ON events USING btree (start_ts)
+      WHERE status='published' AND reminded=FALSE
+    """)
+
+
+@patch
+async def actions_autovacuum(conn, settings, **kwargs):
+    """
+    vacuum actions more often now old actions are deleted by MaintenanceActor.archive_actions
+    """
+    await conn.execute(
+        'ALTER TABLE actions SET (autovacuum_vacuum_scale_factor=0.02, autovacuum_analyze_scale_factor=0.01)'
+    )
+
+
+@patch
+async def create_user_agents(conn, settings, **kwargs):
+    """
+    create user_agents and move user agents in actions.extra to it, this rewrites every action with a user agent
+    """
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_agents (
+      id SERIAL PRIMARY KEY,
+      ua VARCHAR(1023) NOT NULL UNIQUE
+    )
+    """)
+    await conn.execute(settings.logic_sql)
+    v = await conn.execute("UPDATE actions SET extra=compact_action_extra(extra) WHERE extra ? 'ua'")
+    logger.info('compacted actions: %s', v)
+
+
+@patch
+async def update_indexes(conn, settings, **kwargs):
+    """
+    add indexes for tickets, event listings and actions by user and remove low selectivity indexes,
+    run with --direct as indexes are created concurrently
+    """
+    for sql in (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_event_status ON tickets USING btree (event, status)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_reserve_action ON tickets USING btree (reserve_action)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_paid_action ON tickets USING btree (paid_action)',
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_charging ON tickets USING btree (paid_action)
+          WHERE status='charging'
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS event_listed ON events USING btree (category, start_ts)
+          WHERE status='published' AND public=TRUE
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS event_highlighted ON events USING btree (category, start_ts)
+          WHERE status='published' AND public=TRUE AND highlight IS TRUE
+        """,
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS action_user_type ON actions USING btree (user_id, type)',
+        'DROP INDEX CONCURRENTLY IF EXISTS action_compound',
+        'DROP INDEX CONCURRENTLY IF EXISTS action_type',
+        'DROP INDEX CONCURRENTLY IF EXISTS category_live',
+        'DROP INDEX CONCURRENTLY IF EXISTS event_status',
+        'DROP INDEX CONCURRENTLY IF EXISTS event_public',
+        'DROP INDEX CONCURRENTLY IF EXISTS event_highlight',
+    ):
+        await conn.execute(sql)
+
+
 USERS = [
     {
         'first_name': 'Frank',
@@ -326,6 +444,14 @@ Numbered:
 """
 
 
+@patch
+async def outbox_optional_dedupe_key(conn, settings, **kwargs):
+    """
+    allow email_outbox.dedupe_key to be null for emails which shouldn't be deduplicated
+    """
+    await conn.execute('ALTER TABLE email_outbox ALTER COLUMN dedupe_key DROP NOT NULL')
+
+
 @patch
 async def create_demo_data(conn, settings, **kwargs):
     """
@@ -368,3 +494,18 @@ VALUES :values""", [
                 **e)
             for e in events
         ])
+
+
+@patch
+async def create_bulk_data(conn, settings, **kwargs):
+    """
+    Create large volumes of data for benchmarking, volumes are set with BULK_SEED, BULK_COMPANIES, BULK_USERS,
+    BULK_EVENTS, BULK_TICKETS and BULK_LOGINS, see BulkConfig.
+    """
+    config = BulkConfig(**{
+        f: int(os.environ[f'BULK_{f.upper()}']) for f in BulkConfig._fields if f'BULK_{f.upper()}' in os.environ
+    })
+    logger.info('creating bulk data %s', config)
+    start = time()
+    counts = await load_bulk_data(conn, settings, config)
+    logger.info('created %s in %0.1fs', ', '.join(f'{v:,d} {k}' for k, v in counts.items()), time() - start)
@@ -71,17 +71,45 @@ Event:
 """
     },
     Triggers.event_update: {
-        'subject': 'event_update',
-        'title': '',
+        'subject': '{{{ event_name }}} Update',
+        'title': '{{ company_name }}',
         'body': """
-Email event_update
+Hi {{ first_name }},
+
+The details of **{{ event_name }}** have changed, please check the new details below.
+
+{{ centered_button(View Event | {{ event_link }}) }}
+
+Event:
+
+* Start Time: **{{ event_start }}**
+* Duration: **{{ event_duration }}**
+* Location: **{{ event_location }}**
+
+{{#static_map}}
+[![{{ event_location }}]({{{ static_map }}})]({{{ google_maps_url }}})
+{{/static_map}}
 """
     },
     Triggers.event_reminder: {
-        'subject': 'event_reminder',
-        'title': '',
+        'subject': '{{{ event_name }}} Reminder',
+        'title': '{{ company_name }}',
         'body': """
-Email event_reminder
+Hi {{ first_name }},
+
+Just a reminder that **{{ event_name }}** is coming up soon.
+
+{{ centered_button(View Event | {{ event_link }}) }}
+
+Event:
+
+* Start Time: **{{ event_start }}**
+* Duration: **{{ event_duration }}**
+* Location: **{{ event_location }}**
+
+{{#static_map}}
+[![{{ event_location }}]({{{ static_map }}})]({{{ google_maps_url }}})
+{{/static_map}}
 """
     },
     Triggers.event_booking: {
@@ -1,19 +1,71 @@
 import datetime
 import json
 import logging
+from collections import Counter
 from typing import Optional
 
-from arq import concurrent
+from arq import Actor, concurrent, cron
 
 from ..utils import display_cash, password_reset_link, static_map_link
 from .defaults import Triggers
-from .plumbing import BaseEmailActor, UserEmail
+from .plumbing import OUTBOX_ADD_SQL, BaseEmailActor, UserEmail, outbox_ctx
 
 logger = logging.getLogger('nosht.email.main')
 
+REMINDER_EVENTS_SQL = """
+WITH e AS (
+  UPDATE events SET reminded=TRUE
+  WHERE id IN (
+    SELECT id FROM events
+    WHERE status='published' AND reminded=FALSE AND start_ts BETWEEN now() AND now() + $1::int * interval '1 hour'
+    ORDER BY start_ts
+    LIMIT $2
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING id, category, slug, name, short_description, start_ts, duration, location_name, location_lat, location_lng
+)
+SELECT e.*, cat.slug AS cat_slug, cat.company, array(
+  SELECT DISTINCT user_id FROM tickets WHERE event=e.id AND status='paid' AND user_id IS NOT NULL
+) AS user_ids
+FROM e
+JOIN categories AS cat ON e.category = cat.id
+"""
+
+EVENT_UPDATE_SQL = """
+SELECT e.id, e.slug, e.name, e.short_description, e.start_ts, e.duration,
+  e.location_name, e.location_lat, e.location_lng, cat.slug AS cat_slug, cat.company, array(
+    SELECT DISTINCT user_id FROM tickets WHERE event=e.id AND status='paid' AND user_id IS NOT NULL
+  ) AS user_ids
+FROM events AS e
+JOIN categories AS cat ON e.category = cat.id
+WHERE e.id=$1 AND e.status='published'
+"""
+
+
+def event_ctx(data, settings) -> dict:
+    """
+    Email context shared by all emails about an event.
+    """
+    duration: Optional[datetime.timedelta] = data['duration']
+    ctx = {
+        'event_link': '/{cat_slug}/{slug}/'.format(**data),
+        'event_name': data['name'],
+        'event_short_description': data['short_description'],
+        'event_start': data['start_ts'] if duration else data['start_ts'].date(),
+        'event_duration': int(duration.total_seconds()) if duration else 'All day',
+        'event_location': data['location_name'],
+    }
+    lat, lng = data['location_lat'], data['location_lng']
+    if lat and lng:
+        ctx.update(
+            static_map=static_map_link(lat, lng, settings=settings),
+            google_maps_url=f'https://www.google.com/maps/place/{lat},{lng}/@{lat},{lng},13z',
+        )
+    return ctx
+
 
 class EmailActor(BaseEmailActor):
-    @concurrent
+    @concurrent(Actor.HIGH_QUEUE)
     async def send_event_conf(self, paid_action_id: int):
         async with self.pg.acquire() as conn:
             data = await conn.fetchrow(
@@ -39,23 +91,11 @@ class EmailActor(BaseEmailActor):
             other_user_ids = {r_[0] for r_ in r}
             other_user_ids.remove(buyer_user_id)
 
-        duration: Optional[datetime.timedelta] = data['duration']
         ctx = {
-            'event_link': '/{cat_slug}/{slug}/'.format(**data),
-            'event_name': data['name'],
-            'event_short_description': data['short_description'],
-            'event_start': data['start_ts'] if duration else data['start_ts'].date(),
-            'event_duration': int(duration.total_seconds()) if duration else 'All day',
-            'event_location': data['location_name'],
+            **event_ctx(data, self.settings),
             'ticket_price': display_cash(data['price'], data['currency']),
             'buyer_name': data['user_name']
         }
-        lat, lng = data['location_lat'], data['location_lng']
-        if lat and lng:
-            ctx.update(
-                static_map=static_map_link(lat, lng, settings=self.settings),
-                google_maps_url=f'https://www.google.com/maps/place/{lat},{lng}/@{lat},{lng},13z',
-            )
 
         ticket_count = len(other_user_ids) + 1
         ctx_buyer = {
@@ -68,19 +108,22 @@ class EmailActor(BaseEmailActor):
             action_extra = json.loads(data['extra'])
             ctx_buyer['card_details'] = '{card_expiry} - ending {card_last4}'.format(**action_extra)
 
+        dedupe_key = f'paid-action-{paid_action_id}'
         await self.send_emails.direct(
             data['company'],
             Triggers.ticket_buyer,
-            [UserEmail(id=buyer_user_id, ctx=ctx_buyer)]
+            [UserEmail(id=buyer_user_id, ctx=ctx_buyer)],
+            dedupe_key=dedupe_key,
         )
         if other_user_ids:
             await self.send_emails.direct(
                 data['company'],
                 Triggers.ticket_other,
-                [UserEmail(id=user_id, ctx=ctx) for user_id in other_user_ids]
+                [UserEmail(id=user_id, ctx=ctx) for user_id in other_user_ids],
+                dedupe_key=dedupe_key,
             )
 
-    @concurrent
+    @concurrent(Actor.HIGH_QUEUE)
     async def send_account_created(self, user_id: int):
         async with self.pg.acquire() as conn:
             company_id, status = await conn.fetchrow('SELECT company, status FROM users WHERE id=$1', user_id)
@@ -88,4 +131,67 @@ class EmailActor(BaseEmailActor):
         if status == 'pending':
             ctx['confirm_email_link'] = password_reset_link(user_id, auth_fernet=self.auth_fernet)
 
-        await self.send_emails.direct(company_id, Triggers.account_created, [UserEmail(id=user_id, ctx=ctx)])
+        await self.send_emails.direct(company_id, Triggers.account_created, [UserEmail(id=user_id, ctx=ctx)],
+                                      dedupe_key='account-created')
+
+    @cron(minute={5, 15, 25, 35, 45, 55})
+    async def send_event_reminders(self):
+        """
+        Remind ticket holders of events starting in the next event_reminder_window hours. Events are marked as
+        reminded in the same transaction which adds their reminders to the outbox, so each event is reminded
+        once and reminders can't be lost between the two. Reminders are then sent by drain_outbox jobs, up to
+        email_broadcast_jobs per company so large events are shared between workers.
+        """
+        trigger = Triggers.event_reminder
+        event_count = 0
+        while True:
+            emails = Counter()
+            async with self.pg.acquire() as conn:
+                async with conn.transaction():
+                    events = await conn.fetch(REMINDER_EVENTS_SQL, self.settings.event_reminder_window, 100)
+                    rows = []
+                    for e in events:
+                        ctx_json = outbox_ctx(event_ctx(e, self.settings))
+                        rows += [(e['company'], trigger.value, user_id, f'event-{e["id"]}', ctx_json)
+                                 for user_id in e['user_ids']]
+                        emails[e['company']] += len(e['user_ids'])
+                    if rows:
+                        await conn.executemany(OUTBOX_ADD_SQL, rows)
+            if not events:
+                return event_count
+            event_count += len(events)
+
+            for company_id, count in emails.items():
+                chunks = -(-count // self.settings.email_send_chunk_size)
+                for _ in range(min(chunks, self.settings.email_broadcast_jobs)):
+                    await self.drain_outbox(company_id, trigger.value)
+
+    @concurrent(Actor.LOW_QUEUE)
+    async def send_event_update(self, event_id: int, edit_action_id: int):
+        """
+        Tell everyone with a paid ticket for an event that its details have changed.
+
+        The context is the same for every recipient so it's rendered and serialised once, outbox rows are added
+        for all recipients and then sent by up to email_broadcast_jobs drain_outbox jobs in parallel. The
+        edit-event action is the dedupe key so each edit is sent once and progress can be checked with
+        outbox_progress.
+        """
+        trigger = Triggers.event_update
+        async with self.pg.acquire() as conn:
+            data = await conn.fetchrow(EVENT_UPDATE_SQL, event_id)
+            if not data or not data['user_ids']:
+                return 0
+            company_id, user_ids = data['company'], data['user_ids']
+            dedupe_key, ctx_json = f'event-update-{edit_action_id}', outbox_ctx(event_ctx(data, self.settings))
+            await conn.executemany(
+                OUTBOX_ADD_SQL,
+                [(company_id, trigger.value, user_id, dedupe_key, ctx_json) for user_id in user_ids]
+            )
+
+        chunks = -(-len(user_ids) // self.settings.email_send_chunk_size)
+        jobs = min(chunks, self.settings.email_broadcast_jobs)
+        logger.info('event %d updated, sending %d emails with %d jobs, dedupe key %s',
+                    event_id, len(user_ids), jobs, dedupe_key)
+        for _ in range(jobs):
+            await self.drain_outbox(company_id, trigger.value)
+        return len(user_ids)
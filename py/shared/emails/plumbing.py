@@ -3,29 +3,34 @@ import base64
 import datetime
 import hashlib
 import hmac
+import html
 import json
 import logging
+import random
 import re
-from binascii import hexlify
+from collections import Counter
 from email.message import EmailMessage
 from email.policy import SMTP
-from functools import reduce
+from functools import lru_cache, reduce
 from pathlib import Path
 from textwrap import shorten
-from typing import Any, Dict, List, NamedTuple
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from urllib.parse import urlencode
 
 import chevron
 import sass
 from aiohttp import ClientSession, ClientTimeout
-from arq import Actor, concurrent
+from arq import Actor, concurrent, cron
 from buildpg import asyncpg
 from cryptography import fernet
+from chevron.tokenizer import tokenize
 from misaka import HtmlRenderer, Markdown
 
 from ..settings import Settings
 from ..utils import RequestError, format_duration, unsubscribe_sig
 from .defaults import EMAIL_DEFAULTS, Triggers
+from .ratelimit import SesRateLimiter
 
 logger = logging.getLogger('nosht.email.plumbing')
 
@@ -72,6 +77,71 @@ class UserEmail(NamedTuple):
     ctx: Dict[str, Any] = {}
 
 
+OUTBOX_ADD_SQL = """
+INSERT INTO email_outbox (company, trigger, user_id, dedupe_key, ctx) VALUES ($1, $2, $3, $4, $5)
+ON CONFLICT (company, trigger, user_id, dedupe_key) DO NOTHING
+"""
+OUTBOX_CLAIM_SQL = """
+UPDATE email_outbox SET attempts=attempts + 1, send_after=now() + $4::int * interval '1 second'
+WHERE id IN (
+  SELECT id FROM email_outbox
+  WHERE company=$1 AND trigger=$2 AND status='pending' AND send_after <= now()
+  ORDER BY id
+  LIMIT $3
+  FOR UPDATE SKIP LOCKED
+)
+RETURNING id, user_id, ctx, attempts
+"""
+OUTBOX_RESULT_SQL = """
+UPDATE email_outbox SET status=$2, message_id=$3, error=$4, send_after=now() + $5::int * interval '1 second'
+WHERE id=$1
+"""
+OUTBOX_PROGRESS_SQL = """
+SELECT status, count(*) FROM email_outbox WHERE company=$1 AND trigger=$2 AND dedupe_key=$3 GROUP BY status
+"""
+OUTBOX_SKIP_SQL = "UPDATE email_outbox SET status='skipped' WHERE company=$1 AND trigger=$2 AND status='pending'"
+EMAIL_USERS_SQL = """
+SELECT id, first_name, last_name, email
+FROM users
+WHERE company=$1 AND status!='suspended' AND receive_emails=TRUE AND email IS NOT NULL AND id=ANY($2)
+"""
+
+
+class CompiledEmail(NamedTuple):
+    subject: list
+    body: list
+    template: list
+    debug_context: bool
+    # whether there are sections on user fields, see _SECTION_USER_FIELDS
+    user_sections: bool
+
+
+class EmailConfig(NamedTuple):
+    email: CompiledEmail
+    title: str
+    e_from: str
+    global_ctx: Dict[str, Any]
+
+
+class RenderedEmail(NamedTuple):
+    subject: str
+    text: str
+    html: str
+
+
+# fields which differ between users with the same context, see render_shared_email
+USER_FIELDS = 'first_name', 'full_name', 'unsubscribe_link'
+# placeholders survive mustache escaping, markdown and html unchanged
+_PLACEHOLDER = 'zxq{}qxz'
+_PLACEHOLDER_REGEX = re.compile(_PLACEHOLDER.format(r'(\d)'))
+_PREVIEW_PLACEHOLDER = _PLACEHOLDER.format(0)
+_USER_PLACEHOLDERS = {f: _PLACEHOLDER.format(i) for i, f in enumerate(USER_FIELDS, start=1)}
+# render_shared_email would render sections on these fields with the placeholder, which is always truthy,
+# rather than the user's value so emails with them are rendered for each user, unsubscribe_link is set for
+# every user so sections on it render the same either way
+_SECTION_USER_FIELDS = set(USER_FIELDS) - {'unsubscribe_link'}
+
+
 class BaseEmailActor(Actor):
     def __init__(self, *, settings: Settings, http_client=None, pg=None, **kwargs):
         self.redis_settings = settings.redis_settings
@@ -85,71 +155,110 @@ class BaseEmailActor(Actor):
         self.auth_fernet = fernet.Fernet(self.settings.auth_key)
         self.send_via_aws = self.settings.aws_access_key and not self.settings.print_emails
 
+        # parts of the SigV4 signature which don't change between requests
+        self._signing_key_date, self._signing_key = None, None
+        self._credential_scope = _CREDENTIAL_SCOPE.format(
+            date_stamp='{date_stamp}', region=self.settings.aws_region, service=_AWS_SERVICE,
+            auth_request=_AWS_AUTH_REQUEST,
+        )
+        header_values = {'content-type': _CONTENT_TYPE, 'host': self._host, 'x-amz-date': '{x_amz_date}'}
+        canonical_headers = ''.join(f'{h}:{header_values[h]}\n' for h in _SIGNED_HEADERS)
+        self._canonical_request = _CANONICAL_REQUEST.format(
+            canonical_headers=canonical_headers,
+            signed_headers=';'.join(_SIGNED_HEADERS),
+            payload_hash='{payload_hash}',
+        )
+        self._auth_header = _AUTH_HEADER.format(
+            algorithm=_AUTH_ALGORITHM,
+            access_key=self.settings.aws_access_key,
+            credential_scope='{credential_scope}',
+            signed_headers=';'.join(_SIGNED_HEADERS),
+            signature='{signature}',
+        )
+        self._ses_limiter = None
+        # (company id, trigger) -> (expiry, config), see _email_config
+        self._config_cache: Dict[Tuple[int, Triggers], Tuple[float, Optional[EmailConfig]]] = {}
+        self._config_listener = None
+
     async def startup(self):
         self.pg = self.pg or await asyncpg.create_pool_b(dsn=self.settings.pg_dsn, min_size=2)
+        if self.settings.email_config_cache_ttl:
+            self._config_listener = await asyncpg.connect_b(dsn=self.settings.pg_dsn, loop=self.loop)
+            await self._config_listener.add_listener('email_config', self._email_config_changed)
 
     async def shutdown(self):
         await self.client.close()
         await self.pg.close()
+        if self._config_listener:
+            await self._config_listener.close()
+
+    def _email_config_changed(self, conn, pid, channel, payload):
+        """
+        Called via postgres NOTIFY when a company or its email definitions are modified, see logic.sql.
+        """
+        company_id = int(payload)
+        for key in [k for k in self._config_cache if k[0] == company_id]:
+            self._config_cache.pop(key, None)
+
+    def _aws_signing_key(self, date_stamp: str) -> bytes:
+        """
+        The SigV4 signing key only depends on the date, so it's derived once per day.
+        """
+        if self._signing_key_date != date_stamp:
+            key_parts = (
+                b'AWS4' + self.settings.aws_secret_key.encode(),
+                date_stamp,
+                self.settings.aws_region,
+                _AWS_SERVICE,
+                _AWS_AUTH_REQUEST,
+            )
+            self._signing_key = reduce(lambda key, msg: hmac.new(key, msg.encode(), hashlib.sha256).digest(), key_parts)
+            self._signing_key_date = date_stamp
+        return self._signing_key
 
     def _aws_headers(self, data):
         n = datetime.datetime.utcnow()
         x_amz_date = n.strftime('%Y%m%dT%H%M%SZ')
-        date_stamp = n.strftime('%Y%m%d')
-        ctx = dict(
-            access_key=self.settings.aws_access_key,
-            algorithm=_AUTH_ALGORITHM,
+        date_stamp = x_amz_date[:8]
+        credential_scope = self._credential_scope.format(date_stamp=date_stamp)
+
+        canonical_request = self._canonical_request.format(
             x_amz_date=x_amz_date,
-            auth_request=_AWS_AUTH_REQUEST,
-            content_type=_CONTENT_TYPE,
-            date_stamp=date_stamp,
-            host=self._host,
             payload_hash=hashlib.sha256(data).hexdigest(),
-            region=self.settings.aws_region,
-            service=_AWS_SERVICE,
-            signed_headers=';'.join(_SIGNED_HEADERS),
-        )
-        ctx.update(
-            credential_scope=_CREDENTIAL_SCOPE.format(**ctx),
         )
-        canonical_headers = ''.join('{}:{}\n'.format(h, ctx[h.replace('-', '_')]) for h in _SIGNED_HEADERS)
-
-        canonical_request = _CANONICAL_REQUEST.format(canonical_headers=canonical_headers, **ctx).encode()
-
-        s2s = _STRING_TO_SIGN.format(canonical_request_hash=hashlib.sha256(canonical_request).hexdigest(), **ctx)
-
-        key_parts = (
-            b'AWS4' + self.settings.aws_secret_key.encode(),
-            date_stamp,
-            self.settings.aws_region,
-            _AWS_SERVICE,
-            _AWS_AUTH_REQUEST,
-            s2s,
+        s2s = _STRING_TO_SIGN.format(
+            algorithm=_AUTH_ALGORITHM,
+            x_amz_date=x_amz_date,
+            credential_scope=credential_scope,
+            canonical_request_hash=hashlib.sha256(canonical_request.encode()).hexdigest(),
         )
-        signature = reduce(lambda key, msg: hmac.new(key, msg.encode(), hashlib.sha256).digest(), key_parts)
+        signature = hmac.new(self._aws_signing_key(date_stamp), s2s.encode(), hashlib.sha256).hexdigest()
 
-        authorization_header = _AUTH_HEADER.format(signature=hexlify(signature).decode(), **ctx)
         return {
             'Content-Type': _CONTENT_TYPE,
             'X-Amz-Date': x_amz_date,
-            'Authorization': authorization_header
+            'Authorization': self._auth_header.format(credential_scope=credential_scope, signature=signature),
         }
 
     async def aws_send(self, *, e_from: str, email_msg: EmailMessage, to: List[str]):
-        data = {
-            'Action': 'SendRawEmail',
-            'Source': e_from,
-            'RawMessage.Data': base64.b64encode(email_msg.as_string().encode())
-        }
-        data.update({f'Destination.ToAddresses.member.{i + 1}': t.encode() for i, t in enumerate(to)})
-        # data.update({f'Destination.BccAddresses.member.{i + 1}': t.encode() for i, t in enumerate(bcc)})
-        data = urlencode(data).encode()
-
-        headers = self._aws_headers(data)
-        async with self.client.post(self._endpoint, data=data, headers=headers, timeout=5) as r:
-            text = await r.text()
-        if r.status != 200:
-            raise RequestError(r.status, self._endpoint, info=text)
+        data = ses_send_data(e_from, email_msg, to)
+
+        if not self._ses_limiter:
+            self._ses_limiter = SesRateLimiter(await self.get_redis(), max_rate=self.settings.aws_ses_max_send_rate)
+
+        for attempt in range(self.settings.aws_ses_retries + 1):
+            await self._ses_limiter.acquire()
+            headers = self._aws_headers(data)
+            async with self.client.post(self._endpoint, data=data, headers=headers,
+                                        timeout=self.settings.aws_ses_timeout) as r:
+                text = await r.text()
+            if r.status == 200:
+                break
+            elif r.status == 400 and '<Code>Throttling</Code>' in text and attempt < self.settings.aws_ses_retries:
+                await self._ses_limiter.throttled()
+                await asyncio.sleep(2 ** attempt * random.uniform(0.5, 1.5))
+            else:
+                raise RequestError(r.status, self._endpoint, info=text)
         msg_id = re.search('<MessageId>(.+?)</MessageId>', text).groups()[0]
         return msg_id + f'@{self.settings.aws_region}.amazonses.com'
 
@@ -176,12 +285,17 @@ class BaseEmailActor(Actor):
                          *,
                          user: Dict[str, Any],
                          user_ctx: Dict[str, Any],
-                         subject: str,
+                         email: CompiledEmail,
                          title: str,
-                         body: str,
-                         template: str,
                          e_from: str,
-                         global_ctx: Dict[str, Any]):
+                         global_ctx: Dict[str, Any],
+                         rendered: RenderedEmail = None):
+        """
+        Render and send an email to one user.
+
+        :param rendered: email already rendered by render_shared_email for everyone with the same user_ctx,
+          only the user's fields are filled in here
+        """
         base_url = global_ctx['base_url']
 
         full_name = '{first_name} {last_name}'.format(**user).strip(' ')
@@ -191,98 +305,208 @@ class BaseEmailActor(Actor):
             full_name=full_name or user['email'],
             unsubscribe_link=f'/api/unsubscribe/{user["id"]}/?sig={unsubscribe_sig(user["id"], self.settings)}',
         )
-        ctx = clean_ctx({**global_ctx, **extra_ctx, **user_ctx}, base_url)
-        markup_data = ctx.pop('markup_data', None)
-
-        e_msg = EmailMessage(policy=SMTP)
-        subject = chevron.render(subject, data=ctx)
-        e_msg['Subject'] = subject
-        e_msg['From'] = e_from
-        e_msg['To'] = f'{full_name} <{user_email}>' if full_name else user_email
-        e_msg['List-Unsubscribe'] = '<{unsubscribe_link}>'.format(**ctx)
-
-        if DEBUG_PRINT_REGEX.search(body):
-            ctx['__print_debug_context__'] = json.dumps(ctx, indent=2)
-
-        body = apply_macros(body)
-        raw_body = chevron.render(body, data=ctx)
-        e_msg.set_content(raw_body, cte='quoted-printable')
-
-        ctx.update(
-            styles=STYLES,
-            main_message=safe_markdown(raw_body),
-            message_preview=shorten(strip_markdown(raw_body), 60, placeholder='…'),
+        if rendered:
+            subject, raw_body, html_body = personalise_email(rendered, extra_ctx)
+            unsubscribe_link = base_url + extra_ctx['unsubscribe_link']
+        else:
+            ctx = clean_ctx({**global_ctx, **extra_ctx, **user_ctx}, base_url)
+            unsubscribe_link = ctx['unsubscribe_link']
+            subject, raw_body, html_body = render_email(email, title, ctx)
+
+        e_msg = email_message(
+            subject=subject,
+            e_from=e_from,
+            to=f'{full_name} <{user_email}>' if full_name else user_email,
+            unsubscribe_link=unsubscribe_link,
+            raw_body=raw_body,
+            html_body=html_body,
         )
-        if markup_data:
-            ctx['markup_data'] = json.dumps(markup_data, separators=(',', ':'))
-        html_body = chevron.render(template, data=ctx, partials_dict={'title': title})
-        e_msg.add_alternative(html_body, subtype='html', cte='quoted-printable')
 
         send_method = self.aws_send if self.send_via_aws else self.print_email
         msg_id = await send_method(e_from=e_from, to=[user_email], email_msg=e_msg)
 
         logger.debug('email sent "%s" to "%s", id %0.12s...', subject, user_email, msg_id)
+        return msg_id
 
     @concurrent
-    async def send_emails(self, company_id: int, trigger: str, users_emails: List[UserEmail]):
+    async def send_emails(self, company_id: int, trigger: str, users_emails: List[UserEmail], *,
+                          dedupe_key: str = None):
+        """
+        Add emails to the outbox and send them. If dedupe_key is given an email is only added once for each
+        trigger, user and dedupe_key, otherwise emails are always sent.
+        """
         trigger = Triggers(trigger)
+        async with self.pg.acquire() as conn:
+            await conn.executemany(
+                OUTBOX_ADD_SQL,
+                [(company_id, trigger.value, user_id, dedupe_key, outbox_ctx(ctx)) for user_id, ctx in users_emails]
+            )
+        return await self.send_outbox(company_id, trigger)
 
+    async def send_outbox(self, company_id: int, trigger: Triggers) -> int:
+        """
+        Claim pending emails from the outbox in batches and send them. Claimed rows can't be claimed by another
+        worker until they're updated with the result or email_outbox_lease expires.
+        """
+        async with self.pg.acquire() as conn:
+            config = await self._email_config(conn, company_id, trigger)
+            if not config:
+                await conn.execute(OUTBOX_SKIP_SQL, company_id, trigger.value)
+                return 0
+
+        counts = {'sent': 0, 'skipped': 0, 'pending': 0, 'dead': 0}
+        while True:
+            async with self.pg.acquire() as conn:
+                rows = await conn.fetch(OUTBOX_CLAIM_SQL, company_id, trigger.value,
+                                        self.settings.email_send_chunk_size, self.settings.email_outbox_lease)
+                if not rows:
+                    break
+                user_data = await conn.fetch(EMAIL_USERS_SQL, company_id, [r['user_id'] for r in rows])
+
+            results = await self._send_claimed(config, trigger, rows, {u['id']: u for u in user_data})
+            async with self.pg.acquire() as conn:
+                await conn.executemany(OUTBOX_RESULT_SQL, results)
+            for r in results:
+                counts[r[1]] += 1
+
+        log = logger.warning if counts['pending'] or counts['dead'] else logger.info
+        log('emails for trigger %s, company %s (%d): %d sent, %d skipped, %d to retry, %d failed',
+            trigger, config.global_ctx['base_url'], company_id,
+            counts['sent'], counts['skipped'], counts['pending'], counts['dead'])
+        return counts['sent']
+
+    @concurrent(Actor.LOW_QUEUE)
+    async def drain_outbox(self, company_id: int, trigger: str) -> int:
+        """
+        Job wrapping send_outbox, several can be enqueued at once to share a large send between workers.
+        """
+        return await self.send_outbox(company_id, Triggers(trigger))
+
+    async def outbox_progress(self, company_id: int, trigger: Triggers, dedupe_key: str) -> Dict[str, int]:
+        """
+        :return: number of emails in the outbox for the given dedupe_key by status
+        """
+        async with self.pg.acquire() as conn:
+            rows = await conn.fetch(OUTBOX_PROGRESS_SQL, company_id, Triggers(trigger).value, dedupe_key)
+        return dict(rows)
+
+    async def _email_config(self, conn, company_id: int, trigger: Triggers) -> Optional[EmailConfig]:
+        """
+        Email configuration is cached for email_config_cache_ttl seconds, entries for a company are removed when
+        its config changes via _email_config_changed.
+        """
+        key = company_id, trigger
+        expires, config = self._config_cache.get(key, (0, None))
+        if expires > monotonic():
+            return config
+        config = await self._get_email_config(conn, company_id, trigger)
+        if self.settings.email_config_cache_ttl:
+            self._config_cache[key] = monotonic() + self.settings.email_config_cache_ttl, config
+        return config
+
+    async def _get_email_config(self, conn, company_id: int, trigger: Triggers) -> Optional[EmailConfig]:
         dft = EMAIL_DEFAULTS[trigger]
         subject, title, body = dft['subject'], dft['title'], dft['body']
 
+        company_name, e_from, template, company_logo, company_domain = await conn.fetchrow(
+            'SELECT name, email_from, email_template, logo, domain FROM companies WHERE id=$1', company_id
+        )
+        r = await conn.fetchrow(
+            """
+            SELECT active, subject, title, body
+            FROM email_definitions
+            WHERE company=$1 AND trigger=$2
+            """,
+            company_id, trigger.value
+        )
+        if r:
+            if not r['active']:
+                logger.info('not sending email %s (%d), email definition inactive', trigger.value, company_id)
+                return
+            subject = r['subject'] or subject
+            title = r['title'] or title
+            body = r['body'] or body
+
+        return EmailConfig(
+            email=compile_email(subject, body, template or DEFAULT_EMAIL_TEMPLATE),
+            title=title,
+            e_from=e_from or self.settings.default_email_address,
+            global_ctx=dict(
+                company_name=company_name,
+                company_logo=company_logo,
+                base_url=f'https://{company_domain}',
+            ),
+        )
+
+    async def _send_claimed(self, config: EmailConfig, trigger: Triggers, rows, users) -> List[tuple]:
+        """
+        Send emails claimed from the outbox with at most email_send_concurrency requests at once.
+
+        :return: list of (id, status, message_id, error, retry delay) tuples to update the outbox with
+        """
+        semaphore = asyncio.Semaphore(self.settings.email_send_concurrency)
+        # emails with the same context, eg. ticket_other emails or broadcasts, are only rendered once
+        shared = {}
+        if not config.email.debug_context and not config.email.user_sections:
+            ctx_counts = Counter(row['ctx'] for row in rows if row['user_id'] in users)
+            shared = {ctx: render_shared_email(config, json.loads(ctx)) for ctx, c in ctx_counts.items() if c > 1}
+
+        async def send(row):
+            user = users.get(row['user_id'])
+            if not user:
+                # user has been suspended, unsubscribed or has no email address
+                return row['id'], 'skipped', None, None, 0
+            async with semaphore:
+                try:
+                    msg_id = await self.send_email(
+                        user=user,
+                        user_ctx=json.loads(row['ctx']),
+                        email=config.email,
+                        title=config.title,
+                        e_from=config.e_from,
+                        global_ctx=config.global_ctx,
+                        rendered=shared.get(row['ctx']),
+                    )
+                except Exception as e:
+                    return self._send_failed(trigger, row, e)
+            return row['id'], 'sent', msg_id, None, 0
+
+        return await asyncio.gather(*[send(row) for row in rows])
+
+    def _send_failed(self, trigger: Triggers, row, exc: Exception) -> tuple:
+        error = f'{exc.__class__.__name__}: {exc}'
+        # client errors from SES (other than throttling which is handled in aws_send) won't succeed on retry
+        permanent = isinstance(exc, RequestError) and 400 <= exc.status < 500
+        if permanent or row['attempts'] >= self.settings.email_max_attempts:
+            logger.error('email %d %s to user %d failed permanently after %d attempts', row['id'], trigger.value,
+                         row['user_id'], row['attempts'], exc_info=exc)
+            return row['id'], 'dead', None, error, 0
+        else:
+            delay = self.settings.email_retry_delay * 2 ** (row['attempts'] - 1)
+            logger.warning('email %d %s to user %d failed, retrying in %ds: %s', row['id'], trigger.value,
+                           row['user_id'], delay, error)
+            return row['id'], 'pending', None, error, delay
+
+    @cron(second=30)
+    async def retry_outbox(self):
+        """
+        Send emails in the outbox which are due to be retried or whose claim has expired.
+        """
         async with self.pg.acquire() as conn:
-            company_name, e_from, template, company_logo, company_domain = await conn.fetchrow(
-                'SELECT name, email_from, email_template, logo, domain FROM companies WHERE id=$1', company_id
-            )
-            e_from = e_from or self.settings.default_email_address
-            template = template or DEFAULT_EMAIL_TEMPLATE
-
-            r = await conn.fetchrow(
-                """
-                SELECT active, subject, title, body
-                FROM email_definitions
-                WHERE company=$1 AND trigger=$2
-                """,
-                company_id, trigger.value
-            )
-            if r:
-                if not r['active']:
-                    logger.info('not sending email %s (%d), email definition inactive', trigger.value, company_id)
-                    return
-                subject = r['subject'] or subject
-                title = r['title'] or title
-                body = r['body'] or body
-
-            user_data = await conn.fetch(
-                """
-                SELECT id, first_name, last_name, email
-                FROM users
-                WHERE company=$1 AND status!='suspended' AND receive_emails=TRUE AND email IS NOT NULL AND id=ANY($2)
-                """,
-                company_id, [u[0] for u in users_emails]
+            due = await conn.fetch(
+                "SELECT DISTINCT company, trigger FROM email_outbox WHERE status='pending' AND send_after <= now()"
             )
+        for company_id, trigger in due:
+            await self.send_outbox(company_id, Triggers(trigger))
+        return len(due)
 
-        global_ctx = dict(
-            company_name=company_name,
-            company_logo=company_logo,
-            base_url=f'https://{company_domain}',
-        )
-        user_ctx_lookup = {u[0]: u[1] for u in users_emails}
-        await asyncio.gather(*[
-            self.send_email(
-                user=u_data,
-                user_ctx=dict(user_ctx_lookup[u_data['id']]),
-                subject=subject,
-                title=title,
-                body=body,
-                template=template,
-                e_from=e_from,
-                global_ctx=global_ctx,
+    @cron(hour=3, minute=30)
+    async def prune_outbox(self):
+        async with self.pg.acquire() as conn:
+            return await conn.execute(
+                "DELETE FROM email_outbox WHERE status!='pending' AND created_ts < now() - $1::int * interval '1 day'",
+                self.settings.email_outbox_retention_days,
             )
-            for u_data in user_data
-        ])
-        logger.info('%d emails sent for trigger %s, company %s (%d)',
-                    len(user_data), trigger, company_domain, company_id)
 
 
 strip_markdown_re = [
@@ -302,6 +526,80 @@ def strip_markdown(s):
     return s
 
 
+def email_message(*, subject: str, e_from: str, to: str, unsubscribe_link: str, raw_body: str,
+                  html_body: str) -> EmailMessage:
+    e_msg = EmailMessage(policy=SMTP)
+    e_msg['Subject'] = subject
+    e_msg['From'] = e_from
+    e_msg['To'] = to
+    e_msg['List-Unsubscribe'] = f'<{unsubscribe_link}>'
+    e_msg.set_content(raw_body, cte='quoted-printable')
+    e_msg.add_alternative(html_body, subtype='html', cte='quoted-printable')
+    return e_msg
+
+
+def ses_send_data(e_from: str, email_msg: EmailMessage, to: List[str]) -> bytes:
+    """
+    Body of an SES SendRawEmail request.
+    """
+    data = {
+        'Action': 'SendRawEmail',
+        'Source': e_from,
+        'RawMessage.Data': base64.b64encode(email_msg.as_string().encode())
+    }
+    data.update({f'Destination.ToAddresses.member.{i + 1}': t.encode() for i, t in enumerate(to)})
+    # data.update({f'Destination.BccAddresses.member.{i + 1}': t.encode() for i, t in enumerate(bcc)})
+    return urlencode(data).encode()
+
+
+def render_email(email: CompiledEmail, title: str, ctx: Dict[str, Any], message_preview: str = None) -> RenderedEmail:
+    markup_data = ctx.pop('markup_data', None)
+    subject = chevron.render(email.subject, data=ctx)
+
+    if email.debug_context:
+        ctx['__print_debug_context__'] = json.dumps(ctx, indent=2)
+
+    raw_body = chevron.render(email.body, data=ctx)
+    ctx.update(
+        styles=STYLES,
+        main_message=safe_markdown(raw_body),
+        message_preview=message_preview or email_preview(raw_body),
+    )
+    if markup_data:
+        ctx['markup_data'] = json.dumps(markup_data, separators=(',', ':'))
+    html_body = chevron.render(email.template, data=ctx, partials_dict={'title': title})
+    return RenderedEmail(subject, raw_body, html_body)
+
+
+def render_shared_email(config: EmailConfig, user_ctx: Dict[str, Any]) -> RenderedEmail:
+    """
+    Render an email once for all users with the same user_ctx, USER_FIELDS and the message preview are replaced
+    with placeholders which are filled in by personalise_email.
+    """
+    base_url = config.global_ctx['base_url']
+    placeholders = {**_USER_PLACEHOLDERS, 'unsubscribe_link': '/' + _USER_PLACEHOLDERS['unsubscribe_link']}
+    ctx = clean_ctx({**config.global_ctx, **placeholders, **user_ctx}, base_url)
+    return render_email(config.email, config.title, ctx, message_preview=_PREVIEW_PLACEHOLDER)
+
+
+def personalise_email(rendered: RenderedEmail, user_fields: Dict[str, str]) -> RenderedEmail:
+    values = {str(i): user_fields[f] for i, f in enumerate(USER_FIELDS, start=1)}
+    # the unsubscribe link placeholder follows the "/" added by render_shared_email to satisfy clean_ctx
+    values[str(USER_FIELDS.index('unsubscribe_link') + 1)] = user_fields['unsubscribe_link'][1:]
+
+    text = _PLACEHOLDER_REGEX.sub(lambda m: values[m.group(1)], rendered.text)
+    values['0'] = email_preview(text)
+    return RenderedEmail(
+        subject=_PLACEHOLDER_REGEX.sub(lambda m: values[m.group(1)], rendered.subject),
+        text=text,
+        html=_PLACEHOLDER_REGEX.sub(lambda m: html.escape(values[m.group(1)]), rendered.html),
+    )
+
+
+def email_preview(raw_body):
+    return shorten(strip_markdown(raw_body), 60, placeholder='…')
+
+
 def clean_ctx(context, base_url):
     context = context or {}
     if not isinstance(context, dict):
@@ -322,6 +620,23 @@ def clean_ctx(context, base_url):
     return context
 
 
+def _ctx_json_default(v):
+    # formatted as clean_ctx would format them
+    if isinstance(v, datetime.datetime):
+        return v.strftime(datetime_fmt)
+    elif isinstance(v, datetime.timedelta):
+        return format_duration(v)
+    else:
+        return str(v)
+
+
+def outbox_ctx(ctx) -> str:
+    """
+    :return: JSON context to save in the outbox, keys are sorted so identical contexts serialise identically
+    """
+    return json.dumps(ctx or {}, sort_keys=True, default=_ctx_json_default)
+
+
 markdown_macros = [
     {
         'name': 'centered_button',
@@ -335,8 +650,11 @@ markdown_macros = [
 ]
 
 
+macro_regexes = [(re.compile(r'{{ ?%s\((.*?)\) ?}}' % macro['name']), macro) for macro in markdown_macros]
+
+
 def apply_macros(s):
-    for macro in markdown_macros:
+    for regex, macro in macro_regexes:
         def replace_macro(m):
             arg_values = [a.strip(' ') for a in m.group(1).split('|') if a.strip(' ')]
             if len(macro['args']) != len(arg_values):
@@ -344,5 +662,22 @@ def apply_macros(s):
             else:
                 return chevron.render(macro['body'], data=dict(zip(macro['args'], arg_values)))
 
-        s = re.sub(r'{{ ?%s\((.*?)\) ?}}' % macro['name'], replace_macro, s)
+        s = regex.sub(replace_macro, s)
     return s
+
+
+@lru_cache(maxsize=256)
+def compile_email(subject: str, body: str, template: str) -> CompiledEmail:
+    """
+    Apply macros and tokenize templates once rather than for every recipient, chevron.render accepts the list
+    of tokens in place of a template. Cached on the templates themselves so changes to email_definitions or
+    companies.email_template take effect immediately.
+    """
+    tokens = list(tokenize(subject)), list(tokenize(apply_macros(body))), list(tokenize(template))
+    return CompiledEmail(
+        *tokens,
+        debug_context=bool(DEBUG_PRINT_REGEX.search(body)),
+        user_sections=any(
+            tag in {'section', 'inverted section'} and key in _SECTION_USER_FIELDS for t in tokens for tag, key in t
+        ),
+    )
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from time import time
+
+logger = logging.getLogger('nosht.email.ratelimit')
+
+# Token bucket kept in a redis hash so every worker process shares one SES send budget. The rate starts at
+# max_rate, is halved when SES throttles us and recovers linearly towards max_rate. A token is always
+# taken, the script returns how long the caller must wait before sending.
+# Numbers are returned as strings since redis truncates lua numbers to integers.
+ACQUIRE_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local recovery = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local rate = tonumber(b[3]) or max_rate
+local tokens = tonumber(b[1]) or rate
+local elapsed = math.max(0, now - (tonumber(b[2]) or now))
+rate = math.min(max_rate, rate + elapsed * recovery * max_rate)
+tokens = math.min(rate, tokens + elapsed * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 60)
+if tokens >= 0 then
+  return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+THROTTLED_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local min_rate = tonumber(ARGV[2])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'rate')
+local rate = math.max(min_rate, (tonumber(b[2]) or max_rate) / 2)
+local tokens = math.min(0, tonumber(b[1]) or 0)
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 60)
+return tostring(rate)
+"""
+
+
+class SesRateLimiter:
+    """
+    Limits the rate of SES requests across all worker processes, see ACQUIRE_SCRIPT.
+    """
+    key = 'ses-send-rate'
+
+    def __init__(self, redis, *, max_rate: float, min_rate: float = 1, recovery: float = 0.1):
+        self.redis = redis
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+
+    async def acquire(self):
+        wait = float(await self.redis.eval(ACQUIRE_SCRIPT, keys=[self.key],
+                                           args=[self.max_rate, self.recovery, time()]))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def throttled(self):
+        rate = float(await self.redis.eval(THROTTLED_SCRIPT, keys=[self.key], args=[self.max_rate, self.min_rate]))
+        logger.warning('SES throttling, send rate reduced to %0.1f/s', rate)
@@ -0,0 +1,109 @@
+import gzip
+import logging
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from arq import Actor, cron
+from buildpg import asyncpg
+
+from .db import ActionTypes
+from .images import create_s3_session
+from .settings import Settings
+
+logger = logging.getLogger('nosht.maintenance')
+
+# tickets reference these actions so they're never archived
+KEPT_ACTIONS = [ActionTypes.reserve_tickets.value, ActionTypes.buy_tickets.value]
+
+ARCHIVE_ACTIONS_SQL = """
+DELETE FROM actions WHERE id IN (
+  SELECT id FROM actions
+  WHERE ts < date_trunc('month', now() - $1::int * interval '1 day') AND type != ALL($2::action_types[])
+  ORDER BY ts
+  LIMIT $3
+)
+RETURNING id, ts, json_build_object(
+  'id', id, 'company', company, 'user_id', user_id, 'ts', ts, 'type', type, 'extra', action_extra(extra)
+)::text
+"""
+
+
+def write_archive(archive_dir: Path, months: Dict[str, List[str]]):
+    for month, rows in months.items():
+        # appending to a gzip file adds a new member, the file still reads as one stream
+        with gzip.open(archive_dir / f'actions-{month}.jsonl.gz', 'at') as f:
+            f.writelines(row + '\n' for row in rows)
+
+
+def gzip_rows(rows: List[str]) -> bytes:
+    return gzip.compress(''.join(row + '\n' for row in rows).encode())
+
+
+class MaintenanceActor(Actor):
+    def __init__(self, *, settings: Settings, pg=None, **kwargs):
+        self.redis_settings = settings.redis_settings
+        super().__init__(**kwargs)
+        self.settings = settings
+        self.pg = pg
+
+    async def startup(self):
+        self.pg = self.pg or await asyncpg.create_pool_b(dsn=self.settings.pg_dsn, min_size=1)
+
+    async def shutdown(self):
+        await self.pg.close()
+
+    @cron(hour=4, minute=15)
+    async def archive_actions(self, batch_size=5000):
+        """
+        Move actions older than actions_retention_days to gzipped JSON lines files, one object per month and batch
+        in actions_archive_bucket or one file per month in actions_archive_dir. Each batch is deleted in a
+        transaction which is only committed once it's saved.
+
+        Nothing is deleted without somewhere durable to save actions, local files don't survive a restart on
+        heroku so actions_archive_dir is only used elsewhere.
+        """
+        if self.settings.actions_archive_bucket:
+            async with create_s3_session(self.settings) as s3:
+                count = await self._archive_actions(partial(self._upload_archive, s3), batch_size)
+            target = f's3://{self.settings.actions_archive_bucket}'
+        elif self.settings.actions_archive_dir and not self.settings.on_heroku:
+            target = Path(self.settings.actions_archive_dir)
+            target.mkdir(parents=True, exist_ok=True)
+            count = await self._archive_actions(partial(self._write_archive, target), batch_size)
+        else:
+            logger.warning('actions_archive_bucket not set, actions not archived')
+            return 0
+        logger.info('%d actions archived to %s', count, target)
+        return count
+
+    async def _archive_actions(self, save, batch_size):
+        count = 0
+        async with self.pg.acquire() as conn:
+            while True:
+                async with conn.transaction():
+                    rows = await conn.fetch(ARCHIVE_ACTIONS_SQL, self.settings.actions_retention_days,
+                                            KEPT_ACTIONS, batch_size)
+                    if not rows:
+                        break
+                    # month -> (first action id, rows), the id keeps object names unique between batches
+                    months = {}
+                    for id, ts, row_json in rows:
+                        months.setdefault(f'{ts:%Y-%m}', (id, []))[1].append(row_json)
+                    await save(months)
+                count += len(rows)
+        return count
+
+    async def _upload_archive(self, s3, months: Dict[str, Tuple[int, List[str]]]):
+        for month, (first_id, rows) in months.items():
+            data = await self.loop.run_in_executor(None, gzip_rows, rows)
+            await s3.put_object(
+                Bucket=self.settings.actions_archive_bucket,
+                Key=f'actions/{month}/actions-{month}-{first_id}.jsonl.gz',
+                Body=data,
+                ContentType='application/gzip',
+            )
+
+    async def _write_archive(self, archive_dir: Path, months: Dict[str, Tuple[int, List[str]]]):
+        rows = {month: month_rows for month, (_, month_rows) in months.items()}
+        await self.loop.run_in_executor(None, write_archive, archive_dir, rows)
@@ -37,6 +37,30 @@ class Settings(BaseSettings):
     aws_ses_host = 'email.{region}.amazonaws.com'
     aws_ses_endpoint = 'https://{host}/'
     print_emails = False
+    # SES send rate shared by all workers, reduced automatically when SES throttles
+    aws_ses_max_send_rate = 14
+    aws_ses_retries = 3
+    aws_ses_timeout = 5
+    # maximum number of emails sent at once, and recipients loaded from the db at once, per send_emails job
+    email_send_concurrency = 20
+    email_send_chunk_size = 500
+    # maximum number of drain_outbox jobs started to send one broadcast, eg. an event update
+    email_broadcast_jobs = 4
+    # failed emails are retried with exponential backoff starting at email_retry_delay seconds
+    email_max_attempts = 5
+    email_retry_delay = 60
+    # seconds before emails claimed by a worker which hasn't recorded the result can be claimed again
+    email_outbox_lease = 300
+    email_outbox_retention_days = 30
+    # seconds company email config is cached by workers, changes are also pushed to workers via postgres NOTIFY
+    email_config_cache_ttl = 300
+    # hours before an event starts that reminders are sent
+    event_reminder_window = 24
+    # jobs run at once by each worker, the dft and low queues are limited further so transactional jobs
+    # in the high queue always have room to run
+    worker_max_jobs = 50
+    worker_dft_queue_jobs = 30
+    worker_low_queue_jobs = 10
 
     google_siw_client_key = '315422204069-no6540693ciica79g07rs43v705d348g.apps.googleusercontent.com'
     google_siw_url = _GOOGLE_OAUTH2_CERTS_URL
@@ -52,10 +76,36 @@ class Settings(BaseSettings):
 
     stripe_root = 'https://api.stripe.com/v1/'
     stripe_idempotency_extra = ''
+    stripe_timeout = 5
+    stripe_connection_limit = 100
+    stripe_keepalive_timeout = 60
+    # retries for requests which are safe to repeat, the delay doubles with each retry
+    stripe_retries = 2
+    stripe_retry_delay = 0.2
+    # consecutive failures before requests to a stripe account fail fast, and for how many seconds
+    stripe_circuit_threshold = 5
+    stripe_circuit_reset = 30
+    # requests slower than this many seconds are logged as warnings
+    stripe_slow_request = 2
+    # take payments in the worker, the client polls for the result rather than waiting on the request
+    stripe_async_payments = False
 
     default_email_address: str = 'Nosht <nosht@scolvin.com>'
 
     ticket_ttl = 300
+    # payments left in "charging" for longer than this are resolved by StripeActor.recover_charges
+    charge_recovery_delay = 300
+    # audit only actions are saved in batches of up to this size or every actions_flush_interval seconds,
+    # 0 saves every action straight away
+    actions_buffer_size = 100
+    actions_flush_interval = 2
+    # most actions kept in the buffer while they can't be saved, the oldest are dropped beyond this
+    actions_buffer_limit = 10_000
+    # actions older than this (rounded down to the start of a month) are moved to gzipped files in the
+    # actions_archive_bucket S3 bucket, or actions_archive_dir when not on heroku, see MaintenanceActor.archive_actions
+    actions_retention_days = 400
+    actions_archive_bucket: str = None
+    actions_archive_dir: str = None
 
     @validator('on_heroku', always=True)
     def set_on_heroku(cls, v):
@@ -1,6 +1,8 @@
+-- active_ts is only accurate to 5 minutes, updating it less often avoids rewriting (and locking) the user row
+-- for every action, eg. several times while booking tickets
 CREATE OR REPLACE FUNCTION update_user_ts() RETURNS trigger AS $$
   BEGIN
-    UPDATE users SET active_ts=now() WHERE id=NEW.user_id;
+    UPDATE users SET active_ts=now() WHERE id=NEW.user_id AND active_ts < now() - interval '5 minutes';
     return NULL;
   END;
 $$ LANGUAGE plpgsql;
@@ -8,6 +10,33 @@ $$ LANGUAGE plpgsql;
 DROP TRIGGER IF EXISTS update_user_ts ON actions;
 CREATE TRIGGER update_user_ts AFTER INSERT ON actions FOR EACH ROW EXECUTE PROCEDURE update_user_ts();
 
+-- user agents are stored once in user_agents and referenced from actions.extra as "ua_id"
+CREATE OR REPLACE FUNCTION compact_action_extra(extra_ JSONB) RETURNS JSONB AS $$
+  DECLARE
+    ua_ TEXT := left(extra_->>'ua', 1023);
+    ua_id_ INT;
+  BEGIN
+    IF ua_ IS NULL THEN
+      RETURN extra_;
+    END IF;
+    SELECT id INTO ua_id_ FROM user_agents WHERE ua=ua_;
+    IF NOT FOUND THEN
+      INSERT INTO user_agents (ua) VALUES (ua_) ON CONFLICT (ua) DO NOTHING RETURNING id INTO ua_id_;
+      IF ua_id_ IS NULL THEN
+        SELECT id INTO ua_id_ FROM user_agents WHERE ua=ua_;
+      END IF;
+    END IF;
+    RETURN (extra_ - 'ua') || jsonb_build_object('ua_id', ua_id_);
+  END;
+$$ LANGUAGE plpgsql;
+
+-- reverse of compact_action_extra, use when actions are read or exported with request details
+CREATE OR REPLACE FUNCTION action_extra(extra_ JSONB) RETURNS JSONB AS $$
+  SELECT CASE WHEN extra_ ? 'ua_id' THEN
+    (extra_ - 'ua_id') || jsonb_build_object('ua', (SELECT ua FROM user_agents WHERE id=(extra_->>'ua_id')::int))
+  ELSE extra_ END
+$$ LANGUAGE sql STABLE;
+
 -- TODO can be removed once run.
 DROP TRIGGER IF EXISTS ticket_insert ON tickets;
 
@@ -29,6 +58,66 @@ CREATE OR REPLACE FUNCTION check_tickets_remaining(event_id INT, ttl INT) RETURN
 $$ LANGUAGE plpgsql;
 
 
+-- reserve tickets in a single round trip: lock the event, check capacity, upsert guest users, record the action,
+-- create the tickets and update tickets_taken. "result" is one of "ok", "not-found", "not-published" or
+-- "insufficient", capacity problems are reported there rather than via ticket_limit_check violations.
+CREATE OR REPLACE FUNCTION reserve_tickets(company_id_ INT, event_id_ INT, user_id_ INT, tickets_ JSONB,
+    action_extra_ JSONB, ttl_ INT)
+  RETURNS TABLE (result VARCHAR(15), tickets_remaining INT, action_id INT, event_price NUMERIC(7, 2),
+    event_name VARCHAR(63), user_json JSON) AS $$
+  DECLARE
+    status_ EVENT_STATUS;
+    ticket_count_ INT := jsonb_array_length(tickets_);
+  BEGIN
+    -- locking the event serialises reservations for it, so the capacity check below can't be raced
+    SELECT e.status, e.price, e.name INTO status_, event_price, event_name
+    FROM events AS e
+    JOIN categories AS c ON e.category = c.id
+    WHERE c.company=company_id_ AND e.id=event_id_
+    FOR UPDATE OF e;
+
+    IF NOT FOUND THEN
+      result := 'not-found';
+    ELSIF status_ != 'published' THEN
+      result := 'not-published';
+    ELSE
+      tickets_remaining := check_tickets_remaining(event_id_, ttl_);
+      IF tickets_remaining IS NOT NULL AND ticket_count_ > tickets_remaining THEN
+        result := 'insufficient';
+      ELSE
+        INSERT INTO users AS u (company, role, first_name, last_name, email)
+        SELECT company_id_, 'guest', t.first_name, t.last_name, t.email
+        FROM jsonb_to_recordset(tickets_) AS t(first_name VARCHAR(255), last_name VARCHAR(255), email VARCHAR(255))
+        WHERE t.first_name IS NOT NULL OR t.last_name IS NOT NULL OR t.email IS NOT NULL
+        ON CONFLICT (company, email) DO UPDATE SET
+          first_name=coalesce(u.first_name, EXCLUDED.first_name),
+          last_name=coalesce(u.last_name, EXCLUDED.last_name);
+
+        INSERT INTO actions (company, user_id, type, extra)
+        VALUES (company_id_, user_id_, 'reserve-tickets', compact_action_extra(action_extra_))
+        RETURNING id INTO action_id;
+
+        INSERT INTO tickets (event, user_id, reserve_action, extra)
+        SELECT event_id_, u.id, action_id, t.extra
+        FROM jsonb_to_recordset(tickets_) AS t(email VARCHAR(255), extra JSONB)
+        LEFT JOIN users AS u ON u.company=company_id_ AND u.email=t.email;
+
+        UPDATE events SET tickets_taken=tickets_taken + ticket_count_ WHERE id=event_id_;
+        tickets_remaining := tickets_remaining - ticket_count_;
+        result := 'ok';
+      END IF;
+    END IF;
+
+    SELECT row_to_json(t) INTO user_json FROM (
+      SELECT id, full_name(first_name, last_name, email) AS name, email, role
+      FROM users
+      WHERE id=user_id_
+    ) AS t;
+    RETURN NEXT;
+  END;
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION full_name(first_name VARCHAR(255), last_name VARCHAR(255),
     email VARCHAR(255)) RETURNS VARCHAR(255) AS $$
   DECLARE
@@ -36,3 +125,30 @@ CREATE OR REPLACE FUNCTION full_name(first_name VARCHAR(255), last_name VARCHAR(
     return coalesce(first_name || ' ' || last_name, first_name, last_name, email);
   END;
 $$ LANGUAGE plpgsql;
+
+
+-- email workers cache company email config, tell them when it changes, see BaseEmailActor._email_config
+CREATE OR REPLACE FUNCTION email_config_changed() RETURNS trigger AS $$
+  DECLARE
+    r RECORD;
+  BEGIN
+    IF TG_OP = 'DELETE' THEN
+      r := OLD;
+    ELSE
+      r := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'companies' THEN
+      PERFORM pg_notify('email_config', r.id::text);
+    ELSE
+      PERFORM pg_notify('email_config', r.company::text);
+    END IF;
+    RETURN NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS email_config_changed ON companies;
+CREATE TRIGGER email_config_changed AFTER UPDATE OF name, email_from, email_template, logo, domain ON companies
+  FOR EACH ROW EXECUTE PROCEDURE email_config_changed();
+DROP TRIGGER IF EXISTS email_config_changed ON email_definitions;
+CREATE TRIGGER email_config_changed AFTER INSERT OR UPDATE OR DELETE ON email_definitions
+  FOR EACH ROW EXECUTE PROCEDURE email_config_changed();
@@ -32,6 +32,7 @@ CREATE TABLE users (
   image VARCHAR(255),
   password_hash VARCHAR(63),
   stripe_customer_id VARCHAR(31),
+  stripe_sources JSONB,  -- cache of card references to stripe source ids for stripe_customer_id
   receive_emails BOOLEAN DEFAULT TRUE,
   created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   active_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
@@ -42,6 +43,12 @@ CREATE INDEX user_status ON users USING btree (status);
 CREATE INDEX user_company ON users USING btree (company);
 
 
+-- see compact_action_extra in logic.sql
+CREATE TABLE user_agents (
+  id SERIAL PRIMARY KEY,
+  ua VARCHAR(1023) NOT NULL UNIQUE
+);
+
 CREATE TYPE ACTION_TYPES AS ENUM (
   'login',
   'guest-signin',
@@ -62,9 +69,9 @@ CREATE TABLE actions (
   ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   type ACTION_TYPES NOT NULL,
   extra JSONB
-);
-CREATE INDEX action_compound ON actions USING btree (company, user_id);
-CREATE INDEX action_type ON actions USING btree (type);
+) WITH (autovacuum_vacuum_scale_factor=0.02, autovacuum_analyze_scale_factor=0.01);
+-- old actions are archived and deleted daily, see shared/maintenance.py
+CREATE INDEX action_user_type ON actions USING btree (user_id, type);
 CREATE INDEX action_ts ON actions USING btree (ts);
 
 
@@ -87,7 +94,6 @@ CREATE TABLE categories (
 CREATE UNIQUE INDEX category_co_slug ON categories USING btree (company, slug);
 CREATE INDEX category_company ON categories USING btree (company);
 CREATE INDEX category_slug ON categories USING btree (slug);
-CREATE INDEX category_live ON categories USING btree (live);
 CREATE INDEX category_sort_index ON categories USING btree (sort_index);
 
 
@@ -114,18 +120,22 @@ CREATE TABLE events (
   ticket_limit INT CONSTRAINT ticket_limit_gt_0 CHECK (ticket_limit > 0),
   tickets_taken INT NOT NULL DEFAULT 0,  -- sold and reserved
   image VARCHAR(255),
+  reminded BOOLEAN NOT NULL DEFAULT FALSE,  -- event_reminder emails have been sent
   CONSTRAINT ticket_limit_check CHECK (tickets_taken <= ticket_limit)
 );
 CREATE UNIQUE INDEX event_cat_slug ON events USING btree (category, slug);
 CREATE INDEX event_slug ON events USING btree (slug);
-CREATE INDEX event_status ON events USING btree (status);
-CREATE INDEX event_public ON events USING btree (public);
-CREATE INDEX event_highlight ON events USING btree (highlight);
 CREATE INDEX event_start_ts ON events USING btree (start_ts);
+-- upcoming events in a category and highlighted events, see CATEGORY_PUBLIC_SQL and company_sql
+CREATE INDEX event_listed ON events USING btree (category, start_ts) WHERE status='published' AND public=TRUE;
+CREATE INDEX event_highlighted ON events USING btree (category, start_ts)
+  WHERE status='published' AND public=TRUE AND highlight IS TRUE;
+CREATE INDEX event_reminder_due ON events USING btree (start_ts) WHERE status='published' AND reminded=FALSE;
 CREATE INDEX event_category ON events USING btree (category);
 
 
-CREATE TYPE TICKET_STATUS AS ENUM ('reserved', 'paid', 'cancelled');
+-- "charging" tickets have a stripe charge in progress, see shared/stripe.py
+CREATE TYPE TICKET_STATUS AS ENUM ('reserved', 'charging', 'paid', 'cancelled');
 CREATE TABLE tickets (
   id SERIAL PRIMARY KEY,
   event INT NOT NULL REFERENCES events ON DELETE CASCADE,
@@ -136,6 +146,10 @@ CREATE TABLE tickets (
   created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   extra JSONB
 );
+CREATE INDEX ticket_event_status ON tickets USING btree (event, status);
+CREATE INDEX ticket_reserve_action ON tickets USING btree (reserve_action);
+CREATE INDEX ticket_paid_action ON tickets USING btree (paid_action);
+CREATE INDEX ticket_charging ON tickets USING btree (paid_action) WHERE status='charging';
 
 -- must match triggers from emails/defaults.py!
 CREATE TYPE EMAIL_TRIGGERS AS ENUM (
@@ -154,4 +168,25 @@ CREATE TABLE email_definitions (
 );
 CREATE UNIQUE INDEX email_def_unique ON email_definitions USING btree (company, trigger);
 
+-- emails are added to the outbox by send_emails then claimed and sent by workers, see emails/plumbing.py
+CREATE TYPE EMAIL_OUTBOX_STATUS AS ENUM ('pending', 'sent', 'skipped', 'dead');
+CREATE TABLE email_outbox (
+  id SERIAL PRIMARY KEY,
+  company INT NOT NULL REFERENCES companies ON DELETE CASCADE,
+  trigger EMAIL_TRIGGERS NOT NULL,
+  user_id INT NOT NULL REFERENCES users ON DELETE CASCADE,
+  -- null for emails which are never deduplicated
+  dedupe_key VARCHAR(63),
+  ctx JSONB,
+  status EMAIL_OUTBOX_STATUS NOT NULL DEFAULT 'pending',
+  attempts SMALLINT NOT NULL DEFAULT 0,
+  send_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  message_id VARCHAR(255),
+  error TEXT,
+  created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX email_outbox_dedupe ON email_outbox USING btree (company, trigger, user_id, dedupe_key);
+CREATE INDEX email_outbox_pending ON email_outbox USING btree (company, trigger, send_after) WHERE status='pending';
+CREATE INDEX email_outbox_created ON email_outbox USING btree (created_ts);
+
 -- TODO email events
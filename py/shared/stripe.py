@@ -0,0 +1,563 @@
+import asyncio
+import json
+import logging
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+from enum import Enum
+from functools import partial
+from time import time
+from typing import NamedTuple, Optional
+
+from aiohttp import BasicAuth, ClientError, ClientSession, ClientTimeout, TCPConnector
+from arq import Actor, concurrent, cron
+from buildpg import Values, asyncpg
+from buildpg.asyncpg import BuildPgConnection
+from pydantic import BaseModel
+
+from .db import ActionTypes
+from .emails import EmailActor
+from .settings import Settings
+from .utils import RequestError
+
+logger = logging.getLogger('nosht.stripe')
+
+# stripe forgets idempotency keys after 24 hours, after that a charge can't be safely replayed
+IDEMPOTENCY_WINDOW = timedelta(hours=23)
+
+
+PAYMENT_STATUS_KEY = 'payment-status:{}'
+PAYMENT_STATUS_TTL = 3600
+# a successful payment's status is never replaced, eg. when a booking is submitted twice the second submission
+# mustn't reset it to "pending" or "failed"
+SET_PAYMENT_STATUS_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and cjson.decode(current)['status'] == 'success' then
+  return 0
+end
+redis.call('SETEX', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+
+class Reservation(BaseModel):
+    user_id: int
+    action_id: int
+    event_id: int
+    price_cent: int
+    ticket_count: int
+    event_name: str
+
+
+class ReservationError(RuntimeError):
+    pass
+
+
+class PaymentStatus(str, Enum):
+    pending = 'pending'
+    success = 'success'
+    failed = 'failed'
+
+
+class StripeUnavailable(RequestError):
+    """
+    Raised instead of making a request while the circuit breaker for a stripe account is open, only raised
+    before the first attempt at a request so the request has definitely not reached stripe.
+    """
+    def __init__(self, url):
+        super().__init__(503, url, info='circuit breaker open, stripe requests are failing')
+
+
+class CircuitBreaker:
+    """
+    Opens after "threshold" consecutive failures, after "reset" seconds requests are allowed again and
+    one more failure reopens it.
+    """
+    def __init__(self, threshold: int, reset: float):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+
+    def allow(self) -> bool:
+        if self.opened is None:
+            return True
+        elif time() - self.opened > self.reset:
+            self.opened = None
+            self.failures = self.threshold - 1
+            return True
+        else:
+            return False
+
+    def record(self, success: bool):
+        if success:
+            self.failures = 0
+        else:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time()
+
+
+class StripeClient:
+    """
+    Client for stripe's API: connections are pooled and kept alive, requests which are safe to repeat (GETs
+    and requests with an idempotency key) are retried with jittered backoff on network errors, 429 and 5xx
+    and there's a circuit breaker per stripe account so requests fail fast when stripe is degraded.
+    """
+    def __init__(self, settings: Settings, *, loop=None):
+        self.settings = settings
+        self.session = ClientSession(
+            timeout=ClientTimeout(total=settings.stripe_timeout),
+            connector=TCPConnector(
+                limit=settings.stripe_connection_limit,
+                keepalive_timeout=settings.stripe_keepalive_timeout,
+                ttl_dns_cache=300,
+                loop=loop,
+            ),
+            loop=loop,
+        )
+        self._breakers = defaultdict(
+            lambda: CircuitBreaker(settings.stripe_circuit_threshold, settings.stripe_circuit_reset)
+        )
+
+    async def request(self, auth: BasicAuth, method, path, *, idempotency_key=None, **data):
+        metadata = data.pop('metadata', None)
+        if metadata:
+            data.update({f'metadata[{k}]': v for k, v in metadata.items()})
+        headers = {}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key + self.settings.stripe_idempotency_extra
+        full_path = self.settings.stripe_root + path
+
+        breaker = self._breakers[auth.login]
+        retries = self.settings.stripe_retries if (method == 'get' or idempotency_key) else 0
+        last_error = None
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                if last_error:
+                    # an earlier attempt may have reached stripe, so its error is raised rather than
+                    # StripeUnavailable which callers take to mean the request was never made
+                    raise last_error
+                raise StripeUnavailable(full_path)
+            try:
+                return await self._request(breaker, method, full_path, data=data or None, auth=auth,
+                                           headers=headers)
+            except (ClientError, asyncio.TimeoutError, RequestError) as e:
+                if attempt == retries or (isinstance(e, RequestError) and e.status < 500 and e.status != 429):
+                    raise
+                last_error = e
+                delay = self.settings.stripe_retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.info('stripe %s %s failed, retrying in %0.2fs: %s %s', method.upper(), path, delay,
+                            e.__class__.__name__, e)
+                await asyncio.sleep(delay)
+
+    async def _request(self, breaker: CircuitBreaker, method, url, **kwargs):
+        start = time()
+        status = None
+        try:
+            async with self.session.request(method, url, **kwargs) as r:
+                status = r.status
+                if status == 200:
+                    return await r.json()
+                else:
+                    # check stripe > developer > logs for more info
+                    text = await r.text()
+                    raise RequestError(status, url, info=text)
+        finally:
+            breaker.record(status is not None and status < 500)
+            duration = time() - start
+            log = logger.warning if duration > self.settings.stripe_slow_request else logger.debug
+            log('stripe %s %s %s %0.0fms', method.upper(), url, status or 'error', duration * 1000)
+
+    async def close(self):
+        await self.session.close()
+
+
+def charge_idempotency_key(reserve_action_id: int) -> str:
+    return f'charge-{reserve_action_id}'
+
+
+async def start_charge(conn: BuildPgConnection, *,
+                       company_id: int,
+                       user_id: int,
+                       reserve_action_id: int,
+                       ticket_count: int,
+                       charge_data: dict,
+                       new_customer: bool,
+                       new_card: bool,
+                       stripe_sources: dict = None) -> int:
+    """
+    First phase of a payment: record the buy action and move the reserved tickets to "charging" in one short
+    transaction, no stripe request should be made while it's open.
+
+    The paid action id is added to charge_data's metadata and charge_data is saved on the action so
+    an interrupted charge can be replayed by StripeActor.recover_charges.
+
+    stripe_sources, if provided, replaces the user's cache of card references to stripe source ids.
+    """
+    async with conn.transaction():
+        paid_action_id = await conn.fetchval_b(
+            'INSERT INTO actions (:values__names) VALUES :values RETURNING id',
+            values=Values(company=company_id, user_id=user_id, type=ActionTypes.buy_tickets.value)
+        )
+        charge_data['metadata']['paid_action'] = paid_action_id
+        await conn.execute(
+            'UPDATE actions SET extra=$1 WHERE id=$2',
+            json.dumps({'charge_data': charge_data, 'new_customer': new_customer, 'new_card': new_card}),
+            paid_action_id,
+        )
+        charging_tickets = await conn.fetchval(
+            """
+            WITH t AS (
+              UPDATE tickets SET status='charging', paid_action=$1
+              WHERE reserve_action=$2 AND status='reserved' AND paid_action IS NULL
+              RETURNING id
+            )
+            SELECT COUNT(*) FROM t
+            """,
+            paid_action_id, reserve_action_id,
+        )
+        if charging_tickets != ticket_count:
+            # the reservation has been used or expired since it was checked, this rolls back the transaction
+            raise ReservationError(f'{charging_tickets} tickets reserved, expected {ticket_count}')
+        if new_customer:
+            await conn.execute('UPDATE users SET stripe_customer_id=$1 WHERE id=$2', charge_data['customer'], user_id)
+        if stripe_sources is not None:
+            await conn.execute('UPDATE users SET stripe_sources=$1 WHERE id=$2', json.dumps(stripe_sources), user_id)
+    return paid_action_id
+
+
+async def complete_charge(conn: BuildPgConnection, *, paid_action_id: int, charge: dict, new_customer: bool,
+                          new_card: bool):
+    """
+    Final phase of a successful payment: mark the "charging" tickets as paid and record the charge.
+    """
+    async with conn.transaction():
+        await conn.execute("UPDATE tickets SET status='paid' WHERE paid_action=$1 AND status='charging'",
+                           paid_action_id)
+        await conn.execute(
+            'UPDATE actions SET extra=$1 WHERE id=$2',
+            json.dumps({
+                'new_customer': new_customer,
+                'new_card': new_card,
+                'charge_id': charge['id'],
+                'card_last4': charge['source']['last4'],
+                'card_expiry': f"{charge['source']['exp_month']}/{charge['source']['exp_year'] - 2000}",
+            }),
+            paid_action_id,
+        )
+
+
+async def cancel_charge(conn: BuildPgConnection, paid_action_id: int):
+    """
+    Final phase of a failed payment: return the tickets to "reserved" so payment can be retried or the
+    reservation left to expire, and remove the buy action.
+    """
+    async with conn.transaction():
+        await conn.execute(
+            "UPDATE tickets SET status='reserved', paid_action=NULL WHERE paid_action=$1 AND status='charging'",
+            paid_action_id,
+        )
+        await conn.execute('DELETE FROM actions WHERE id=$1', paid_action_id)
+
+
+async def pay_reservation(conn: BuildPgConnection, stripe: StripeClient, res: Reservation, *,
+                          company_id: int, stripe_token: str, stripe_card_ref: str) -> int:
+    """
+    Take payment for a reservation, the reservation must already have been validated.
+
+    :return: id of the buy-tickets action
+    """
+    user_name, user_email, user_role, stripe_customer_id, stripe_sources, stripe_secret_key, currency = (
+        await conn.fetchrow(
+            """
+            SELECT
+              first_name || ' ' || last_name AS name, email, role, stripe_customer_id, stripe_sources,
+              stripe_secret_key, currency
+            FROM users AS u
+            JOIN companies c on u.company = c.id
+            WHERE u.id=$1 AND c.id=$2
+            """,
+            res.user_id, company_id
+        )
+    )
+    reserved_tickets = await conn.fetchval(
+        """
+        SELECT COUNT(*)
+        FROM tickets
+        WHERE event=$1 AND reserve_action=$2 AND status='reserved' AND paid_action IS NULL
+        """,
+        res.event_id, res.action_id,
+    )
+    if res.ticket_count != reserved_tickets:
+        # reservation could have already been used or event id could be wrong
+        raise ReservationError(f'res ticket count {res.ticket_count}, db reserved tickets {reserved_tickets}')
+
+    auth = BasicAuth(stripe_secret_key)
+    stripe_get = partial(stripe.request, auth, 'get')
+    stripe_post = partial(stripe.request, auth, 'post')
+    cs = await _get_customer_source(
+        stripe_token, stripe_card_ref, stripe_customer_id, stripe_sources and json.loads(stripe_sources),
+        stripe_get, stripe_post,
+        email=f'{user_name} <{user_email}>' if user_name else user_email,
+        description=f'{user_name or user_email} ({user_role})',
+        metadata={
+            'role': user_role,
+            'user_id': res.user_id,
+        },
+    )
+
+    charge_data = dict(
+        amount=res.price_cent,
+        currency=currency,
+        customer=cs.customer_id,
+        source=cs.source_id,
+        description=f'{res.ticket_count} tickets for {res.event_name} ({res.event_id})',
+        metadata={
+            'event': res.event_id,
+            'tickets_bought': res.ticket_count,
+            'reserve_action': res.action_id,
+        }
+    )
+    paid_action_id = await start_charge(
+        conn,
+        company_id=company_id,
+        user_id=res.user_id,
+        reserve_action_id=res.action_id,
+        ticket_count=res.ticket_count,
+        charge_data=charge_data,
+        new_customer=cs.new_customer,
+        new_card=cs.new_card,
+        stripe_sources=cs.sources,
+    )
+
+    # no transaction is open here: tickets are "charging" so can't be used or expire while we wait for stripe,
+    # if this dies before the charge is resolved StripeActor.recover_charges will resolve it
+    try:
+        charge = await stripe_post('charges', idempotency_key=charge_idempotency_key(res.action_id), **charge_data)
+    except RequestError as e:
+        if isinstance(e, StripeUnavailable) or (e.status < 500 and e.status != 409):
+            # the charge has definitely failed or was never sent, 409 means a retry found the first attempt
+            # still in progress so the charge may yet succeed
+            await cancel_charge(conn, paid_action_id)
+            if cs.cached:
+                # the cached source may be stale, clear the cache so it's checked with stripe next time
+                await conn.execute('UPDATE users SET stripe_sources=NULL WHERE id=$1', res.user_id)
+        raise
+
+    await complete_charge(conn, paid_action_id=paid_action_id, charge=charge, new_customer=cs.new_customer,
+                          new_card=cs.new_card)
+    return paid_action_id
+
+
+class CustomerSource(NamedTuple):
+    customer_id: str
+    source_id: str
+    new_customer: bool
+    new_card: bool
+    # card refs to source ids to cache on the user, None if the cache is unchanged
+    sources: Optional[dict]
+    # whether source_id came from the cache without checking with stripe
+    cached: bool
+
+
+async def _get_customer_source(stripe_token, stripe_card_ref, stripe_customer_id, stripe_sources, stripe_get,
+                               stripe_post, **customer_data) -> CustomerSource:
+    """
+    Find or create the stripe customer and card source to charge, stripe_sources is the user's cache of card
+    references to source ids, if it contains stripe_card_ref no request to stripe is required.
+    """
+    if stripe_customer_id and stripe_sources and stripe_card_ref in stripe_sources:
+        return CustomerSource(stripe_customer_id, stripe_sources[stripe_card_ref], False, False, None, True)
+
+    if stripe_customer_id:
+        try:
+            cards = await stripe_get(f'customers/{stripe_customer_id}/sources?object=card')
+        except RequestError as e:
+            # 404 is ok, it happens when the customer has been deleted, we create a new customer below
+            if e.status != 404:
+                raise
+        else:
+            sources = {_card_ref(c): c['id'] for c in cards['data']}
+            source_id = sources.get(stripe_card_ref)
+            if source_id:
+                return CustomerSource(stripe_customer_id, source_id, False, False, sources, False)
+
+            # card not found on customer, create a new source
+            source = await stripe_post(
+                f'customers/{stripe_customer_id}/sources',
+                source=stripe_token,
+            )
+            sources[stripe_card_ref] = source['id']
+            return CustomerSource(stripe_customer_id, source['id'], False, True, sources, False)
+
+    customer = await stripe_post('customers', source=stripe_token, **customer_data)
+    source_id = customer['sources']['data'][0]['id']
+    return CustomerSource(customer['id'], source_id, True, True, {stripe_card_ref: source_id}, False)
+
+
+def _card_ref(c):
+    return '{last4}-{exp_year}-{exp_month}'.format(**c)
+
+
+def stripe_error_message(e: RequestError) -> Optional[str]:
+    """
+    Get the message from a stripe card error, these are intended to be shown to the customer.
+    """
+    try:
+        error = json.loads(e.info)['error']
+    except (ValueError, TypeError, KeyError):
+        return
+    if error.get('type') == 'card_error':
+        return error.get('message')
+
+
+async def set_payment_status(redis, res: Reservation, status: PaymentStatus, message: str = None) -> bool:
+    """
+    :return: whether the status was set, see SET_PAYMENT_STATUS_SCRIPT
+    """
+    return bool(await redis.eval(
+        SET_PAYMENT_STATUS_SCRIPT,
+        keys=[PAYMENT_STATUS_KEY.format(res.action_id)],
+        args=[json.dumps({'user_id': res.user_id, 'status': status.value, 'message': message}), PAYMENT_STATUS_TTL],
+    ))
+
+
+async def get_payment_status(redis, payment_id: int) -> Optional[dict]:
+    v = await redis.get(PAYMENT_STATUS_KEY.format(payment_id))
+    return v and json.loads(v.decode())
+
+
+CHARGING_SQL = """
+SELECT DISTINCT ON (t.paid_action) t.paid_action, t.reserve_action, t.event, e.name AS event_name,
+  count(*) OVER (PARTITION BY t.paid_action) AS ticket_count, a.user_id, a.ts, a.extra, co.stripe_secret_key
+FROM tickets AS t
+JOIN actions AS a ON t.paid_action = a.id
+JOIN events AS e ON t.event = e.id
+JOIN companies AS co ON a.company = co.id
+WHERE t.status='charging' AND a.ts < now() - $1::int * interval '1 second'
+ORDER BY t.paid_action
+"""
+
+
+class StripeActor(Actor):
+    def __init__(self, *, settings: Settings, stripe_client: StripeClient = None, pg=None, email_actor=None,
+                 **kwargs):
+        self.redis_settings = settings.redis_settings
+        super().__init__(**kwargs)
+        self.settings = settings
+        self.stripe = stripe_client or StripeClient(settings, loop=kwargs.get('loop'))
+        self.pg = pg
+        self.email_actor = email_actor
+
+    async def startup(self):
+        self.pg = self.pg or await asyncpg.create_pool_b(dsn=self.settings.pg_dsn, min_size=2)
+        self.email_actor = self.email_actor or EmailActor(
+            settings=self.settings, existing_redis=await self.get_redis(), http_client=self.stripe.session
+        )
+
+    async def shutdown(self):
+        await self.stripe.close()
+        await self.pg.close()
+
+    @concurrent(Actor.HIGH_QUEUE)
+    async def pay(self, company_id: int, reservation: dict, stripe_token: str, stripe_card_ref: str):
+        """
+        Take payment for a reservation validated by the web app, progress is recorded in redis so it can be
+        polled via the payment status endpoint.
+        """
+        res = Reservation(**reservation)
+        redis = await self.get_redis()
+        try:
+            async with self.pg.acquire() as conn:
+                paid_action_id = await pay_reservation(
+                    conn, self.stripe, res,
+                    company_id=company_id,
+                    stripe_token=stripe_token,
+                    stripe_card_ref=stripe_card_ref,
+                )
+        except ReservationError as e:
+            logger.warning('invalid reservation: %s', e)
+            await set_payment_status(redis, res, PaymentStatus.failed, 'invalid reservation')
+            return
+        except Exception as e:
+            if not await self._charge_started(res):
+                message = isinstance(e, RequestError) and stripe_error_message(e)
+                await set_payment_status(redis, res, PaymentStatus.failed, message or 'Payment failed')
+            # otherwise the status stays "pending" as the charge may yet be completed by recover_charges
+            raise
+
+        await set_payment_status(redis, res, PaymentStatus.success)
+        await self.email_actor.send_event_conf(paid_action_id)
+        return paid_action_id
+
+    async def _charge_started(self, res: Reservation) -> bool:
+        """
+        Whether the reservation's tickets are "charging", ie. a charge was sent to stripe (or might have been)
+        and hasn't been cancelled.
+        """
+        async with self.pg.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM tickets WHERE reserve_action=$1 AND status='charging')",
+                res.action_id,
+            )
+
+    @cron(minute={0, 10, 20, 30, 40, 50})
+    async def recover_charges(self):
+        """
+        Resolve payments left in "charging", eg. because the web process died or the stripe request timed out
+        part way through. The charge is replayed with the same idempotency key, so stripe either returns the
+        original charge or performs it now.
+        """
+        async with self.pg.acquire() as conn:
+            charging = await conn.fetch(CHARGING_SQL, self.settings.charge_recovery_delay)
+            for r in charging:
+                try:
+                    await self._recover_charge(conn, r)
+                except Exception:
+                    # one bad charge mustn't stop the rest being recovered
+                    logger.exception('error recovering charge for paid action %d', r['paid_action'])
+        return len(charging)
+
+    async def _recover_charge(self, conn, r):
+        paid_action_id = r['paid_action']
+        if r['ts'] < datetime.utcnow() - IDEMPOTENCY_WINDOW:
+            logger.error('paid action %d stuck in "charging" beyond the idempotency window, needs manual resolution',
+                         paid_action_id)
+            return
+
+        extra = json.loads(r['extra'])
+        # the buyer may be polling the payment status, see pay
+        res = Reservation(
+            user_id=r['user_id'],
+            action_id=r['reserve_action'],
+            event_id=r['event'],
+            price_cent=extra['charge_data']['amount'],
+            ticket_count=r['ticket_count'],
+            event_name=r['event_name'],
+        )
+        redis = await self.get_redis()
+        try:
+            charge = await self.stripe.request(
+                BasicAuth(r['stripe_secret_key']),
+                'post',
+                'charges',
+                idempotency_key=charge_idempotency_key(r['reserve_action']),
+                **extra['charge_data'],
+            )
+        except RequestError as e:
+            if e.status < 500 and e.status != 409:
+                logger.warning('charge for paid action %d failed, cancelling: %s', paid_action_id, e)
+                await cancel_charge(conn, paid_action_id)
+                await set_payment_status(redis, res, PaymentStatus.failed, stripe_error_message(e) or 'Payment failed')
+            else:
+                logger.warning('error recovering charge for paid action %d, will retry: %s', paid_action_id, e)
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning('error recovering charge for paid action %d, will retry: %s %s',
+                           paid_action_id, e.__class__.__name__, e)
+        else:
+            logger.info('recovered charge for paid action %d', paid_action_id)
+            await complete_charge(conn, paid_action_id=paid_action_id, charge=charge,
+                                  new_customer=extra['new_customer'], new_card=extra['new_card'])
+            await set_payment_status(redis, res, PaymentStatus.success)
+            await self.email_actor.send_event_conf(paid_action_id)
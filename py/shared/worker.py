@@ -1,18 +1,116 @@
-from arq import BaseWorker
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict
+
+from arq import Actor, BaseWorker, Drain
+from arq.utils import timestamp
+from async_timeout import timeout
 
 from .emails import EmailActor
+from .maintenance import MaintenanceActor
 from .settings import Settings
+from .stripe import StripeActor
+
+logger = logging.getLogger('nosht.worker')
+
+QUEUES = Actor.HIGH_QUEUE, Actor.DEFAULT_QUEUE, Actor.LOW_QUEUE
+QUEUE_METRICS_KEY = 'worker-queue-metrics'
+
+
+class PriorityDrain(Drain):
+    """
+    Drain which limits the number of jobs from each queue running at once. Queues are popped in order so high
+    priority jobs are always taken first, queues which have reached their limit aren't popped from at all so
+    a backlog of low priority jobs can't fill up the worker.
+    """
+    def __init__(self, *, queue_limits: Dict[bytes, int], **kwargs):
+        super().__init__(**kwargs)
+        self.queue_limits = queue_limits
+        self.queue_jobs = Counter()
+
+    async def iter(self, *raw_queues: bytes, pop_timeout=1):
+        if self.burst_mode:
+            # burst mode is only used to drain queues in one off runs, limits aren't required
+            async for msg in super().iter(*raw_queues, pop_timeout=pop_timeout):
+                yield msg
+            return
+
+        while self.running:
+            try:
+                with timeout(self.semaphore_timeout):
+                    await self.task_semaphore.acquire()
+            except asyncio.TimeoutError:
+                # as in Drain.iter: all task slots are busy, log and check running again rather than blocking
+                logger.warning('task semaphore acquisition timed out after %0.1fs', self.semaphore_timeout)
+                continue
+            if not self.running:
+                break
+            queues = [q for q in raw_queues if self.queue_jobs[q] < self.queue_limits.get(q, self.max_concurrent_tasks)]
+            msg = None
+            if queues:
+                with await self.redis as r:
+                    msg = await r.blpop(*queues, timeout=pop_timeout)
+            else:
+                await asyncio.sleep(pop_timeout, loop=self.loop)
+            if msg is None:
+                yield None, None
+                self.task_semaphore.release()
+            else:
+                yield msg
+
+    def add(self, coro, job, re_enqueue=False):
+        self.queue_jobs[job.raw_queue] += 1
+
+        async def run(j):
+            try:
+                return await coro(j)
+            finally:
+                self.queue_jobs[j.raw_queue] -= 1
+
+        super().add(run, job, re_enqueue)
+
+
+async def queue_metrics(redis) -> Dict[str, int]:
+    """
+    Number of jobs waiting in each queue across all workers, these can be used to scale the number of workers.
+    """
+    return {q: await redis.llen(Actor.QUEUE_PREFIX + q.encode()) for q in QUEUES}
 
 
 class Worker(BaseWorker):
-    shadows = [EmailActor]
+    shadows = [EmailActor, StripeActor, MaintenanceActor]
 
     def __init__(self, **kwargs):  # pragma: no cover
         self.settings = Settings()
         kwargs['redis_settings'] = self.settings.redis_settings
+        self.max_concurrent_tasks = self.settings.worker_max_jobs
         super().__init__(**kwargs)
 
+    def drain_class(self, **kwargs):
+        prefix = Actor.QUEUE_PREFIX
+        return PriorityDrain(
+            queue_limits={
+                prefix + Actor.DEFAULT_QUEUE.encode(): self.settings.worker_dft_queue_jobs,
+                prefix + Actor.LOW_QUEUE.encode(): self.settings.worker_low_queue_jobs,
+            },
+            **kwargs
+        )
+
     async def shadow_kwargs(self):
         kwargs = await super().shadow_kwargs()
         kwargs['settings'] = self.settings
         return kwargs
+
+    async def record_health(self, redis_queues, queue_lookup):
+        """
+        As well as arq's health check, save queue lengths and jobs in progress by queue to QUEUE_METRICS_KEY.
+        """
+        if (timestamp() - self.last_health_check) >= self.health_check_interval:
+            redis = self.drain.redis
+            metrics = {f'{q}_queued': v for q, v in (await queue_metrics(redis)).items()}
+            metrics.update({f'{queue_lookup[q]}_running': v for q, v in self.drain.queue_jobs.items()})
+            await redis.hmset_dict(QUEUE_METRICS_KEY, metrics)
+            await redis.expire(QUEUE_METRICS_KEY, self.health_check_interval * 2)
+            logger.info('queue metrics: %s', ' '.join(f'{k}={v}' for k, v in sorted(metrics.items())))
+        await super().record_health(redis_queues, queue_lookup)
@@ -37,6 +37,7 @@ settings_args = dict(
     ticket_ttl=15,
     facebook_siw_app_secret='testing',
     print_emails=False,
+    actions_buffer_size=0,
 )
 
 
@@ -63,6 +64,7 @@ replaced_url_fields = (
     'grecaptcha_url',
     'google_siw_url',
     'facebook_siw_url',
+    'stripe_root',
 )
 
 
@@ -255,6 +257,8 @@ async def post_startup_app(app):
     inner_app = app['main_app']
     inner_app['email_actor'].pg = inner_app['pg']
     inner_app['email_actor']._concurrency_enabled = False
+    inner_app['stripe_actor'].pg = inner_app['pg']
+    inner_app['stripe_actor']._concurrency_enabled = False
 
 
 @pytest.fixture(name='cli')
@@ -1,7 +1,33 @@
+"""
+Stand-ins for the external services used by the app: SES, grecaptcha, google and facebook sign in and stripe.
+
+Used by the tests and benchmarks, it can also be run on its own with eg.
+
+    python -m tests.dummy_server --port 8001 --behaviour behaviour.json
+
+Responses are instant unless a behaviour is configured for an endpoint, behaviour is set per route name
+(or "*" for all routes) with json like:
+
+    {"stripe_post_charges": {"latency": "lognormal:0.4:0.5", "error_rate": 0.02, "rate_limit": 25}}
+
+latency is "fixed:<s>", "uniform:<min s>:<max s>", "normal:<mean s>:<sd s>" or "lognormal:<median s>:<sigma>",
+error_rate is the fraction of requests which fail with a 500 and requests beyond rate_limit per second are
+throttled. Behaviour can be changed while the server is running with "PUT /_behaviour/".
+"""
+import argparse
+import asyncio
 import base64
+import json
+import math
+import random
+from collections import deque
 from email import message_from_bytes
+from itertools import count
+from time import time
+from typing import Callable, NamedTuple, Optional
 
 from aiohttp import web
+from aiohttp.web_middlewares import middleware
 from aiohttp.web_response import Response, json_response
 
 
@@ -16,6 +42,11 @@ async def aws_ses(request):
             d[f'part:{part.get_content_type()}'] = payload.decode().replace('\r\n', '\n')
 
     request.app['log'].append(('email_send_endpoint', 'Subject: "{Subject}", To: "{To}"'.format(**email)))
+    if 'fail@' in email['To']:
+        return Response(text='<Error><Code>MessageRejected</Code></Error>', status=400)
+    if 'throttle@' in email['To'] and not request.app['throttled']:
+        request.app['throttled'] = True
+        return Response(text='<Error><Code>Throttling</Code></Error>', status=400)
     request.app['emails'].append(d)
     return Response(text='<MessageId>testing</MessageId>')
 
@@ -46,18 +77,215 @@ async def facebook_siw(request):
     })
 
 
-async def create_dummy_server(loop, create_server):
-    app = web.Application(loop=loop)
+async def stripe_post_customers(request):
+    data = await request.post()
+    request.app['log'].append(('stripe_post_customers', data.get('email')))
+    customer_id = f'cus_{next(request.app["ids"])}'
+    return json_response({
+        'id': customer_id,
+        'sources': {
+            'data': [
+                {
+                    'id': f'src_{next(request.app["ids"])}',
+                    'customer': customer_id,
+                    'last4': '4242',
+                    'exp_month': 8,
+                    'exp_year': 2032,
+                },
+            ],
+        },
+    })
+
+
+def stripe_customer_source(customer_id):
+    return {
+        'id': 'src_1',
+        'customer': customer_id,
+        'last4': '4242',
+        'exp_month': 8,
+        'exp_year': 2032,
+    }
+
+
+async def stripe_get_customers(request):
+    request.app['log'].append(('stripe_get_customers', None))
+    return json_response({
+        'data': [
+            {'id': 'cus_1', 'sources': {'data': [stripe_customer_source('cus_1')]}},
+        ],
+    })
+
+
+async def stripe_get_customer_sources(request):
+    request.app['log'].append(('stripe_get_customer_sources', request.match_info['customer']))
+    return json_response({'data': [stripe_customer_source(request.match_info['customer'])]})
+
+
+async def stripe_post_customer_sources(request):
+    request.app['log'].append(('stripe_post_customer_sources', request.match_info['customer']))
+    return json_response({'id': f'src_{next(request.app["ids"])}'})
+
+
+async def stripe_post_charges(request):
+    data = await request.post()
+    request.app['log'].append(('stripe_post_charges', data['amount']))
+    charge_id = f'ch_{next(request.app["ids"])}'
+    charge = request.app['stripe_charges'][charge_id] = {
+        'id': charge_id,
+        'amount': int(data['amount']),
+        'description': data.get('description'),
+        'metadata': {k[9:-1]: v for k, v in data.items() if k.startswith('metadata[')},
+        'source': {
+            'id': data['source'],
+            'last4': '4242',
+            'exp_month': 8,
+            'exp_year': 2032,
+        },
+    }
+    return json_response(charge)
+
+
+async def stripe_get_charge(request):
+    charge_id = request.match_info['charge']
+    request.app['log'].append(('stripe_get_charge', charge_id))
+    charge = request.app['stripe_charges'].get(charge_id)
+    if not charge:
+        return json_response({'error': {'type': 'invalid_request_error', 'message': 'no such charge'}}, status=404)
+    return json_response(charge)
+
+
+class Behaviour(NamedTuple):
+    latency: Optional[Callable[[], float]]
+    error_rate: float
+    rate_limit: Optional[int]
+
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed': lambda s: lambda: s,
+    'uniform': lambda low, high: lambda: random.uniform(low, high),
+    'normal': lambda mean, sd: lambda: max(random.gauss(mean, sd), 0),
+    'lognormal': lambda median, sigma: lambda: random.lognormvariate(math.log(median), sigma),
+}
+
+
+def parse_behaviour(config: dict) -> dict:
+    behaviour = {}
+    for name, c in config.items():
+        latency = None
+        if c.get('latency'):
+            dist, *params = c['latency'].split(':')
+            latency = LATENCY_DISTRIBUTIONS[dist](*map(float, params))
+        behaviour[name] = Behaviour(latency, c.get('error_rate', 0), c.get('rate_limit'))
+    return behaviour
+
+
+def error_response(route_name: str, status: int):
+    if route_name == 'aws_ses':
+        # SES reports throttling with a 400
+        code = 'Throttling' if status == 429 else 'InternalFailure'
+        return Response(text=f'<Error><Code>{code}</Code></Error>', status=400 if status == 429 else status)
+    elif route_name.startswith('stripe_'):
+        error_type = 'rate_limit_error' if status == 429 else 'api_error'
+        return json_response({'error': {'type': error_type, 'message': 'dummy server error'}}, status=status)
+    else:
+        return Response(text='dummy server error', status=status)
+
+
+def throttled(app, route_name: str, rate_limit: int) -> bool:
+    second = int(time())
+    window_second, window_count = app['rate_windows'].get(route_name, (second, 0))
+    if window_second != second:
+        window_count = 0
+    app['rate_windows'][route_name] = second, window_count + 1
+    return window_count >= rate_limit
+
+
+@middleware
+async def behaviour_middleware(request, handler):
+    route_name = request.match_info.route.name
+    behaviour = route_name and (request.app['behaviour'].get(route_name) or request.app['behaviour'].get('*'))
+    if behaviour:
+        if behaviour.rate_limit and throttled(request.app, route_name, behaviour.rate_limit):
+            request.app['log'].append((route_name, 'throttled'))
+            return error_response(route_name, 429)
+        if behaviour.latency:
+            await asyncio.sleep(behaviour.latency())
+        if random.random() < behaviour.error_rate:
+            request.app['log'].append((route_name, 'error'))
+            return error_response(route_name, 500)
+    return await handler(request)
+
+
+async def get_behaviour(request):
+    return json_response(request.app['behaviour_config'])
+
+
+async def set_behaviour(request):
+    config = await request.json()
+    request.app.update(behaviour_config=config, behaviour=parse_behaviour(config))
+    return json_response(config)
+
+
+def create_dummy_app(loop=None, behaviour_config: dict = None, log_size: int = None):
+    """
+    log_size limits the number of log entries and emails kept, the default keeps them all.
+    """
+    app = web.Application(loop=loop, middlewares=(behaviour_middleware,))
     app.add_routes([
-        web.post('/aws_ses_endpoint/', aws_ses),
-        web.post('/grecaptcha_url/', grecaptcha),
-        web.get('/google_siw_url/', google_siw),
-        web.get('/facebook_siw_url/', facebook_siw),
+        web.post('/aws_ses_endpoint/', aws_ses, name='aws_ses'),
+        web.post('/grecaptcha_url/', grecaptcha, name='grecaptcha'),
+        web.get('/google_siw_url/', google_siw, name='google_siw'),
+        web.get('/facebook_siw_url/', facebook_siw, name='facebook_siw'),
+        web.get('/stripe_root/customers', stripe_get_customers, name='stripe_get_customers'),
+        web.post('/stripe_root/customers', stripe_post_customers, name='stripe_post_customers'),
+        web.get('/stripe_root/customers/{customer}/sources', stripe_get_customer_sources,
+                name='stripe_get_customer_sources'),
+        web.post('/stripe_root/customers/{customer}/sources', stripe_post_customer_sources,
+                 name='stripe_post_customer_sources'),
+        web.post('/stripe_root/charges', stripe_post_charges, name='stripe_post_charges'),
+        web.get('/stripe_root/charges/{charge}', stripe_get_charge, name='stripe_get_charge'),
+        web.get('/_behaviour/', get_behaviour),
+        web.put('/_behaviour/', set_behaviour),
     ])
-    server = await create_server(app)
+    behaviour_config = behaviour_config or {}
     app.update(
-        log=[],
-        emails=[],
-        server_name=f'http://localhost:{server.port}'
+        log=deque(maxlen=log_size) if log_size else [],
+        emails=deque(maxlen=log_size) if log_size else [],
+        throttled=False,
+        ids=count(1),
+        stripe_charges={},
+        rate_windows={},
+        behaviour_config=behaviour_config,
+        behaviour=parse_behaviour(behaviour_config),
     )
+    return app
+
+
+async def create_dummy_server(loop, create_server, behaviour_config: dict = None):
+    app = create_dummy_app(loop, behaviour_config)
+    server = await create_server(app)
+    app['server_name'] = f'http://localhost:{server.port}'
     return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the stand-ins for external services')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--behaviour', help='json file with the behaviour of each endpoint')
+    parser.add_argument('--log-size', type=int, default=1000, help='number of log entries and emails to keep')
+    args = parser.parse_args()
+
+    behaviour_config = None
+    if args.behaviour:
+        with open(args.behaviour) as f:
+            behaviour_config = json.load(f)
+    app = create_dummy_app(behaviour_config=behaviour_config, log_size=args.log_size)
+    server_name = app['server_name'] = f'http://localhost:{args.port}'
+    print('point these settings at the stand-ins:')
+    for field in ('aws_ses_endpoint', 'grecaptcha_url', 'google_siw_url', 'facebook_siw_url', 'stripe_root'):
+        print(f'  {field}: {server_name}/{field}/')
+    web.run_app(app, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
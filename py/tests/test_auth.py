@@ -36,6 +36,24 @@ async def test_login_successful(cli, url, factory: Factory):
     assert r.status == 200, await r.text()
 
 
+async def test_login_action_user_agent(cli, url, factory: Factory, login, db_conn):
+    await factory.create_company()
+    await factory.create_user()
+    await login()
+    await login()
+
+    extra = await db_conn.fetch("SELECT extra FROM actions WHERE type='login'")
+    assert len(extra) == 2
+    assert json.loads(extra[0]['extra']) == json.loads(extra[1]['extra']) == {
+        'url': '/api/auth-token/',
+        'ip': RegexStr('.+'),
+        'ua_id': AnyInt(),
+    }
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM user_agents')
+    extra = json.loads(await db_conn.fetchval("SELECT action_extra(extra) FROM actions WHERE type='login' LIMIT 1"))
+    assert extra['ua'] == RegexStr('Python.*aiohttp.*')
+
+
 async def test_host_signup_email(cli, url, factory: Factory, db_conn, dummy_server, settings):
     await factory.create_company()
     assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM users')
@@ -1,6 +1,21 @@
-from pytest_toolbox.comparison import RegexStr
+import gzip
+import json
+from datetime import datetime
 
+from buildpg import MultipleValues, Values
+from pytest_toolbox.comparison import AnyInt, RegexStr
+
+from shared.bulk_data import BulkConfig, load_bulk_data
 from shared.db import create_demo_data
+from shared.emails.main import EVENT_UPDATE_SQL, REMINDER_EVENTS_SQL
+from shared.emails.plumbing import EMAIL_USERS_SQL, OUTBOX_CLAIM_SQL
+from shared.maintenance import MaintenanceActor
+from shared.stripe import CHARGING_SQL
+from web.views import company_sql
+from web.views.categories import CATEGORY_PUBLIC_SQL
+from web.views.events import event_sql, event_ticket_sql
+
+from .conftest import Factory
 
 
 async def test_create_demo_data(cli, url, db_conn, settings):
@@ -70,3 +85,196 @@ async def test_create_demo_data(cli, url, db_conn, settings):
         },
         'user': None,
     }
+
+
+async def test_update_user_ts(db_conn, factory: Factory):
+    await factory.create_company()
+    await factory.create_user(active_ts=datetime(2018, 1, 1))
+    add_action = "INSERT INTO actions (company, user_id, type) VALUES ($1, $2, 'login')"
+
+    await db_conn.execute(add_action, factory.company_id, factory.user_id)
+    assert True is await db_conn.fetchval('SELECT active_ts = now() FROM users')
+
+    # updates are skipped while active_ts is recent
+    await db_conn.execute("UPDATE users SET active_ts=now() - interval '1 minute'")
+    await db_conn.execute(add_action, factory.company_id, factory.user_id)
+    assert True is await db_conn.fetchval("SELECT active_ts = now() - interval '1 minute' FROM users")
+
+
+async def create_old_actions(db_conn, factory: Factory):
+    await factory.create_company()
+    await factory.create_user()
+    await db_conn.execute_b(
+        'INSERT INTO actions (:values__names) VALUES :values',
+        values=MultipleValues(*[
+            Values(company=factory.company_id, user_id=factory.user_id, type=t, ts=ts)
+            for t, ts in [
+                ('login', datetime(2016, 1, 1)),
+                ('logout', datetime(2016, 2, 1)),
+                ('reserve-tickets', datetime(2016, 1, 1)),
+                ('login', datetime.utcnow()),
+            ]
+        ])
+    )
+
+
+async def test_archive_actions(db_conn, db_pool, factory: Factory, settings, loop, tmpdir):
+    await create_old_actions(db_conn, factory)
+    settings.actions_archive_dir = str(tmpdir)
+
+    actor = MaintenanceActor(settings=settings, pg=db_pool, loop=loop, concurrency_enabled=False)
+    assert 2 == await actor.archive_actions.direct(batch_size=1)
+    await actor.close()
+
+    rows = await db_conn.fetch('SELECT type FROM actions ORDER BY ts')
+    assert [r['type'] for r in rows] == ['reserve-tickets', 'login']
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['actions-2016-01.jsonl.gz', 'actions-2016-02.jsonl.gz']
+    with gzip.open(str(tmpdir.join('actions-2016-01.jsonl.gz')), 'rt') as f:
+        archived = [json.loads(line) for line in f]
+    assert archived == [
+        {
+            'id': AnyInt(),
+            'company': factory.company_id,
+            'user_id': factory.user_id,
+            'ts': '2016-01-01T00:00:00',
+            'type': 'login',
+            'extra': None,
+        },
+    ]
+
+
+class FakeS3:
+    def __init__(self):
+        self.uploads = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def put_object(self, **kwargs):
+        self.uploads.append(kwargs)
+
+
+async def test_archive_actions_s3(db_conn, db_pool, factory: Factory, settings, loop, mocker):
+    await create_old_actions(db_conn, factory)
+    settings.actions_archive_bucket = 'testing-archive'
+    s3 = FakeS3()
+    mocker.patch('shared.maintenance.create_s3_session', return_value=s3)
+
+    actor = MaintenanceActor(settings=settings, pg=db_pool, loop=loop, concurrency_enabled=False)
+    assert 2 == await actor.archive_actions.direct(batch_size=1)
+    await actor.close()
+
+    rows = await db_conn.fetch('SELECT type FROM actions ORDER BY ts')
+    assert [r['type'] for r in rows] == ['reserve-tickets', 'login']
+    assert [(u['Bucket'], u['Key']) for u in s3.uploads] == [
+        ('testing-archive', RegexStr(r'actions/2016-01/actions-2016-01-\d+\.jsonl\.gz')),
+        ('testing-archive', RegexStr(r'actions/2016-02/actions-2016-02-\d+\.jsonl\.gz')),
+    ]
+    archived = [json.loads(line) for line in gzip.decompress(s3.uploads[1]['Body']).decode().splitlines()]
+    assert [a['type'] for a in archived] == ['logout']
+
+
+async def test_archive_actions_no_target(db_conn, db_pool, factory: Factory, settings, loop, tmpdir, caplog):
+    await create_old_actions(db_conn, factory)
+    # local files don't survive restarts on heroku so actions aren't deleted
+    settings.actions_archive_dir = str(tmpdir)
+    settings.on_heroku = True
+
+    actor = MaintenanceActor(settings=settings, pg=db_pool, loop=loop, concurrency_enabled=False)
+    assert 0 == await actor.archive_actions.direct()
+    await actor.close()
+
+    assert 4 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+    assert tmpdir.listdir() == []
+    assert 'actions_archive_bucket not set, actions not archived' in caplog.text
+
+
+# tables which grow with usage, the rest are small enough that a sequential scan is always fine
+LARGE_TABLES = {'users', 'events', 'tickets', 'actions', 'email_outbox'}
+
+
+def seq_scans(plan):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for sub_plan in plan.get('Plans', []):
+        yield from seq_scans(sub_plan)
+
+
+async def test_hot_queries_use_indexes(db_conn, settings):
+    # enough data for the planner to prefer indexes with its default settings, but small enough to load quickly
+    await load_bulk_data(db_conn, settings, BulkConfig(seed=1, companies=2, users=1000, events=400, tickets=10,
+                                                       logins=5))
+    await db_conn.execute(
+        """
+        INSERT INTO email_outbox (company, trigger, user_id, dedupe_key, status, created_ts)
+        SELECT company, 'event-update'::email_triggers, id, 'bulk-' || i,
+          (CASE WHEN i = 5 THEN 'pending' ELSE 'sent' END)::email_outbox_status, now() - i * interval '1 day'
+        FROM users, generate_series(1, 5) AS i
+        """
+    )
+    await db_conn.execute('ANALYZE')
+    company_id, user_id = await db_conn.fetchrow("SELECT company, id FROM users WHERE role='admin' LIMIT 1")
+    event_id, event_slug, cat_slug = await db_conn.fetchrow(
+        """
+        SELECT e.id, e.slug, c.slug FROM events AS e
+        JOIN categories AS c ON e.category = c.id
+        WHERE c.company=$1 AND e.status='published'
+        LIMIT 1
+        """,
+        company_id,
+    )
+
+    queries = [
+        (company_sql, company_id, user_id),
+        (CATEGORY_PUBLIC_SQL, company_id, cat_slug),
+        (event_sql, company_id, cat_slug, event_slug),
+        (event_ticket_sql, event_id, company_id),
+        (CHARGING_SQL, 60),
+        (REMINDER_EVENTS_SQL, 24, 100),
+        (EVENT_UPDATE_SQL, event_id),
+        (OUTBOX_CLAIM_SQL, company_id, 'event-update', 100, 60),
+        (EMAIL_USERS_SQL, company_id, [user_id]),
+        ("SELECT count(*) FROM tickets WHERE event=$1 AND status != 'cancelled'", event_id),
+        ("SELECT user_id FROM tickets WHERE paid_action=$1", 1),
+        ("SELECT 1 FROM tickets WHERE event=$1 AND reserve_action=$2 AND status='reserved'", event_id, 1),
+        (
+            """
+            SELECT 1 FROM actions
+            WHERE user_id=$1 AND type='password-reset' AND now() - ts < interval '7 days' AND extra->>'nonce'=$2
+            """,
+            user_id, 'foobar'
+        ),
+    ]
+    for sql, *args in queries:
+        plan = json.loads(await db_conn.fetchval('EXPLAIN (FORMAT JSON) ' + sql, *args))
+        assert LARGE_TABLES.isdisjoint(seq_scans(plan[0]['Plan'])), sql
+
+
+async def test_load_bulk_data(db_conn, settings):
+    config = BulkConfig(seed=1, companies=2, users=20, events=30, tickets=10, logins=2)
+    counts = await load_bulk_data(db_conn, settings, config)
+    assert counts['companies'] == 2
+    assert counts['users'] == 40
+    assert counts['events'] == 30
+    assert counts['tickets'] > 0
+    assert counts == {k: await db_conn.fetchval(f'SELECT count(*) FROM {k}') for k in counts}
+
+    # tickets_taken must agree with the tickets created
+    assert 0 == await db_conn.fetchval(
+        """
+        SELECT count(*) FROM events AS e
+        WHERE tickets_taken != (SELECT count(*) FROM tickets WHERE event=e.id AND status != 'cancelled')
+        """
+    )
+    assert 0 == await db_conn.fetchval(
+        """
+        SELECT count(*) FROM tickets AS t
+        JOIN events AS e ON t.event = e.id
+        JOIN categories AS c ON e.category = c.id
+        JOIN actions AS a ON t.reserve_action = a.id
+        WHERE a.company != c.company OR a.type != 'reserve-tickets'
+        """
+    )
@@ -1,11 +1,16 @@
 import json
 import re
+from datetime import datetime, timedelta
 
+import msgpack
 import pytest
 from buildpg import Values
 from pytest_toolbox.comparison import RegexStr
 
 from shared.emails import EmailActor, Triggers, UserEmail
+from shared.emails import plumbing
+from shared.emails.plumbing import compile_email
+from shared.emails.ratelimit import SesRateLimiter
 from shared.settings import Settings
 from web.actions import ActionTypes
 
@@ -68,6 +73,81 @@ async def test_with_def(email_actor: EmailActor, factory: Factory, dummy_server,
     }
 
 
+async def test_email_config_cache(email_actor: EmailActor, factory: Factory, dummy_server, db_conn):
+    await factory.create_company()
+    await factory.create_user(email='testing@scolvin.com')
+    users_emails = [UserEmail(id=factory.user_id)]
+
+    await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails, dedupe_key='1')
+    await db_conn.execute_b(
+        'INSERT INTO email_definitions (:values__names) VALUES :values',
+        values=Values(company=factory.company_id, trigger=Triggers.admin_notification.value, subject='Changed'),
+    )
+    await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails, dedupe_key='2')
+
+    email_actor._email_config_changed(None, 1, 'email_config', str(factory.company_id))
+    await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails, dedupe_key='3')
+    assert [e['Subject'] for e in dummy_server.app['emails']] == [
+        'Testing notification', 'Testing notification', 'Changed',
+    ]
+
+
+async def test_shared_render(email_actor: EmailActor, factory: Factory, dummy_server, db_conn):
+    await factory.create_company()
+    u1 = await factory.create_user(first_name='Anne', email='anne@example.com')
+    u2 = await factory.create_user(first_name='Ben', email='ben@example.com')
+    await db_conn.execute_b(
+        'INSERT INTO email_definitions (:values__names) VALUES :values',
+        values=Values(
+            company=factory.company_id,
+            trigger=Triggers.password_reset.value,
+            subject='{{ foo }} for {{{ full_name }}}',
+            body='Hi **{{ first_name }}**, {{ foo }}\n\n{{ centered_button(Unsubscribe | {{ unsubscribe_link }}) }}',
+        )
+    )
+
+    ctx = {'foo': 'bar'}
+    await email_actor.send_emails(factory.company_id, Triggers.password_reset,
+                                  [UserEmail(id=u1, ctx=ctx), UserEmail(id=u2, ctx=ctx)])
+
+    emails = sorted(dummy_server.app['emails'], key=lambda e: e['To'])
+    assert [(e['Subject'], e['To']) for e in emails] == [
+        ('bar for Anne Spencer', 'Anne Spencer <anne@example.com>'),
+        ('bar for Ben Spencer', 'Ben Spencer <ben@example.com>'),
+    ]
+    assert 'Hi **Ben**, bar' in emails[1]['part:text/plain']
+    html = emails[1]['part:text/html']
+    assert '<strong>Ben</strong>' in html
+    assert f'https://127.0.0.1/api/unsubscribe/{u2}/?sig=' in html
+    assert 'zxq' not in html
+    assert emails[1]['List-Unsubscribe'] == RegexStr(rf'<https://127\.0\.0\.1/api/unsubscribe/{u2}/\?sig=\w+>')
+
+
+async def test_shared_render_user_sections(email_actor: EmailActor, factory: Factory, dummy_server, db_conn,
+                                           mocker):
+    await factory.create_company()
+    u1 = await factory.create_user(first_name='Anne', email='anne@example.com')
+    u2 = await factory.create_user(first_name='Ben', email='ben@example.com')
+    await db_conn.execute_b(
+        'INSERT INTO email_definitions (:values__names) VALUES :values',
+        values=Values(
+            company=factory.company_id,
+            trigger=Triggers.admin_notification.value,
+            body='{{#first_name}}Hi {{ first_name }},{{/first_name}}{{^first_name}}Hello,{{/first_name}} {{ foo }}',
+        )
+    )
+    render_shared_email = mocker.spy(plumbing, 'render_shared_email')
+
+    ctx = {'foo': 'bar'}
+    await email_actor.send_emails(factory.company_id, Triggers.admin_notification,
+                                  [UserEmail(id=u1, ctx=ctx), UserEmail(id=u2, ctx=ctx)])
+
+    assert render_shared_email.call_count == 0
+    emails = sorted(dummy_server.app['emails'], key=lambda e: e['To'])
+    assert 'Hi Anne, bar' in emails[0]['part:text/plain']
+    assert 'Hi Ben, bar' in emails[1]['part:text/plain']
+
+
 async def test_send_ticket_email(email_actor: EmailActor, db_conn, factory: Factory, dummy_server):
     await factory.create_company()
     await factory.create_cat()
@@ -112,6 +192,59 @@ async def test_send_ticket_email(email_actor: EmailActor, db_conn, factory: Fact
     assert '<p><a href="https://www.google.com/maps/place/' in html
 
 
+async def create_reminder_events(db_conn, factory: Factory):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user(email='testing@scolvin.com')
+    await factory.create_event(status='published', start_ts=datetime.utcnow() + timedelta(hours=2))
+    await factory.create_event(name='Later', status='published', start_ts=datetime.utcnow() + timedelta(days=3))
+
+    action_id = await db_conn.fetchval_b(
+        'INSERT INTO actions (:values__names) VALUES :values RETURNING id',
+        values=Values(company=factory.company_id, user_id=factory.user_id, type=ActionTypes.buy_tickets)
+    )
+    await db_conn.execute_b(
+        'INSERT INTO tickets (:values__names) VALUES :values',
+        values=Values(event=factory.event_id, user_id=factory.user_id, reserve_action=action_id,
+                      paid_action=action_id, status='paid')
+    )
+
+
+async def test_send_event_reminders(email_actor: EmailActor, db_conn, factory: Factory, dummy_server):
+    await create_reminder_events(db_conn, factory)
+
+    assert 1 == await email_actor.send_event_reminders.direct()
+    assert dummy_server.app['log'] == [
+        ('email_send_endpoint', 'Subject: "The Event Name Reminder", To: "Frank Spencer <testing@scolvin.com>"'),
+    ]
+    assert [True, False] == [r[0] for r in await db_conn.fetch('SELECT reminded FROM events ORDER BY id')]
+
+    assert 0 == await email_actor.send_event_reminders.direct()
+    assert len(dummy_server.app['emails']) == 1
+
+
+async def test_send_event_reminders_enqueued(email_actor: EmailActor, db_conn, factory: Factory, dummy_server,
+                                             mocker):
+    await create_reminder_events(db_conn, factory)
+    jobs = []
+
+    async def enqueue_job(func_name, *args, **kwargs):
+        # arq serialises jobs with msgpack, this raises an error if any argument can't be serialised
+        jobs.append(msgpack.unpackb(msgpack.packb([func_name, args, kwargs], use_bin_type=True), raw=False))
+
+    email_actor._concurrency_enabled = True
+    mocker.patch.object(email_actor, 'enqueue_job', side_effect=enqueue_job)
+    assert 1 == await email_actor.send_event_reminders.direct()
+
+    assert [j[:2] for j in jobs] == [['drain_outbox', [factory.company_id, 'event-reminder']]]
+    assert 'pending' == await db_conn.fetchval('SELECT status FROM email_outbox')
+    assert dummy_server.app['emails'] == []
+
+    email_actor._concurrency_enabled = False
+    assert 1 == await email_actor.drain_outbox(factory.company_id, 'event-reminder')
+    assert len(dummy_server.app['emails']) == 1
+
+
 async def test_unsubscribe(email_actor: EmailActor, factory: Factory, dummy_server, db_conn, cli):
     await factory.create_company()
     await factory.create_user(email='testing@scolvin.com')
@@ -127,3 +260,119 @@ async def test_unsubscribe(email_actor: EmailActor, factory: Factory, dummy_serv
     assert r.status == 307, await r.text()
     assert r.headers['Location'].endswith('/unsubscribe-valid/')
     assert False is await db_conn.fetchval('SELECT receive_emails FROM users where id=$1', factory.user_id)
+
+
+async def test_send_emails_partial_failure(email_actor: EmailActor, factory: Factory, dummy_server, settings):
+    await factory.create_company()
+    user_ids = [
+        await factory.create_user(email='a@example.com'),
+        await factory.create_user(email='fail@example.com'),
+        await factory.create_user(email='b@example.com'),
+    ]
+    settings.email_send_chunk_size = 2
+
+    sent = await email_actor.send_emails(factory.company_id, Triggers.admin_notification,
+                                         [UserEmail(id=user_id) for user_id in user_ids])
+    assert sent == 2
+    assert len(dummy_server.app['log']) == 3
+    assert {e['To'] for e in dummy_server.app['emails']} == {
+        'Frank Spencer <a@example.com>',
+        'Frank Spencer <b@example.com>',
+    }
+
+
+async def test_outbox_dedupe(email_actor: EmailActor, factory: Factory, dummy_server, db_conn):
+    await factory.create_company()
+    await factory.create_user(email='testing@scolvin.com')
+    users_emails = [UserEmail(id=factory.user_id, ctx={'foo': 'bar'})]
+
+    assert 1 == await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails,
+                                              dedupe_key='one')
+    assert 0 == await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails,
+                                              dedupe_key='one')
+    assert 1 == await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails,
+                                              dedupe_key='another')
+    # without a dedupe key emails with the same context are always sent
+    assert 1 == await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails)
+    assert 1 == await email_actor.send_emails(factory.company_id, Triggers.admin_notification, users_emails)
+    assert len(dummy_server.app['emails']) == 4
+
+    rows = await db_conn.fetch('SELECT dedupe_key, status, attempts, message_id FROM email_outbox ORDER BY id')
+    assert [dict(r) for r in rows] == [
+        {'dedupe_key': 'one', 'status': 'sent', 'attempts': 1, 'message_id': 'testing@eu-west-1.amazonses.com'},
+        {'dedupe_key': 'another', 'status': 'sent', 'attempts': 1, 'message_id': 'testing@eu-west-1.amazonses.com'},
+        {'dedupe_key': None, 'status': 'sent', 'attempts': 1, 'message_id': 'testing@eu-west-1.amazonses.com'},
+        {'dedupe_key': None, 'status': 'sent', 'attempts': 1, 'message_id': 'testing@eu-west-1.amazonses.com'},
+    ]
+
+
+async def test_outbox_retry(email_actor: EmailActor, factory: Factory, db_conn, mocker):
+    mocker.patch.object(email_actor, 'aws_send', side_effect=RuntimeError('boom'))
+    await factory.create_company()
+    await factory.create_user(email='testing@scolvin.com')
+
+    sent = await email_actor.send_emails(factory.company_id, Triggers.admin_notification,
+                                         [UserEmail(id=factory.user_id)])
+    assert sent == 0
+    r = await db_conn.fetchrow('SELECT status, attempts, error, send_after > now() AS delayed FROM email_outbox')
+    assert dict(r) == {'status': 'pending', 'attempts': 1, 'error': 'RuntimeError: boom', 'delayed': True}
+
+    max_attempts = email_actor.settings.email_max_attempts
+    await db_conn.execute('UPDATE email_outbox SET send_after=now(), attempts=$1', max_attempts - 1)
+    assert 0 == await email_actor.send_outbox(factory.company_id, Triggers.admin_notification)
+    r = await db_conn.fetchrow('SELECT status, attempts FROM email_outbox')
+    assert dict(r) == {'status': 'dead', 'attempts': max_attempts}
+
+
+async def test_send_email_throttled(email_actor: EmailActor, factory: Factory, dummy_server, mocker):
+    mocker.patch('shared.emails.plumbing.random.uniform', return_value=0)
+    await factory.create_company()
+    await factory.create_user(email='throttle@example.com')
+
+    sent = await email_actor.send_emails(factory.company_id, Triggers.admin_notification,
+                                         [UserEmail(id=factory.user_id)])
+    assert sent == 1
+    assert len(dummy_server.app['log']) == 2
+    assert len(dummy_server.app['emails']) == 1
+
+
+async def test_ses_rate_limiter(redis):
+    limiter = SesRateLimiter(redis, max_rate=10)
+    for i in range(3):
+        await limiter.acquire()
+    tokens, rate = await redis.hmget(SesRateLimiter.key, 'tokens', 'rate')
+    assert 7 <= float(tokens) < 7.5
+    assert float(rate) == 10
+
+    await limiter.throttled()
+    tokens, rate = await redis.hmget(SesRateLimiter.key, 'tokens', 'rate')
+    assert float(tokens) == 0
+    assert float(rate) == 5
+
+
+async def test_aws_signing_key(email_actor: EmailActor):
+    key = email_actor._aws_signing_key('20180101')
+    assert key.hex() == '413c9b337af872433dbbcecf63e8106527716223d8a2145f75acd23224cecf9e'
+    assert email_actor._aws_signing_key('20180101') is key
+    assert email_actor._aws_signing_key('20180102') != key
+
+
+def test_compile_email():
+    compile_email.cache_clear()
+    email = compile_email('{{ company_name }}', 'hello\n{{ centered_button(Go | /foo/) }}', '{{> title }}')
+    assert email.subject == [('variable', 'company_name')]
+    assert email.body == [
+        ('literal', 'hello\n<div class="button">\n  <a href="/foo/"><span>Go</span></a>\n</div>\n'),
+    ]
+    assert email.template == [('partial', 'title')]
+    assert email.debug_context is False
+    assert email.user_sections is False
+    assert compile_email('{{ company_name }}', 'hello\n{{ centered_button(Go | /foo/) }}', '{{> title }}') is email
+    assert compile_email.cache_info().hits == 1
+
+
+def test_compile_email_user_sections():
+    assert compile_email('x', '{{#first_name}}Hi {{ first_name }}{{/first_name}}', '').user_sections is True
+    assert compile_email('{{^full_name}}x{{/full_name}}', 'y', '').user_sections is True
+    email = compile_email('x', 'y', '{{#unsubscribe_link}}{{ unsubscribe_link }}{{/unsubscribe_link}}')
+    assert email.user_sections is False
@@ -199,6 +199,54 @@ async def test_edit_event(cli, url, db_conn, factory: Factory, login):
     assert location_lat == 50
 
 
+async def test_edit_event_update_email(cli, url, db_conn, factory: Factory, login, dummy_server):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published')
+    await login()
+    guest_id = await factory.create_user(first_name='Guest', email='guest@example.com', role='guest')
+
+    action_id = await db_conn.fetchval_b(
+        'INSERT INTO actions (:values__names) VALUES :values RETURNING id',
+        values=Values(company=factory.company_id, user_id=guest_id, type=ActionTypes.buy_tickets)
+    )
+    await db_conn.execute_b(
+        'INSERT INTO tickets (:values__names) VALUES :values',
+        values=MultipleValues(
+            Values(event=factory.event_id, user_id=guest_id, reserve_action=action_id, paid_action=action_id,
+                   status='paid'),
+            Values(event=factory.event_id, user_id=None, reserve_action=action_id, paid_action=action_id,
+                   status='paid'),
+        )
+    )
+
+    data = dict(location={'name': 'New Location', 'lat': 50, 'lng': 1})
+    r = await cli.put(url('event-edit', pk=factory.event_id), data=json.dumps(data))
+    assert r.status == 200, await r.text()
+    assert dummy_server.app['log'] == [
+        ('email_send_endpoint', 'Subject: "The Event Name Update", To: "Guest Spencer <guest@example.com>"'),
+    ]
+    assert 'New Location' in dummy_server.app['emails'][0]['part:text/plain']
+
+    r = await cli.put(url('event-edit', pk=factory.event_id), data=json.dumps(data))
+    assert r.status == 200, await r.text()
+    r = await cli.put(url('event-edit', pk=factory.event_id), data=json.dumps(dict(ticket_limit=20)))
+    assert r.status == 200, await r.text()
+    assert len(dummy_server.app['emails']) == 1
+    assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM email_outbox WHERE status='sent'")
+
+    # changing the location and then changing it back sends both updates
+    data_b = dict(location={'name': 'Other Location', 'lat': 51, 'lng': 2})
+    r = await cli.put(url('event-edit', pk=factory.event_id), data=json.dumps(data_b))
+    assert r.status == 200, await r.text()
+    r = await cli.put(url('event-edit', pk=factory.event_id), data=json.dumps(data))
+    assert r.status == 200, await r.text()
+    assert len(dummy_server.app['emails']) == 3
+    assert 'New Location' in dummy_server.app['emails'][2]['part:text/plain']
+    assert 3 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='edit-event'")
+
+
 async def test_set_event_status(cli, url, db_conn, factory: Factory, login):
     await factory.create_company()
     await factory.create_cat()
@@ -415,3 +463,43 @@ async def test_event_tickets_admin(cli, url, db_conn, factory: Factory, login):
             },
         ],
     }
+
+
+async def test_reserve_tickets_none_left(cli, url, db_conn, factory: Factory, login):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10, ticket_limit=1)
+    await login()
+
+    data = {
+        'tickets': [
+            {'t': True, 'name': 'Ticket Buyer', 'email': 'ticket.buyer@example.com'},
+            {'t': True, 'name': 'Other Person', 'email': 'other.person@example.com'},
+        ]
+    }
+    r = await cli.post(url('event-reserve-tickets', id=factory.event_id), data=json.dumps(data))
+    assert r.status == 470, await r.text()
+    data = await r.json()
+    assert data == {
+        'message': 'only 1 tickets remaining',
+        'tickets_remaining': 1,
+    }
+    assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM tickets')
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='reserve-tickets'")
+    assert 0 == await db_conn.fetchval('SELECT tickets_taken FROM events')
+
+
+async def test_reserve_tickets_not_published(cli, url, db_conn, factory: Factory, login):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(price=10)
+    await login()
+
+    data = {'tickets': [{'t': True, 'name': 'Ticket Buyer', 'email': 'ticket.buyer@example.com'}]}
+    r = await cli.post(url('event-reserve-tickets', id=factory.event_id), data=json.dumps(data))
+    assert r.status == 400, await r.text()
+    data = await r.json()
+    assert data == {'message': 'Event not published'}
+    assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM tickets')
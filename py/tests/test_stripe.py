@@ -1,15 +1,23 @@
+import asyncio
 import json
 import os
+from datetime import timedelta
 
 import pytest
 from aiohttp import BasicAuth
 from buildpg import Values
-from pytest_toolbox.comparison import CloseToNow, RegexStr
+from pytest_toolbox.comparison import AnyInt, CloseToNow, RegexStr
 
+from shared.emails import EmailActor
+from shared.stripe import (CircuitBreaker, PaymentStatus, ReservationError, StripeActor, StripeClient,
+                           StripeUnavailable, _get_customer_source, cancel_charge, complete_charge, get_payment_status,
+                           pay_reservation, set_payment_status, start_charge)
+from shared.utils import RequestError
 from web.stripe import Reservation, StripePayModel, stripe_pay, stripe_request
 from web.utils import encrypt_json
 
 from .conftest import Factory
+from .dummy_server import parse_behaviour
 
 stripe_public_key = 'pk_test_PMjnIfWjalY8jr4pkm1pexwR'
 stripe_secret_key = 'sk_test_WZT0Ntpze4QB8oeQIGeXAYsG'
@@ -48,9 +56,21 @@ def stripe_factory(factory, db_conn):
     return factory
 
 
-@real_stripe_test
-async def test_stripe_successful(cli, db_conn, stripe_factory: Factory):
-    await stripe_factory.create_company(stripe_public_key=stripe_public_key, stripe_secret_key=stripe_secret_key)
+@pytest.fixture(params=['stand-in', pytest.param('real', marks=real_stripe_test)])
+def stripe_keys(request, settings):
+    """
+    Public and secret keys for tests run against the stripe stand-in and, with REAL_STRIPE_TESTS, stripe's test mode.
+    """
+    if request.param == 'real':
+        settings.stripe_root = 'https://api.stripe.com/v1/'
+        return stripe_public_key, stripe_secret_key
+    else:
+        return 'pk_test_123', 'sk_test_123'
+
+
+async def test_stripe_successful(cli, db_conn, stripe_factory: Factory, stripe_keys):
+    public_key, secret_key = stripe_keys
+    await stripe_factory.create_company(stripe_public_key=public_key, stripe_secret_key=secret_key)
     await stripe_factory.create_cat()
     await stripe_factory.create_user()
     await stripe_factory.create_event(ticket_limit=10)
@@ -100,7 +120,7 @@ async def test_stripe_successful(cli, db_conn, stripe_factory: Factory):
         'card_last4': '4242',
     }
 
-    charge = await stripe_request(app, BasicAuth(stripe_secret_key), 'get', f'charges/{extra["charge_id"]}')
+    charge = await stripe_request(app, BasicAuth(secret_key), 'get', f'charges/{extra["charge_id"]}')
     # debug(d)
     assert charge['amount'] == 10_00
     assert charge['description'] == f'1 tickets for Foobar ({stripe_factory.event_id})'
@@ -113,9 +133,9 @@ async def test_stripe_successful(cli, db_conn, stripe_factory: Factory):
     assert charge['source']['last4'] == '4242'
 
 
-@real_stripe_test
-async def test_stripe_existing_customer_card(cli, db_conn, stripe_factory: Factory):
-    await stripe_factory.create_company(stripe_public_key=stripe_public_key, stripe_secret_key=stripe_secret_key)
+async def test_stripe_existing_customer_card(cli, db_conn, stripe_factory: Factory, stripe_keys):
+    public_key, secret_key = stripe_keys
+    await stripe_factory.create_company(stripe_public_key=public_key, stripe_secret_key=secret_key)
     await stripe_factory.create_cat()
     await stripe_factory.create_user()
     await stripe_factory.create_event(ticket_limit=10)
@@ -123,7 +143,7 @@ async def test_stripe_existing_customer_card(cli, db_conn, stripe_factory: Facto
     res: Reservation = await stripe_factory.create_reservation()
     app = cli.app['main_app']
 
-    customers = await stripe_request(app, BasicAuth(stripe_secret_key), 'get', 'customers?limit=1')
+    customers = await stripe_request(app, BasicAuth(secret_key), 'get', 'customers?limit=1')
     customer = customers['data'][0]
     customer_id = customer['id']
     await db_conn.execute('UPDATE users SET stripe_customer_id=$1 WHERE id=$2', customer_id, stripe_factory.user_id)
@@ -150,3 +170,477 @@ async def test_stripe_existing_customer_card(cli, db_conn, stripe_factory: Facto
         'card_expiry': RegexStr('\d+/\d+'),
         'card_last4': '4242',
     }
+
+
+async def start_test_charge(db_conn, factory: Factory, ticket_count=1):
+    await factory.create_company(stripe_public_key='pk_test_123', stripe_secret_key='sk_test_123')
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(ticket_limit=10)
+    return await start_reservation_charge(db_conn, factory, ticket_count)
+
+
+async def start_reservation_charge(db_conn, factory: Factory, ticket_count=1):
+    res: Reservation = await factory.create_reservation()
+    return await start_charge(
+        db_conn,
+        company_id=factory.company_id,
+        user_id=factory.user_id,
+        reserve_action_id=res.action_id,
+        ticket_count=ticket_count,
+        charge_data={'amount': 10_00, 'customer': 'cus_123', 'metadata': {'reserve_action': res.action_id}},
+        new_customer=True,
+        new_card=True,
+        stripe_sources={'4242-32-01': 'card_123'},
+    )
+
+
+async def test_start_complete_charge(db_conn, stripe_factory: Factory):
+    paid_action_id = await start_test_charge(db_conn, stripe_factory)
+
+    assert 'charging' == await db_conn.fetchval('SELECT status FROM tickets WHERE paid_action=$1', paid_action_id)
+    extra = json.loads(await db_conn.fetchval('SELECT extra FROM actions WHERE id=$1', paid_action_id))
+    assert extra == {
+        'charge_data': {
+            'amount': 10_00,
+            'customer': 'cus_123',
+            'metadata': {'reserve_action': AnyInt(), 'paid_action': paid_action_id},
+        },
+        'new_customer': True,
+        'new_card': True,
+    }
+    assert 'cus_123' == await db_conn.fetchval('SELECT stripe_customer_id FROM users')
+    assert {'4242-32-01': 'card_123'} == json.loads(await db_conn.fetchval('SELECT stripe_sources FROM users'))
+
+    charge = {'id': 'ch_123', 'source': {'last4': '4242', 'exp_month': 1, 'exp_year': 2032}}
+    await complete_charge(db_conn, paid_action_id=paid_action_id, charge=charge, new_customer=True, new_card=True)
+
+    assert 'paid' == await db_conn.fetchval('SELECT status FROM tickets WHERE paid_action=$1', paid_action_id)
+    extra = json.loads(await db_conn.fetchval('SELECT extra FROM actions WHERE id=$1', paid_action_id))
+    assert extra == {
+        'new_customer': True,
+        'new_card': True,
+        'charge_id': 'ch_123',
+        'card_last4': '4242',
+        'card_expiry': '1/32',
+    }
+
+
+async def test_cancel_charge(db_conn, stripe_factory: Factory):
+    paid_action_id = await start_test_charge(db_conn, stripe_factory)
+    await cancel_charge(db_conn, paid_action_id)
+
+    assert ('reserved', None) == tuple(await db_conn.fetchrow('SELECT status, paid_action FROM tickets'))
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+
+
+async def test_start_charge_wrong_count(db_conn, stripe_factory: Factory):
+    with pytest.raises(ReservationError):
+        await start_test_charge(db_conn, stripe_factory, ticket_count=2)
+
+    assert ('reserved', None) == tuple(await db_conn.fetchrow('SELECT status, paid_action FROM tickets'))
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    assert None is await db_conn.fetchval('SELECT stripe_customer_id FROM users')
+
+
+async def test_async_pay_invalid_reservation(cli, url, login, stripe_factory: Factory):
+    await stripe_factory.create_company()
+    await stripe_factory.create_cat()
+    await stripe_factory.create_user()
+    await stripe_factory.create_event(ticket_limit=10)
+    await login()
+
+    app = cli.app['main_app']
+    app['settings'].stripe_async_payments = True
+    res = Reservation(
+        user_id=stripe_factory.user_id,
+        action_id=123,
+        event_id=stripe_factory.event_id,
+        price_cent=10_00,
+        ticket_count=1,
+        event_name='Foobar',
+    )
+    data = dict(
+        stripe_token='tok_visa',
+        stripe_client_ip='0.0.0.0',
+        stripe_card_ref='4242-32-01',
+        booking_token=encrypt_json(app, res.dict()).decode(),
+    )
+    r = await cli.post(url('event-buy-tickets'), data=json.dumps(data))
+    assert r.status == 200, await r.text()
+    assert {'status': 'pending', 'payment_id': 123} == await r.json()
+
+    r = await cli.get(url('event-payment-status', id=123))
+    assert r.status == 200, await r.text()
+    assert {'status': 'failed', 'message': 'invalid reservation'} == await r.json()
+
+
+@pytest.fixture
+async def stripe_actor(settings, db_pool, loop):
+    email_actor = EmailActor(settings=settings, pg=db_pool, loop=loop, concurrency_enabled=False)
+    await email_actor.startup()
+    actor = StripeActor(settings=settings, pg=db_pool, email_actor=email_actor, loop=loop, concurrency_enabled=False)
+    yield actor
+    await actor.stripe.close()
+    await actor.close()
+    await email_actor.shutdown()
+    await email_actor.close()
+
+
+async def create_pay_reservation(factory: Factory):
+    await factory.create_company(stripe_public_key='pk_test_123', stripe_secret_key='sk_test_123')
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(ticket_limit=10)
+    return await factory.create_reservation()
+
+
+async def test_async_pay_error_before_charge(stripe_actor: StripeActor, db_conn, redis, stripe_factory, mocker):
+    res = await create_pay_reservation(stripe_factory)
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=asyncio.TimeoutError())
+
+    with pytest.raises(asyncio.TimeoutError):
+        await stripe_actor.pay(stripe_factory.company_id, res.dict(), 'tok_visa', '4242-32-01')
+
+    status = await get_payment_status(redis, res.action_id)
+    assert status == {'user_id': stripe_factory.user_id, 'status': 'failed', 'message': 'Payment failed'}
+    assert 'reserved' == await db_conn.fetchval('SELECT status FROM tickets')
+
+
+async def test_async_pay_error_after_charge_started(stripe_actor: StripeActor, db_conn, redis,
+                                                    stripe_factory: Factory, mocker):
+    res = await create_pay_reservation(stripe_factory)
+    await db_conn.execute('UPDATE users SET stripe_customer_id=$1, stripe_sources=$2', 'cus_123',
+                          json.dumps({'4242-32-01': 'card_123'}))
+    await set_payment_status(redis, res, PaymentStatus.pending)
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=asyncio.TimeoutError())
+
+    with pytest.raises(asyncio.TimeoutError):
+        await stripe_actor.pay(stripe_factory.company_id, res.dict(), 'tok_visa', '4242-32-01')
+
+    assert 'pending' == (await get_payment_status(redis, res.action_id))['status']
+    assert 'charging' == await db_conn.fetchval('SELECT status FROM tickets')
+
+
+async def test_payment_status_success_not_replaced(redis, stripe_factory: Factory):
+    res = await create_pay_reservation(stripe_factory)
+    assert await set_payment_status(redis, res, PaymentStatus.pending)
+    assert await set_payment_status(redis, res, PaymentStatus.success)
+    assert not await set_payment_status(redis, res, PaymentStatus.failed, 'invalid reservation')
+    assert not await set_payment_status(redis, res, PaymentStatus.pending)
+    assert 'success' == (await get_payment_status(redis, res.action_id))['status']
+
+
+async def test_payment_status_not_found(cli, url, login, factory: Factory):
+    await factory.create_company()
+    await factory.create_user()
+    await login()
+
+    r = await cli.get(url('event-payment-status', id=123))
+    assert r.status == 404, await r.text()
+
+
+async def test_customer_source_cached():
+    async def stripe_request(path, **kwargs):
+        raise AssertionError(f'unexpected stripe request to {path}')
+
+    cs = await _get_customer_source('tok_visa', '4242-32-01', 'cus_123', {'4242-32-01': 'card_123'},
+                                    stripe_request, stripe_request)
+    assert cs == ('cus_123', 'card_123', False, False, None, True)
+
+
+async def test_customer_source_refresh_cache():
+    requests = []
+
+    async def stripe_get(path):
+        requests.append(path)
+        return {'data': [{'id': 'card_123', 'last4': '4242', 'exp_year': 32, 'exp_month': '01'}]}
+
+    cs = await _get_customer_source('tok_visa', '4242-32-01', 'cus_123', {'1234-30-12': 'card_old'},
+                                    stripe_get, None)
+    assert cs == ('cus_123', 'card_123', False, False, {'4242-32-01': 'card_123'}, False)
+    assert requests == ['customers/cus_123/sources?object=card']
+
+
+def test_circuit_breaker(mocker):
+    mock_time = mocker.patch('shared.stripe.time', return_value=100)
+    breaker = CircuitBreaker(threshold=2, reset=30)
+    assert breaker.allow()
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert not breaker.allow()
+
+    mock_time.return_value = 131
+    assert breaker.allow()
+    breaker.record(False)
+    assert not breaker.allow()
+
+    mock_time.return_value = 162
+    assert breaker.allow()
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.allow()
+
+
+async def test_stripe_client_stand_in_errors(settings, loop, dummy_server, mocker):
+    settings.stripe_retries = 1
+    settings.stripe_retry_delay = 0
+    settings.stripe_circuit_threshold = 2
+    # keep requests in the same rate limit window
+    mocker.patch('tests.dummy_server.time', return_value=1000)
+    dummy_server.app['behaviour'].update(parse_behaviour({
+        'stripe_get_customer_sources': {'rate_limit': 1},
+        'stripe_post_charges': {'error_rate': 1},
+    }))
+    stripe = StripeClient(settings, loop=loop)
+    auth = BasicAuth('sk_test_123')
+    try:
+        await stripe.request(auth, 'get', 'customers/cus_1/sources')
+        with pytest.raises(RequestError) as exc_info:
+            await stripe.request(auth, 'get', 'customers/cus_1/sources')
+        assert exc_info.value.status == 429
+
+        # throttling doesn't open the circuit breaker, server errors do
+        with pytest.raises(RequestError) as exc_info:
+            await stripe.request(auth, 'post', 'charges', idempotency_key='charge-1', amount=100, source='src_1')
+        assert exc_info.value.status == 500
+        with pytest.raises(StripeUnavailable):
+            await stripe.request(auth, 'post', 'charges', idempotency_key='charge-2', amount=100, source='src_1')
+    finally:
+        await stripe.close()
+
+    assert dummy_server.app['log'] == [
+        ('stripe_get_customer_sources', 'cus_1'),
+        ('stripe_get_customer_sources', 'throttled'),
+        ('stripe_get_customer_sources', 'throttled'),
+        ('stripe_post_charges', 'error'),
+        ('stripe_post_charges', 'error'),
+    ]
+
+
+@pytest.fixture
+async def stripe_client(settings, loop):
+    settings.stripe_retry_delay = 0
+    client = StripeClient(settings, loop=loop)
+    yield client
+    await client.close()
+
+
+async def test_stripe_get_retried(stripe_client: StripeClient, dummy_server, mocker):
+    dummy_server.app['behaviour'].update(parse_behaviour({
+        'stripe_get_customer_sources': {'error_rate': 0.5, 'rate_limit': 1},
+    }))
+    # first attempt fails with a 500, the second is throttled and the third succeeds
+    mocker.patch('tests.dummy_server.random').random.side_effect = [0.1, 0.9]
+    mocker.patch('tests.dummy_server.time', side_effect=[1000, 1000, 1001])
+
+    data = await stripe_client.request(BasicAuth('sk_test_123'), 'get', 'customers/cus_1/sources')
+    assert data['data'][0]['id'] == 'src_1'
+    assert dummy_server.app['log'] == [
+        ('stripe_get_customer_sources', 'error'),
+        ('stripe_get_customer_sources', 'throttled'),
+        ('stripe_get_customer_sources', 'cus_1'),
+    ]
+
+
+async def test_stripe_post_retried_with_idempotency_key(stripe_client: StripeClient, dummy_server, mocker):
+    dummy_server.app['behaviour'].update(parse_behaviour({'stripe_post_charges': {'error_rate': 0.5}}))
+    mocker.patch('tests.dummy_server.random').random.side_effect = [0.1, 0.9, 0.1]
+    auth = BasicAuth('sk_test_123')
+
+    charge = await stripe_client.request(auth, 'post', 'charges', idempotency_key='charge-1', amount=100,
+                                         source='src_1')
+    assert charge['amount'] == 100
+
+    # without an idempotency key a retry could charge the customer twice
+    with pytest.raises(RequestError) as exc_info:
+        await stripe_client.request(auth, 'post', 'charges', amount=100, source='src_1')
+    assert exc_info.value.status == 500
+
+    assert dummy_server.app['log'] == [
+        ('stripe_post_charges', 'error'),
+        ('stripe_post_charges', '100'),
+        ('stripe_post_charges', 'error'),
+    ]
+
+
+async def test_stripe_retry_limit(stripe_client: StripeClient, settings, dummy_server):
+    settings.stripe_retries = 3
+    dummy_server.app['behaviour'].update(parse_behaviour({'stripe_get_customer_sources': {'error_rate': 1}}))
+    auth = BasicAuth('sk_test_123')
+
+    with pytest.raises(RequestError) as exc_info:
+        await stripe_client.request(auth, 'get', 'customers/cus_1/sources')
+    assert exc_info.value.status == 500
+
+    # client errors aren't retried
+    with pytest.raises(RequestError) as exc_info:
+        await stripe_client.request(auth, 'get', 'charges/ch_missing')
+    assert exc_info.value.status == 404
+
+    assert dummy_server.app['log'] == [('stripe_get_customer_sources', 'error')] * 4 + [
+        ('stripe_get_charge', 'ch_missing'),
+    ]
+
+
+async def test_charge_timeout_then_circuit_open(db_conn, stripe_factory: Factory, settings, loop, mocker):
+    res = await create_pay_reservation(stripe_factory)
+    await db_conn.execute('UPDATE users SET stripe_customer_id=$1, stripe_sources=$2', 'cus_123',
+                          json.dumps({'4242-32-01': 'card_123'}))
+    settings.stripe_circuit_threshold = 1
+    settings.stripe_retry_delay = 0
+    stripe = StripeClient(settings, loop=loop)
+    requests = []
+
+    async def request_timeout(breaker, method, url, **kwargs):
+        requests.append(url)
+        breaker.record(False)
+        raise asyncio.TimeoutError()
+
+    mocker.patch.object(stripe, '_request', side_effect=request_timeout)
+    try:
+        # the first attempt may have reached stripe, so the charge must be left for recover_charges
+        with pytest.raises(asyncio.TimeoutError):
+            await pay_reservation(db_conn, stripe, res, company_id=stripe_factory.company_id, stripe_token='tok_visa',
+                                  stripe_card_ref='4242-32-01')
+    finally:
+        await stripe.close()
+
+    assert len(requests) == 1
+    assert 'charging' == await db_conn.fetchval('SELECT status FROM tickets')
+    assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+
+
+TEST_CHARGE = {'id': 'ch_123', 'source': {'last4': '4242', 'exp_month': 8, 'exp_year': 2032}}
+
+
+async def age_charges(db_conn, age: timedelta):
+    await db_conn.execute("UPDATE actions SET ts=now() - $1::interval WHERE type='buy-tickets'", age)
+
+
+async def test_recover_charge_replayed(stripe_actor: StripeActor, db_conn, stripe_factory: Factory, dummy_server,
+                                       mocker):
+    paid_action_id = await start_test_charge(db_conn, stripe_factory)
+    await age_charges(db_conn, timedelta(minutes=10))
+
+    async def stripe_request(auth, method, path, **kwargs):
+        return TEST_CHARGE
+
+    request = mocker.patch.object(stripe_actor.stripe, 'request', side_effect=stripe_request)
+    assert 1 == await stripe_actor.recover_charges()
+
+    reserve_action_id = await db_conn.fetchval('SELECT reserve_action FROM tickets')
+    assert request.call_count == 1
+    assert request.call_args[0][1:] == ('post', 'charges')
+    assert request.call_args[1] == {
+        'idempotency_key': f'charge-{reserve_action_id}',
+        'amount': 10_00,
+        'customer': 'cus_123',
+        'metadata': {'reserve_action': reserve_action_id, 'paid_action': paid_action_id},
+    }
+    assert 'paid' == await db_conn.fetchval('SELECT status FROM tickets')
+    extra = json.loads(await db_conn.fetchval('SELECT extra FROM actions WHERE id=$1', paid_action_id))
+    assert extra['charge_id'] == 'ch_123'
+    assert dummy_server.app['log'] == [
+        ('email_send_endpoint', 'Subject: "The Event Name Ticket Confirmation", '
+                                'To: "Frank Spencer <frank@example.com>"'),
+    ]
+
+
+async def test_recover_charge_declined(stripe_actor: StripeActor, db_conn, redis, stripe_factory: Factory, mocker):
+    await start_test_charge(db_conn, stripe_factory)
+    await age_charges(db_conn, timedelta(minutes=10))
+    error = RequestError(402, 'charges', info=json.dumps({'error': {'type': 'card_error', 'message': 'declined'}}))
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=error)
+
+    assert 1 == await stripe_actor.recover_charges()
+
+    reserve_action_id, status, paid_action_id = await db_conn.fetchrow(
+        'SELECT reserve_action, status, paid_action FROM tickets'
+    )
+    assert ('reserved', None) == (status, paid_action_id)
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    status = await get_payment_status(redis, reserve_action_id)
+    assert status == {'user_id': stripe_factory.user_id, 'status': 'failed', 'message': 'declined'}
+
+
+async def test_async_pay_recovered(stripe_actor: StripeActor, cli, url, login, db_conn, redis,
+                                   stripe_factory: Factory, mocker):
+    res = await create_pay_reservation(stripe_factory)
+    await db_conn.execute('UPDATE users SET stripe_customer_id=$1, stripe_sources=$2', 'cus_123',
+                          json.dumps({'4242-32-01': 'card_123'}))
+    await login()
+    await set_payment_status(redis, res, PaymentStatus.pending)
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=asyncio.TimeoutError())
+
+    with pytest.raises(asyncio.TimeoutError):
+        await stripe_actor.pay(stripe_factory.company_id, res.dict(), 'tok_visa', '4242-32-01')
+
+    r = await cli.get(url('event-payment-status', id=res.action_id))
+    assert r.status == 200, await r.text()
+    assert {'status': 'pending', 'message': None} == await r.json()
+
+    async def stripe_request(auth, method, path, **kwargs):
+        return TEST_CHARGE
+
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=stripe_request)
+    await age_charges(db_conn, timedelta(minutes=10))
+    assert 1 == await stripe_actor.recover_charges()
+
+    r = await cli.get(url('event-payment-status', id=res.action_id))
+    assert r.status == 200, await r.text()
+    assert {'status': 'success', 'message': None} == await r.json()
+
+
+@pytest.mark.parametrize('error', [
+    RequestError(500, 'charges'),
+    RequestError(409, 'charges'),
+    asyncio.TimeoutError(),
+])
+async def test_recover_charge_retried(stripe_actor: StripeActor, db_conn, stripe_factory: Factory, mocker, error):
+    await start_test_charge(db_conn, stripe_factory)
+    await age_charges(db_conn, timedelta(minutes=10))
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=error)
+
+    assert 1 == await stripe_actor.recover_charges()
+
+    assert 'charging' == await db_conn.fetchval('SELECT status FROM tickets')
+    assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+
+
+async def test_recover_charge_recent_and_expired(stripe_actor: StripeActor, db_conn, stripe_factory: Factory, mocker,
+                                                 caplog):
+    await start_test_charge(db_conn, stripe_factory)
+    request = mocker.patch.object(stripe_actor.stripe, 'request')
+
+    # the charge may still be in progress
+    assert 0 == await stripe_actor.recover_charges()
+
+    # stripe has forgotten the idempotency key so the charge can't be safely replayed
+    await age_charges(db_conn, timedelta(days=2))
+    assert 1 == await stripe_actor.recover_charges()
+
+    assert request.call_count == 0
+    assert 'charging' == await db_conn.fetchval('SELECT status FROM tickets')
+    assert 'needs manual resolution' in caplog.text
+
+
+async def test_recover_charges_error_continues(stripe_actor: StripeActor, db_conn, stripe_factory: Factory, mocker,
+                                               caplog):
+    first_paid_action_id = await start_test_charge(db_conn, stripe_factory)
+    second_paid_action_id = await start_reservation_charge(db_conn, stripe_factory)
+    await db_conn.execute('UPDATE actions SET extra=$1 WHERE id=$2', '{}', first_paid_action_id)
+    await age_charges(db_conn, timedelta(minutes=10))
+
+    async def stripe_request(auth, method, path, **kwargs):
+        return TEST_CHARGE
+
+    mocker.patch.object(stripe_actor.stripe, 'request', side_effect=stripe_request)
+    assert 2 == await stripe_actor.recover_charges()
+
+    rows = await db_conn.fetch('SELECT paid_action, status FROM tickets ORDER BY paid_action')
+    assert [tuple(r) for r in rows] == [(first_paid_action_id, 'charging'), (second_paid_action_id, 'paid')]
+    assert f'error recovering charge for paid action {first_paid_action_id}' in caplog.text
@@ -1,7 +1,19 @@
+import asyncio
+import json
 from datetime import datetime
+from types import SimpleNamespace
 
+from arq import Actor
+from pytest_toolbox.comparison import CloseToNow
+
+from shared.db import ActionTypes
+from shared.worker import PriorityDrain
+from web.actions import ActionsBuffer
 from web.utils import pretty_lenient_json
 
+from .conftest import Factory
+from .dummy_server import create_dummy_app
+
 
 def test_pretty_json():
     a = {'foo': datetime(1970, 1, 2)}
@@ -10,3 +22,142 @@ def test_pretty_json():
         '  "foo": "1970-01-02T00:00:00"\n'
         '}\n'
     )
+
+
+async def test_priority_drain(redis, loop):
+    high, low = Actor.QUEUE_PREFIX + b'high', Actor.QUEUE_PREFIX + b'low'
+    await redis.rpush(low, b'low1', b'low2')
+    await redis.rpush(high, b'high1')
+    finish = asyncio.Event(loop=loop)
+
+    async def run_job(job):
+        await finish.wait()
+
+    drain = PriorityDrain(redis=redis, queue_limits={low: 1}, burst_mode=False)
+    popped = []
+    async with drain:
+        async for raw_queue, raw_data in drain.iter(high, low):
+            popped.append(raw_data)
+            if raw_queue is None:
+                break
+            drain.add(run_job, SimpleNamespace(raw_queue=raw_queue))
+        assert drain.queue_jobs == {high: 1, low: 1}
+        finish.set()
+    assert popped == [b'high1', b'low1', None]
+    assert drain.queue_jobs == {high: 0, low: 0}
+    assert await redis.lrange(low, 0, -1) == [b'low2']
+
+
+async def test_priority_drain_semaphore_timeout(redis, loop, caplog):
+    high = Actor.QUEUE_PREFIX + b'high'
+    await redis.rpush(high, b'high1', b'high2')
+    finish = asyncio.Event(loop=loop)
+
+    async def run_job(job):
+        await finish.wait()
+
+    drain = PriorityDrain(redis=redis, queue_limits={}, burst_mode=False, max_concurrent_tasks=1,
+                          semaphore_timeout=0.01)
+    popped = []
+    async with drain:
+        # the worker is full after the first job, iter must keep checking running rather than block
+        loop.call_later(0.1, setattr, drain, 'running', False)
+        async for raw_queue, raw_data in drain.iter(high):
+            popped.append(raw_data)
+            drain.add(run_job, SimpleNamespace(raw_queue=raw_queue))
+        finish.set()
+    assert popped == [b'high1']
+    assert 'task semaphore acquisition timed out after 0.0s' in caplog.text
+    assert await redis.lrange(high, 0, -1) == [b'high2']
+
+
+async def test_actions_buffer(db_pool, db_conn, factory: Factory, settings, loop):
+    await factory.create_company()
+    await factory.create_user()
+    settings.actions_buffer_size = 2
+    actions_buffer = ActionsBuffer(db_pool, settings, loop=loop)
+    actions_buffer.start()
+
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.login, '{"ip": "127.0.0.1"}')
+    await asyncio.sleep(0.01, loop=loop)
+    assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.logout)
+    await asyncio.sleep(0.01, loop=loop)
+    assert 2 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.unsubscribe)
+    await actions_buffer.close()
+    rows = await db_conn.fetch('SELECT type, extra, ts FROM actions ORDER BY id')
+    assert [r['type'] for r in rows] == ['login', 'logout', 'unsubscribe']
+    assert json.loads(rows[0]['extra']) == {'ip': '127.0.0.1'}
+    assert rows[2]['extra'] is None
+    assert rows[2]['ts'] == CloseToNow()
+
+
+async def test_actions_buffer_invalid_action(db_pool, db_conn, factory: Factory, settings, loop, caplog):
+    await factory.create_company()
+    await factory.create_user()
+    actions_buffer = ActionsBuffer(db_pool, settings, loop=loop)
+
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.login)
+    actions_buffer.add(factory.company_id, factory.user_id + 1, ActionTypes.logout)
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.unsubscribe)
+    assert 2 == await actions_buffer.flush()
+    assert actions_buffer.actions == []
+    rows = await db_conn.fetch('SELECT type FROM actions ORDER BY id')
+    assert [r['type'] for r in rows] == ['login', 'unsubscribe']
+    assert 'dropping invalid action' in caplog.text
+
+
+async def test_actions_buffer_limit(settings, loop, caplog):
+    class BrokenPool:
+        def acquire(self):
+            raise ConnectionRefusedError()
+
+    settings.actions_buffer_size = 100
+    settings.actions_buffer_limit = 3
+    actions_buffer = ActionsBuffer(BrokenPool(), settings, loop=loop)
+    for action_type in (ActionTypes.login, ActionTypes.logout):
+        actions_buffer.add(1, 2, action_type)
+    assert 0 == await actions_buffer.flush()
+    assert len(actions_buffer.actions) == 2
+    for action_type in (ActionTypes.login, ActionTypes.logout):
+        actions_buffer.add(1, 2, action_type)
+    assert [a[2] for a in actions_buffer.actions] == ['logout', 'login', 'logout']
+    assert 'actions buffer full, dropping the oldest 1 actions' in caplog.text
+
+
+async def test_actions_buffer_close_waits(db_pool, db_conn, factory: Factory, settings, loop):
+    await factory.create_company()
+    await factory.create_user()
+    settings.actions_buffer_size = 1
+    actions_buffer = ActionsBuffer(db_pool, settings, loop=loop)
+    actions_buffer.start()
+
+    actions_buffer.add(factory.company_id, factory.user_id, ActionTypes.login)
+    while not actions_buffer._flush:
+        await asyncio.sleep(0, loop=loop)
+    # the flush has started but not finished when close() cancels the task
+    assert not actions_buffer._flush.done()
+    await actions_buffer.close()
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+
+async def test_dummy_server_behaviour(aiohttp_client, loop):
+    client = await aiohttp_client(create_dummy_app(loop, {
+        'stripe_post_charges': {'latency': 'uniform:0:0.01', 'error_rate': 1},
+    }))
+    r = await client.post('/stripe_root/charges', data={'amount': 1000, 'source': 'src_1'})
+    assert r.status == 500, await r.text()
+    assert (await r.json())['error']['type'] == 'api_error'
+
+    r = await client.put('/_behaviour/', json={})
+    assert r.status == 200, await r.text()
+    r = await client.post('/stripe_root/charges', data={'amount': 1000, 'source': 'src_1'})
+    assert r.status == 200, await r.text()
+    assert (await r.json())['amount'] == 1000
+    assert client.server.app['log'] == [
+        ('stripe_post_charges', 'error'),
+        ('stripe_post_charges', '1000'),
+    ]
@@ -1,13 +1,43 @@
+import asyncio
 import json
+import logging
+from datetime import datetime, timezone
+
+from buildpg import asyncpg
 
 from shared.db import ActionTypes
+from shared.settings import Settings
 
 from .utils import get_ip
 
+logger = logging.getLogger('nosht.actions')
+
+# actions which are only recorded for auditing, nothing reads them back straight away so they can be saved
+# in batches by ActionsBuffer
+BUFFERED_ACTIONS = {
+    ActionTypes.login,
+    ActionTypes.guest_signin,
+    ActionTypes.host_signup,
+    ActionTypes.logout,
+    ActionTypes.cancel_reserved_tickets,
+    ActionTypes.unsubscribe,
+}
+
+INSERT_ACTIONS_SQL = """
+INSERT INTO actions (company, user_id, type, extra, ts)
+SELECT company, user_id, type, compact_action_extra(extra), ts
+FROM unnest($1::int[], $2::int[], $3::action_types[], $4::jsonb[], $5::timestamptz[])
+  AS t(company, user_id, type, extra, ts)
+"""
+
 
 def actions_request_extra(request):
+    """
+    Request details saved with actions, the url's host is always the company's domain so isn't included,
+    the user agent is moved to the user_agents table by compact_action_extra.
+    """
     return dict(
-        url=str(request.url),
+        url=str(request.rel_url),
         ip=get_ip(request),
         ua=request.headers.get('User-Agent')
     )
@@ -15,14 +45,108 @@ def actions_request_extra(request):
 
 async def record_action(request, user_id, action_type: ActionTypes, **extra):
     extra = json.dumps({**actions_request_extra(request), **extra})
-    await request['conn'].execute(
-        'INSERT INTO actions (company, user_id, type, extra) VALUES ($1, $2, $3, $4)',
-        request['company_id'], user_id, action_type.value, extra)
+    actions_buffer = request.app.get('actions_buffer')
+    if actions_buffer and action_type in BUFFERED_ACTIONS:
+        actions_buffer.add(request['company_id'], user_id, action_type, extra)
+    else:
+        await request['conn'].execute(
+            'INSERT INTO actions (company, user_id, type, extra) VALUES ($1, $2, $3, compact_action_extra($4))',
+            request['company_id'], user_id, action_type.value, extra)
 
 
 async def record_action_id(request, user_id, action_type: ActionTypes, **extra):
     extra = json.dumps({**actions_request_extra(request), **extra})
     return await request['conn'].fetchval(
-        'INSERT INTO actions (company, user_id, type, extra) VALUES ($1, $2, $3, $4) RETURNING id',
+        'INSERT INTO actions (company, user_id, type, extra) VALUES ($1, $2, $3, compact_action_extra($4)) '
+        'RETURNING id',
         request['company_id'], user_id, action_type.value, extra
     )
+
+
+class ActionsBuffer:
+    """
+    Saves actions to the db in batches from a background task, either every actions_flush_interval seconds or
+    as soon as actions_buffer_size actions are waiting. Remaining actions are saved by close().
+
+    Batches which fail with a temporary error, eg. the db being unavailable, are retried but no more than
+    actions_buffer_limit actions are kept. Batches with invalid actions are split to save the valid ones.
+    """
+    def __init__(self, pg, settings: Settings, *, loop=None):
+        self.pg = pg
+        self.max_size = settings.actions_buffer_size
+        self.limit = settings.actions_buffer_limit
+        self.interval = settings.actions_flush_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.actions = []
+        self._full = asyncio.Event(loop=self.loop)
+        self._task = None
+        self._flush = None
+
+    def start(self):
+        self._task = self.loop.create_task(self._run())
+
+    def add(self, company_id: int, user_id: int, action_type: ActionTypes, extra: str = None):
+        # ts is set here so actions keep the time they happened rather than the time they were saved
+        self.actions.append((company_id, user_id, action_type.value, extra, datetime.now(timezone.utc)))
+        if len(self.actions) >= self.max_size:
+            self._full.set()
+        self._limit()
+
+    async def flush(self) -> int:
+        actions, self.actions = self.actions, []
+        if not actions:
+            return 0
+        try:
+            saved = await self._save(actions)
+        except Exception:
+            logger.exception('error saving %d actions, will retry', len(actions))
+            self.actions = actions + self.actions
+            self._limit()
+            return 0
+        return saved
+
+    async def _save(self, actions) -> int:
+        """
+        Save actions, if any are invalid the batch is split in two and each half saved separately so only invalid
+        actions are dropped.
+        """
+        try:
+            async with self.pg.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(INSERT_ACTIONS_SQL, *(list(column) for column in zip(*actions)))
+        except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+            if len(actions) == 1:
+                logger.error('dropping invalid action %s: %s %s', actions[0], e.__class__.__name__, e)
+                return 0
+            middle = len(actions) // 2
+            return await self._save(actions[:middle]) + await self._save(actions[middle:])
+        return len(actions)
+
+    def _limit(self):
+        dropped = len(self.actions) - self.limit
+        if dropped > 0:
+            logger.error('actions buffer full, dropping the oldest %d actions', dropped)
+            del self.actions[:dropped]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            # shielded so close() cancelling the task can't interrupt a flush and lose actions
+            self._flush = asyncio.ensure_future(self.flush(), loop=self.loop)
+            await asyncio.shield(self._flush, loop=self.loop)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._flush:
+            # wait for a flush interrupted by cancelling the task to finish before the pg pool is closed
+            await self._flush
+        await self.flush()
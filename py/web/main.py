@@ -12,8 +12,10 @@ from shared.db import prepare_database
 from shared.emails import EmailActor
 from shared.logs import setup_logging
 from shared.settings import Settings
+from shared.stripe import StripeActor, StripeClient
 from shared.utils import mk_password
 
+from .actions import ActionsBuffer
 from .middleware import error_middleware, host_middleware, pg_middleware
 from .views import index
 from .views.auth import (authenticate_token, guest_signin, host_signup, login, login_with, logout, set_password,
@@ -21,7 +23,7 @@ from .views.auth import (authenticate_token, guest_signin, host_signup, login, l
 from .views.categories import (CategoryBread, category_add_image, category_default_image, category_delete_image,
                                category_images, category_public)
 from .views.events import (BuyTickets, CancelReservedTickets, EventBread, ReserveTickets, SetEventStatus, booking_info,
-                           event_categories, event_public, event_tickets)
+                           event_categories, event_public, event_tickets, payment_status)
 from .views.static import static_handler
 from .views.users import UserBread
 
@@ -33,18 +35,26 @@ async def startup(app: web.Application):
     await prepare_database(settings, False)
     redis = await create_pool_lenient(settings.redis_settings, app.loop)
     http_client = ClientSession(timeout=ClientTimeout(total=20), loop=app.loop)
+    stripe_client = StripeClient(settings, loop=app.loop)
+    email_actor = EmailActor(settings=settings, existing_redis=redis, http_client=http_client)
     app.update(
         pg=app.get('pg') or await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=2),
         redis=redis,
-        email_actor=EmailActor(settings=settings, existing_redis=redis, http_client=http_client),
+        email_actor=email_actor,
+        stripe_actor=StripeActor(settings=settings, existing_redis=redis, stripe_client=stripe_client,
+                                 email_actor=email_actor),
         http_client=http_client,
-        # custom stripe client to make stripe requests as speedy as possible
-        stripe_client=ClientSession(timeout=ClientTimeout(total=5), loop=app.loop),
+        stripe_client=stripe_client,
     )
+    if settings.actions_buffer_size:
+        app['actions_buffer'] = ActionsBuffer(app['pg'], settings, loop=app.loop)
+        app['actions_buffer'].start()
 
 
 async def cleanup(app: web.Application):
     await app['email_actor'].close()
+    actions_buffer = app.get('actions_buffer')
+    actions_buffer and await actions_buffer.close()
     await app['pg'].close()
     await app['http_client'].close()
     await app['stripe_client'].close()
@@ -89,6 +99,7 @@ def create_app(*, settings: Settings=None, logging_client=None):
         web.get('/events/{id:\d+}/tickets/', event_tickets, name='event-tickets'),
         web.post('/events/{id:\d+}/reserve/', ReserveTickets.view(), name='event-reserve-tickets'),
         web.post('/events/buy/', BuyTickets.view(), name='event-buy-tickets'),
+        web.get('/events/payment/{id:\d+}/', payment_status, name='event-payment-status'),
         web.post('/events/cancel-reservation/', CancelReservedTickets.view(), name='event-cancel-reservation'),
         web.get('/events/{category}/{event}/', event_public, name='event-get'),
 
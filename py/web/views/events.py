@@ -1,3 +1,4 @@
+import json
 import logging
 from datetime import datetime, timedelta
 from enum import Enum
@@ -5,18 +6,19 @@ from textwrap import shorten
 from time import time
 from typing import List, Optional
 
-from asyncpg import CheckViolationError
-from buildpg import MultipleValues, V, Values, funcs
+from buildpg import V, funcs
 from buildpg.asyncpg import BuildPgConnection
 from buildpg.clauses import Join, Where
 from pydantic import BaseModel, EmailStr, constr
+from pydantic.json import pydantic_encoder
 
+from shared.stripe import PaymentStatus, get_payment_status, set_payment_status
 from shared.utils import slugify
-from web.actions import ActionTypes, record_action, record_action_id
+from web.actions import ActionTypes, actions_request_extra, record_action, record_action_id
 from web.auth import check_session, is_admin_or_host, is_auth
 from web.bread import Bread, UpdateView
-from web.stripe import Reservation, StripePayModel, stripe_pay
-from web.utils import JsonErrors, decrypt_json, encrypt_json, json_response, raw_json_response, split_name, to_json_if
+from web.stripe import Reservation, StripePayModel, get_reservation, stripe_pay
+from web.utils import JsonErrors, decrypt_json, encrypt_json, json_response, raw_json_response, split_name
 
 logger = logging.getLogger('nosht.events')
 
@@ -86,6 +88,10 @@ async def event_categories(request):
     return raw_json_response(json_str)
 
 
+# changes to these fields are emailed to ticket holders
+EVENT_UPDATE_FIELDS = {'start_ts', 'duration', 'location_name', 'location_lat', 'location_lng'}
+
+
 class EventBread(Bread):
     class Model(BaseModel):
         name: constr(max_length=63)
@@ -184,6 +190,19 @@ class EventBread(Bread):
     def prepare_edit_data(self, data):
         return self.prepare(data)
 
+    async def edit_execute(self, pk, data):
+        update_fields = EVENT_UPDATE_FIELDS & data.keys()
+        if update_fields:
+            before = await self.conn.fetchrow(
+                'SELECT start_ts, duration, location_name, location_lat, location_lng FROM events WHERE id=$1', pk
+            )
+            update_fields = {f for f in update_fields if data[f] != before[f]}
+        await super().edit_execute(pk, data)
+        if update_fields:
+            action_id = await record_action_id(self.request, self.request['session']['user_id'],
+                                               ActionTypes.edit_event, event_id=pk, fields=sorted(update_fields))
+            await self.app['email_actor'].send_event_update(pk, action_id)
+
 
 event_ticket_sql = """
 SELECT json_build_object('tickets', tickets)
@@ -283,6 +302,19 @@ class TicketModel(BaseModel):
     extra_info: str = None
 
 
+class ReserveResult(str, Enum):
+    """
+    Must match the results returned by reserve_tickets in sql/logic.sql
+    """
+    ok = 'ok'
+    not_found = 'not-found'
+    not_published = 'not-published'
+    insufficient = 'insufficient'
+
+
+RESERVE_SQL = 'SELECT * FROM reserve_tickets($1, $2, $3, $4, $5, $6)'
+
+
 class ReserveTickets(UpdateView):
     class Model(BaseModel):
         tickets: List[TicketModel]
@@ -296,104 +328,56 @@ class ReserveTickets(UpdateView):
         if ticket_count < 1:
             raise JsonErrors.HTTPBadRequest(message='at least one ticket must be purchased')
 
-        status, event_price, event_name = await self.conn.fetchrow(
-            """
-            SELECT e.status, e.price, e.name
-            FROM events AS e
-            JOIN categories c on e.category = c.id
-            WHERE c.company=$1 AND e.id=$2
-            """,
-            self.request['company_id'], event_id
-        )
-        if status != 'published':
-            raise JsonErrors.HTTPBadRequest(message='Event not published')
+        # TODO check user isn't already booked
 
-        tickets_remaining = await self.conn.fetchval(
-            'SELECT check_tickets_remaining($1, $2)',
-            event_id, self.settings.ticket_ttl
+        r = await self.conn.fetchrow(
+            RESERVE_SQL,
+            self.request['company_id'],
+            event_id,
+            self.session['user_id'],
+            json.dumps([self.ticket_data(t) for t in m.tickets], default=pydantic_encoder),
+            json.dumps(actions_request_extra(self.request)),
+            self.settings.ticket_ttl,
         )
-
-        if tickets_remaining is not None and ticket_count > tickets_remaining:
+        result = ReserveResult(r['result'])
+        if result == ReserveResult.not_found:
+            raise JsonErrors.HTTPNotFound(message='Event not found')
+        elif result == ReserveResult.not_published:
+            raise JsonErrors.HTTPBadRequest(message='Event not published')
+        elif result == ReserveResult.insufficient:
+            tickets_remaining = r['tickets_remaining']
             raise JsonErrors.HTTP470(message=f'only {tickets_remaining} tickets remaining',
                                      tickets_remaining=tickets_remaining)
 
-        # TODO check user isn't already booked
-
-        try:
-            async with self.conn.transaction():
-                user_lookup = await self.create_users(m.tickets)
-
-                action_id = await record_action_id(self.request, self.session['user_id'], ActionTypes.reserve_tickets)
-                await self.conn.execute_b(
-                    'INSERT INTO tickets (:values__names) VALUES :values',
-                    values=MultipleValues(*[
-                        Values(
-                            event=event_id,
-                            user_id=user_lookup[t.email.lower()] if t.email else None,
-                            reserve_action=action_id,
-                            extra=to_json_if(t.dict(include={'dietary_req', 'extra_info'})),
-                        )
-                        for t in m.tickets
-                    ])
-                )
-                await self.conn.execute('SELECT check_tickets_remaining($1, $2)', event_id, self.settings.ticket_ttl)
-        except CheckViolationError as e:
-            logger.warning('CheckViolationError: %s', e)
-            raise JsonErrors.HTTPBadRequest(message='insufficient tickets remaining')
-
-        user = await self.conn.fetchrow(
-            """
-            SELECT id, full_name(first_name, last_name, email) AS name, email, role
-            FROM users
-            WHERE id=$1
-            """,
-            self.session['user_id']
-        )
+        event_price = r['event_price']
         # TODO needs to work when the event is free
         price_cent = int(event_price * ticket_count * 100)
         res = Reservation(
             user_id=self.session['user_id'],
-            action_id=action_id,
+            action_id=r['action_id'],
             price_cent=price_cent,
             event_id=event_id,
             ticket_count=ticket_count,
-            event_name=event_name,
+            event_name=r['event_name'],
         )
         return {
             'booking_token': encrypt_json(self.app, res.dict()),
             'ticket_count': ticket_count,
             'item_price_cent': int(event_price * 100),
             'total_price_cent': price_cent,
-            'user': dict(user),
+            'user': json.loads(r['user_json']),
             'timeout': int(time()) + self.settings.ticket_ttl,
         }
 
-    async def create_users(self, tickets: List[TicketModel]):
-        user_values = []
-
-        for t in tickets:
-            if t.name or t.email:
-                first_name, last_name = split_name(t.name)
-                user_values.append(
-                    Values(
-                        company=self.request['company_id'],
-                        role='guest',
-                        first_name=first_name,
-                        last_name=last_name,
-                        email=t.email and t.email.lower(),
-                    )
-                )
-        rows = await self.conn.fetch_b(
-            """
-            INSERT INTO users AS u (:values__names) VALUES :values
-            ON CONFLICT (company, email) DO UPDATE SET
-              first_name=coalesce(u.first_name, EXCLUDED.first_name),
-              last_name=coalesce(u.last_name, EXCLUDED.last_name)
-            RETURNING id, email
-            """,
-            values=MultipleValues(*user_values)
+    @staticmethod
+    def ticket_data(t: TicketModel):
+        first_name, last_name = split_name(t.name)
+        return dict(
+            first_name=first_name,
+            last_name=last_name,
+            email=t.email and t.email.lower(),
+            extra={k: v for k, v in t.dict(include={'dietary_req', 'extra_info'}).items() if v} or None,
         )
-        return {r['email']: r['id'] for r in rows}
 
 
 class CancelReservedTickets(UpdateView):
@@ -413,5 +397,21 @@ class BuyTickets(UpdateView):
     Model = StripePayModel
 
     async def execute(self, m: StripePayModel):
+        if self.settings.stripe_async_payments:
+            res = get_reservation(m, self.session['user_id'], self.app)
+            await set_payment_status(self.app['redis'], res, PaymentStatus.pending)
+            await self.app['stripe_actor'].pay(self.request['company_id'], res.dict(), m.stripe_token,
+                                               m.stripe_card_ref)
+            return {'status': PaymentStatus.pending.value, 'payment_id': res.action_id}
+
         paid_action_id = await stripe_pay(m, self.request['company_id'], self.session['user_id'], self.app, self.conn)
         await self.app['email_actor'].send_event_conf(paid_action_id)
+
+
+@is_auth
+async def payment_status(request):
+    payment_id = int(request.match_info['id'])
+    status = await get_payment_status(request.app['redis'], payment_id)
+    if not status or status['user_id'] != request['session']['user_id']:
+        raise JsonErrors.HTTPNotFound(message='payment not found')
+    return json_response(status=status['status'], message=status['message'])